@@ -1,22 +1,69 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django import forms
 from django.contrib import admin
 
 from rules.models import *
 
 
+class RuleResponseForm(forms.ModelForm):
+    """Edits the response text, which lives in the shared body store rather than on the RuleResponse row."""
+
+    response = forms.CharField(widget=forms.Textarea, required=False)
+
+    class Meta:
+        model = RuleResponse
+        fields = ('response', 'body_file', 'active', 'weight')
+
+    def __init__(self, *args, **kwargs):
+        super(RuleResponseForm, self).__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.initial['response'] = self.instance.response
+
+    def save(self, commit=True):
+        self.instance.response = self.cleaned_data['response']
+        return super(RuleResponseForm, self).save(commit)
+
+
 class RuleResponseInline(admin.TabularInline):
     model = RuleResponse
+    form = RuleResponseForm
 
 
 class RuleSubstitutionInline(admin.TabularInline):
     model = RuleSubstitution
 
 
+def _stats_column(field, description):
+    def column(model_admin, rule):
+        try:
+            return getattr(rule.stats, field)
+        except RuleStats.DoesNotExist:
+            return None
+    column.short_description = description
+    column.admin_order_field = 'stats__%s' % field
+    return column
+
+
 class RuleAdmin(admin.ModelAdmin):
-    list_display = ('vendor', 'hostname', 'path', 'verb', 'action', 'delay_ms', 'live_url')
+    list_display = ('vendor', 'hostname', 'path', 'verb', 'match_params', 'action', 'delay_ms', 'live_url', 'hits',
+                    'last_seen', 'latency_p50_ms', 'latency_p99_ms')
     list_filter = ('vendor', 'verb', 'action')
+    list_select_related = ('vendor', 'stats')
     inlines = (RuleResponseInline, RuleSubstitutionInline)
 
+    hits = _stats_column('hits', 'hits')
+    last_seen = _stats_column('last_seen', 'last seen')
+    latency_p50_ms = _stats_column('latency_p50_ms', 'p50 ms')
+    latency_p99_ms = _stats_column('latency_p99_ms', 'p99 ms')
+
+
+class RuleStatsAdmin(admin.ModelAdmin):
+    list_display = ('rule', 'hits', 'last_seen', 'latency_p50_ms', 'latency_p99_ms', 'action_counts')
+    list_select_related = ('rule',)
+    readonly_fields = ('rule', 'hits', 'last_seen', 'action_counts', 'latency_histogram', 'latency_p50_ms',
+                       'latency_p99_ms')
+
 admin.site.register(Rule, RuleAdmin)
+admin.site.register(RuleStats, RuleStatsAdmin)
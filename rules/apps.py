@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class RulesConfig(AppConfig):
     name = 'rules'
+
+    def ready(self):
+        import rules.signals  # noqa: connects the receivers that keep the compiled rule table current
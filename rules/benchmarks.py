@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.six.moves import BaseHTTPServer, socketserver
+
+from rules.discovery import rule_discovery
+from rules.models import Rule, RuleResponse, RuleSubstitution
+from rules.table import rule_table
+from stormcloud.middleware import StormCloudMiddleware
+
+# measured once per rule table size
+FIXED_ACTIONS = ('301', '302', '500', 'unknown')
+# also measured per response size and substitution count
+BODY_ACTIONS = ('flat', 'live', 'proxy')
+
+
+def make_body(size, substitutions):
+    """size bytes of text containing each of the substitutions' finds (needle0, needle1...) over and over."""
+    words = []
+    length = 0
+    while length < size:
+        word = 'needle%s lorem ipsum ' % (len(words) % substitutions) if substitutions else 'lorem ipsum '
+        words.append(word)
+        length += len(word)
+    return ''.join(words)[:size]
+
+
+class StubServer(object):
+    """A local upstream for live and proxy rules, answering /<size>/<substitutions> with that make_body()."""
+
+    def __init__(self):
+        bodies = {}
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, as a vendor would be
+            wbufsize = -1  # one write per response, rather than one per header line that then waits on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                key = tuple(int(part) for part in self.path.split('?')[0].strip('/').split('/'))
+                body = bodies.get(key)
+                if body is None:
+                    body = bodies[key] = make_body(*key).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(middleware, make_request, requests, warmup):
+    """Runs requests through the middleware one at a time, timing each from the call until its body is read."""
+    latencies = []
+    for i in range(warmup + requests):
+        request = make_request(i)
+        started = default_timer()
+        response = middleware(request)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        else:
+            response.content
+        response.close()
+        if i >= warmup:
+            latencies.append(default_timer() - started)
+
+    latencies.sort()
+    return OrderedDict([
+        ('requests', requests),
+        ('rps', requests / sum(latencies)),
+        ('p50_ms', percentile(latencies, 0.5) * 1000.0),
+        ('p99_ms', percentile(latencies, 0.99) * 1000.0),
+    ])
+
+
+def create_rule(path, action, body='', substitutions=0, live_url=None):
+    rule = Rule.objects.create(hostname='testserver', path=path, verb='GET', action=action, live_url=live_url)
+    if action in ('flat', '301', '302'):
+        RuleResponse.objects.create(rule=rule, response=body if action == 'flat' else 'https://example.com/moved')
+    for i in range(substitutions):
+        RuleSubstitution.objects.create(rule=rule, find='needle%s' % i, replace='pin%s' % i)
+    return rule
+
+
+def run_benchmarks(requests=1000, table_sizes=(100, 10000), response_sizes=(1024, 65536), substitution_counts=(0, 10),
+                   report=None):
+    """Drives StormCloudMiddleware through every action against the current database, returning
+    {scenario: {requests, rps, p50_ms, p99_ms}}. report, if given, is called with each scenario as it finishes."""
+    middleware = StormCloudMiddleware(get_response=lambda request: HttpResponse(''))
+    factory = RequestFactory()
+    warmup = max(10, requests // 10)
+    results = OrderedDict()
+    upstream = StubServer()
+
+    def run(name, make_request):
+        results[name] = measure(middleware, make_request, requests, warmup)
+        if report is not None:
+            report(name, results[name])
+
+    try:
+        created = 0
+        for table_size in sorted(table_sizes):
+            # the rest of the table, so lookups are measured at this size
+            Rule.objects.bulk_create((Rule(hostname='testserver', path='/filler/%s' % i, verb='GET', action='200')
+                                      for i in range(created, table_size)), batch_size=500)
+            created = max(created, table_size)
+            rule_table.clear()
+
+            for action in FIXED_ACTIONS:
+                name = '%s rules=%s' % (action, table_size)
+                if action == 'unknown':
+                    run(name, lambda i, table_size=table_size: factory.get('/unknown/%s/%s' % (table_size, i)))
+                    rule_discovery.flush()
+                else:
+                    path = create_rule('/benchmark/%s/%s' % (action, table_size), action).path
+                    run(name, lambda i, path=path: factory.get(path))
+
+            for action in BODY_ACTIONS:
+                for size in response_sizes:
+                    for substitutions in substitution_counts:
+                        live_url = '%s/%s/%s' % (upstream.url, size, substitutions)
+                        path = create_rule('/benchmark/%s/%s/%s/%s' % (action, table_size, size, substitutions),
+                                           action, make_body(size, substitutions), substitutions, live_url).path
+                        run('%s rules=%s body=%s subs=%s' % (action, table_size, size, substitutions),
+                            lambda i, path=path: factory.get(path))
+    finally:
+        upstream.stop()
+        rule_table.clear()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """The ways results regressed past the baseline by more than tolerance (a fraction), as messages."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append("%s: %.0f req/s, baseline %.0f" % (name, result['rps'], base['rps']))
+        for field in ('p50_ms', 'p99_ms'):
+            if result[field] > base[field] * (1 + tolerance):
+                regressions.append("%s: %s %.3f, baseline %.3f" % (name, field, result[field], base[field]))
+    return regressions
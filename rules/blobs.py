@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import io
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for STORMCLOUD_BODY_COMPRESSION = 'zstd'
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional, responses are offered in br as well as gzip if it's installed
+    brotli = None
+
+# bodies shorter than this are stored as they are, compressing them saves next to nothing
+MIN_COMPRESS_SIZE = 256
+
+
+def body_digest(data):
+    """The content address of an encoded body."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data):
+    """(encoding, stored bytes) for a body, compressed with STORMCLOUD_BODY_COMPRESSION ('zlib', 'zstd' or None) if that
+    makes it smaller."""
+    method = getattr(settings, 'STORMCLOUD_BODY_COMPRESSION', 'zlib')
+    if not method or len(data) < MIN_COMPRESS_SIZE:
+        return '', data
+    if method == 'zlib':
+        compressed = zlib.compress(data, 9)
+    elif method == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("STORMCLOUD_BODY_COMPRESSION = 'zstd' needs the zstandard package installed")
+        compressed = zstandard.ZstdCompressor(level=19).compress(data)
+    else:
+        raise ImproperlyConfigured("Unknown STORMCLOUD_BODY_COMPRESSION %r, use 'zlib', 'zstd' or None" % method)
+    if len(compressed) >= len(data):
+        return '', data
+    return method, compressed
+
+
+def gzip_bytes(data, level=9):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(mode='wb', compresslevel=level, fileobj=buffer, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def content_encodings(data):
+    """The Content-Encoding variants (gzip, and br if brotli is installed) a body is served in to clients that accept
+    them, by encoding. Leaves out any that wouldn't be smaller."""
+    if len(data) < MIN_COMPRESS_SIZE:
+        return {}
+    variants = {'gzip': gzip_bytes(data)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return dict((encoding, encoded) for encoding, encoded in variants.items() if len(encoded) < len(data))
+
+
+def decompress(encoding, data):
+    data = bytes(data)  # BinaryFields come back as memoryview / buffer on some databases
+    if not encoding:
+        return data
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ImproperlyConfigured("Response bodies were stored with zstd, install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown response body encoding %r" % encoding)
+
+
+class BodyCache(object):
+    """Decoded response bodies by digest, least recently used dropped first once they add up to more than
+    STORMCLOUD_BODY_CACHE_SIZE bytes. A digest's body never changes, so nothing here is ever stale."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bodies = OrderedDict()  # digest -> (text, size), least recently used first
+        self.size = 0
+
+    @property
+    def capacity(self):
+        return getattr(settings, 'STORMCLOUD_BODY_CACHE_SIZE', 64 * 1024 * 1024)
+
+    def get(self, digest):
+        with self._lock:
+            entry = self.bodies.pop(digest, None)
+            if entry is None:
+                return None
+            self.bodies[digest] = entry  # now the most recently used
+            return entry[0]
+
+    def put(self, digest, text, size):
+        if size > self.capacity:
+            return
+        with self._lock:
+            if digest in self.bodies:
+                return
+            self.bodies[digest] = (text, size)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, evicted) = self.bodies.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self.bodies.clear()
+            self.size = 0
+
+
+body_cache = BodyCache()
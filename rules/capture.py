@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import hashlib
+import io
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+
+from rules.router import request_host
+
+logger = logging.getLogger(__name__)
+
+# how often (seconds) captured requests are appended to the capture file
+WRITE_INTERVAL = 1.0
+
+
+class TrafficCapture(object):
+    """Records every request the middleware sees to STORMCLOUD_CAPTURE_PATH, one JSON object per line, for
+    `manage.py replay_traffic` to play back:
+
+        {"ts": 1514160000.123, "host": "api.stripe.com", "path": "/v1/charges", "verb": "POST",
+         "params": {"get": {}, "post": {"amount": ["100"]}}, "content_type": "application/x-www-form-urlencoded",
+         "body_sha1": "...", "body_length": 10, "rule": 12, "status": 200}
+
+    host is the hostname the request was sent to (its Host header), which vendors are matched on and the replay sends
+    again. Only the hash and length of a body are kept. Lines are queued in memory and appended by a background writer, one
+    write per batch, so several processes can share a file."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self.pending = []  # encoded lines
+
+    @property
+    def path(self):
+        return getattr(settings, 'STORMCLOUD_CAPTURE_PATH', None)
+
+    def start(self, request):
+        """What there is to know about a request before it's handled (after which its body may have been streamed
+        away), or None if capturing is off."""
+        if not self.path:
+            return None
+        try:
+            body = request.body
+        except RequestDataTooBig:  # left unread for the proxy to stream, and its form fields with it
+            body = None
+        return {
+            'ts': time.time(),
+            'host': request_host(request.META),
+            'path': request.META['PATH_INFO'],
+            'verb': request.META['REQUEST_METHOD'],
+            'params': {'get': dict(request.GET.lists()), 'post': dict(request.POST.lists()) if body is not None else {}},
+            'content_type': request.META.get('CONTENT_TYPE', ''),
+            'body_sha1': hashlib.sha1(body).hexdigest() if body else None,
+            'body_length': len(body) if body is not None else int(request.META.get('CONTENT_LENGTH') or 0),
+        }
+
+    def finish(self, record, rule, response):
+        record['rule'] = rule.pk if rule is not None else None
+        record['status'] = response.status_code
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self.pending.append(line)
+        self._start_writer()
+
+    def _start_writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='stormcloud-traffic-capture')
+                    self._writer.daemon = True
+                    self._writer.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(WRITE_INTERVAL)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing captured traffic failed")
+
+    def flush(self):
+        """Appends everything waiting to the capture file, returns how many requests were written."""
+        with self._lock:
+            lines, self.pending = self.pending, []
+        if lines and self.path:
+            with io.open(self.path, 'ab') as f:
+                f.write(''.join(lines).encode('utf-8'))
+        return len(lines)
+
+
+traffic_capture = TrafficCapture()
+
+
+def read_capture(path):
+    """The requests in a capture file, oldest first."""
+    with io.open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records.sort(key=lambda record: record['ts'])
+    return records
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+
+from rules.learning import template_for
+from rules.models import Rule
+from rules.snapshot import get_snapshot
+from rules.table import rule_table
+
+logger = logging.getLogger(__name__)
+
+
+class RuleDiscovery(object):
+    """Write-behind queue for the rules created from requests nothing matched yet.
+
+    The request only records what it saw and gets its blank response straight away. A background writer picks the
+    queue up every STORMCLOUD_DISCOVERY_INTERVAL seconds (or as soon as STORMCLOUD_DISCOVERY_BATCH_SIZE are waiting)
+    and bulk creates them, so first-run discovery against a large test suite doesn't serialize every request on the
+    database's write lock. Discoveries are deduplicated by the same (vendor, path, verb) key rules are looked up by.
+
+    With STORMCLOUD_DISCOVERY_TEMPLATES on, identifier-looking path segments (numbers, UUIDs, hex tokens) are replaced
+    with parameters before that, so an API with ids in its URLs is discovered as one pattern rule per endpoint rather
+    than one rule per id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._writer = None
+        self._stopping = False
+        self.pending = OrderedDict()  # (vendor_id, path, verb) -> Rule fields
+
+    def enqueue(self, vendor, hostname, path, verb):
+        """Returns whether this was a new discovery rather than one already waiting to be written."""
+        if getattr(settings, 'STORMCLOUD_DISCOVERY_TEMPLATES', False):
+            path = template_for(path)
+        key = (vendor.pk if vendor else None, path, verb)
+        with self._lock:
+            if key in self.pending:
+                return False
+            self.pending[key] = dict(vendor=vendor, hostname=hostname, path=path, verb=verb)
+            waiting = len(self.pending)
+
+        self._start_writer()
+        if waiting >= getattr(settings, 'STORMCLOUD_DISCOVERY_BATCH_SIZE', 500):
+            self._wake.set()
+        return True
+
+    def _start_writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='stormcloud-rule-discovery')
+                    self._writer.daemon = True
+                    self._writer.start()
+                    atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(getattr(settings, 'STORMCLOUD_DISCOVERY_INTERVAL', 1.0))
+            self._wake.clear()
+            if self._stopping:
+                break  # the exit flush writes what's left
+            try:
+                if self.flush():
+                    connection.close()  # don't hold this thread's connection open between batches
+            except Exception:
+                logger.exception("Writing discovered rules failed, they'll be tried again with the next batch")
+                connection.close()  # the next batch gets a new one, in case this one is what failed
+
+    def _flush_at_exit(self):
+        # stop the writer first, rather than leave it waiting while the interpreter tears down the modules it uses
+        self._stopping = True
+        self._wake.set()
+        self._writer.join(5)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Writing discovered rules at exit failed")
+
+    def get_or_create(self, rule):
+        """Creates a discovered rule unless its (vendor, path, verb) has one already, returns whether it did."""
+        return Rule.objects.get_or_create(vendor=rule.vendor, path=rule.path, verb=rule.verb, match_key='',
+                                          defaults={'hostname': rule.hostname})[1]
+
+    def flush(self):
+        """Writes everything waiting, returns how many rules were created. If the database fails them (locked, gone
+        away) they're put back to be written with the next batch, and the error raised."""
+        with self._lock:
+            batch, self.pending = self.pending, OrderedDict()
+        if not batch:
+            return 0
+        try:
+            created = self.write(batch)
+        except DatabaseError:
+            with self._lock:
+                for key, fields in self.pending.items():  # discovered since, after the ones put back
+                    batch.setdefault(key, fields)
+                self.pending = batch
+            raise
+        logger.info("Created %s discovered rules", created)
+        return created
+
+    def write(self, batch):
+        """Creates the rules for a batch of discoveries, returns how many it did."""
+        # another worker, or a rule created in the admin, may have got there first - rules that only match some
+        # parameter values don't count, the discovered rule is the fallback for everything else
+        existing = set(Rule.objects.filter(path__in=set(path for vendor_id, path, verb in batch), match_key='')
+                       .values_list('vendor_id', 'path', 'verb'))
+        new_rules = [Rule(**fields) for key, fields in batch.items() if key not in existing]
+        try:
+            with transaction.atomic():
+                Rule.objects.bulk_create(new_rules,
+                                         batch_size=getattr(settings, 'STORMCLOUD_DISCOVERY_BATCH_SIZE', 500))
+        except IntegrityError:  # lost a race for one of them to another worker, the unique index decides
+            new_rules = [rule for rule in new_rules if self.get_or_create(rule)]
+
+        # bulk_create sends no post_save, bring the rule table (and snapshot) up to date in one go
+        rule_table.refresh_rules(Rule.objects.filter(path__in=set(rule.path for rule in new_rules)))
+        snapshot = get_snapshot()
+        if snapshot is not None and new_rules:
+            snapshot.schedule_publish()
+        return len(new_rules)
+
+
+rule_discovery = RuleDiscovery()
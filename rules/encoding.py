@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+
+from rules.blobs import MIN_COMPRESS_SIZE
+from rules.live import STREAM_CHUNK_SIZE
+
+# offered in this order when a client accepts several equally
+PREFERENCE = ('br', 'gzip')
+
+
+def accepted_encodings(header):
+    """{coding: q} from an Accept-Encoding header, lowercased. A coding listed without a q value has q=1."""
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, parameters = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for parameter in parameters.split(';'):
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def ranked_encodings(header, available):
+    """The codings in available the client accepts, most wanted first (ties go by PREFERENCE)."""
+    accepted = accepted_encodings(header)
+    ranked = []
+    for position, coding in enumerate(PREFERENCE):
+        if coding in available:
+            q = accepted.get(coding, accepted.get('*', 0.0))
+            if q > 0:
+                ranked.append((-q, position, coding))
+    return [coding for _, _, coding in sorted(ranked)]
+
+
+def compressing(request):
+    return getattr(settings, 'STORMCLOUD_COMPRESS_RESPONSES', True) and 'HTTP_ACCEPT_ENCODING' in request.META
+
+
+def gzip_stream(response, chunks):
+    """A streaming response gzipping chunks as they're produced, so a body never has to be held compressed in full."""
+    streamed = StreamingHttpResponse(compress_sequence(chunks), status=response.status_code)
+    for name, value in response.items():
+        if name.lower() not in ('content-length', 'content-encoding'):
+            streamed[name] = value
+    streamed['Content-Encoding'] = 'gzip'
+    streamed._closable_objects.extend(response._closable_objects)  # e.g. the upstream connection
+    patch_vary_headers(streamed, ('Accept-Encoding',))
+    return streamed
+
+
+def body_response(request, content, body=None):
+    """A response with content, in whichever Content-Encoding the request accepts.
+
+    body is the ResponseBody content is unchanged from. Its gzip (and br) variants were compressed once when it was
+    stored, and are loaded with the rule table, so all that's left per request is picking one. Anything else -
+    substituted, filled in or live bodies - is gzipped as it's streamed out."""
+    if not compressing(request):
+        return HttpResponse(content)
+    accept = request.META['HTTP_ACCEPT_ENCODING']
+
+    if body is not None:
+        for coding in ranked_encodings(accept, PREFERENCE):
+            encoded = body.encoded(coding)
+            if encoded is not None:
+                response = HttpResponse(encoded)
+                response['Content-Encoding'] = coding
+                response['Content-Length'] = len(encoded)
+                patch_vary_headers(response, ('Accept-Encoding',))
+                return response
+
+    response = HttpResponse(content)
+    if len(response.content) < MIN_COMPRESS_SIZE:
+        return response
+    patch_vary_headers(response, ('Accept-Encoding',))
+    if body is None and ranked_encodings(accept, ('gzip',)):
+        content = response.content
+        return gzip_stream(response, (content[start:start + STREAM_CHUNK_SIZE]
+                                      for start in range(0, len(content), STREAM_CHUNK_SIZE)))
+    return response  # stored, but not in any coding the client accepts or none was smaller
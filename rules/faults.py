@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+from timeit import default_timer
+
+from django.http import StreamingHttpResponse
+
+# set in the WSGI environ by stormcloud.asgi, which then waits out a paced response's gaps on the event loop
+SERVER_PACES = 'stormcloud.server_paces'
+# where the middleware leaves the Pacer for a response the server paces
+PACER = 'stormcloud.pacer'
+
+# how many chunks a second a throttled response is sent in
+SENDS_PER_SECOND = 10
+
+
+class TruncatedResponse(Exception):
+    """Raised from a truncated response's body once it's been cut off. The server drops the connection, which is the
+    point: the client was promised Content-Length bytes and never gets them."""
+
+
+class Pacer(object):
+    """When each chunk of a paced response is due: bytes_per_second (None for no limit), with one extra pause of
+    stall_seconds once stall_at bytes have been sent."""
+
+    def __init__(self, bytes_per_second=None, stall_at=None, stall_seconds=0):
+        self.bytes_per_second = bytes_per_second
+        self.stall_at = stall_at
+        self.stall_seconds = stall_seconds
+        self.started = None
+        self.sent = 0
+
+    def wait(self, size):
+        """Seconds to wait before sending the next size bytes."""
+        now = default_timer()
+        if self.started is None:
+            self.started = now
+        due = self.started
+        if self.bytes_per_second:
+            due += self.sent / float(self.bytes_per_second)
+        if self.stall_at is not None and self.sent >= self.stall_at:
+            due += self.stall_seconds
+        self.sent += size
+        return max(due - now, 0.0)
+
+
+def paced_chunks(chunks, bytes_per_second=None, cut_at=(), truncate_at=None):
+    """Re-chunks a body so a throttled response goes out SENDS_PER_SECOND times a second and a chunk ends exactly at
+    each of the byte offsets in cut_at. Stops at truncate_at bytes (raising TruncatedResponse)."""
+    size = max(bytes_per_second // SENDS_PER_SECOND, 1) if bytes_per_second else None
+    offsets = [offset for offset in cut_at if offset] + ([truncate_at] if truncate_at is not None else [])
+    if truncate_at is not None and truncate_at <= 0:
+        raise TruncatedResponse("Response cut off before it started")
+    sent = 0
+    for chunk in chunks:
+        while chunk:
+            limit = min(len(chunk), size) if size else len(chunk)
+            upcoming = [offset for offset in offsets if offset > sent]
+            if upcoming:
+                limit = min(limit, min(upcoming) - sent)
+            piece, chunk = chunk[:limit], chunk[limit:]
+            yield piece
+            sent += len(piece)
+            if truncate_at is not None and sent >= truncate_at:
+                raise TruncatedResponse("Response cut off after %s bytes" % sent)
+
+
+def _sleeping(chunks, pacer):
+    for chunk in chunks:
+        wait = pacer.wait(len(chunk))
+        if wait:
+            time.sleep(wait)
+        yield chunk
+
+
+def paced_response(rule, request, chunks, length):
+    """A StreamingHttpResponse sending a rule's body (an iterable of byte chunks, length bytes in all) the way its
+    action asks:
+
+    - throttle: at throttle_bps bytes a second
+    - truncate: cut off after fault_after_bytes (half the body if blank), though Content-Length promises all of it
+    - stall: pause for stall_ms after fault_after_bytes (half the body if blank), then send the rest
+
+    throttle_bps applies to truncate and stall too. Under stormcloud.asgi the pauses are waited out on the event loop
+    between chunks. Under WSGI there's nothing else to do them with, so each paced response holds its worker thread."""
+    fault_at = rule.fault_after_bytes if rule.fault_after_bytes is not None else length // 2
+    truncate_at = fault_at if rule.action == 'truncate' else None
+    stall_at = fault_at if rule.action == 'stall' and rule.stall_ms else None
+
+    pacer = Pacer(rule.throttle_bps, stall_at, (rule.stall_ms or 0) / 1000.0)
+    content = paced_chunks(chunks, rule.throttle_bps, cut_at=[stall_at or 0], truncate_at=truncate_at)
+    if request.META.get(SERVER_PACES):
+        request.META[PACER] = pacer
+    else:
+        content = _sleeping(content, pacer)
+
+    response = StreamingHttpResponse(content)
+    response['Content-Length'] = length
+    return response
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import mimetypes
+import os
+import re
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+from rules.live import STREAM_CHUNK_SIZE
+
+BYTE_RANGE = re.compile(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', re.IGNORECASE)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def byte_range(header, size):
+    """The (start, stop) slice of a size byte body a Range header asks for, or None to send the whole body - no header,
+    or one we don't serve partially (multiple ranges, other units), which RFC 7233 allows ignoring. Raises
+    RangeNotSatisfiable if it asks for nothing but bytes past the end."""
+    match = BYTE_RANGE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:  # bytes=-500 is the last 500 bytes
+        if not last:
+            return None
+        if not int(last) or not size:
+            raise RangeNotSatisfiable()
+        return max(size - int(last), 0), size
+
+    start = int(first)
+    if last and int(last) < start:
+        return None  # invalid, so ignored
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last) + 1, size) if last else size
+
+
+def iter_file(f, start, stop, chunk_size=STREAM_CHUNK_SIZE):
+    """The bytes of an open file from start to stop, chunk by chunk. Closes the file once done."""
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+class BodyFileResponse(FileResponse):
+    block_size = STREAM_CHUNK_SIZE
+
+
+class ClosingFile(object):
+    """A response's file as handed to wsgi.file_wrapper, closing closer along with it. The server only ever closes the
+    file it was given, never the response, so anything else the response holds open (an in-flight place, see
+    rules.limits) has to be closed from here."""
+
+    def __init__(self, f, closer):
+        self.file = f
+        self.closer = closer
+
+    def __getattr__(self, name):  # read(), fileno() for sendfile, seek() and tell()
+        return getattr(self.file, name)
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.closer.close()
+
+
+def file_response(body_file, request, substituter=None):
+    """Serves a RuleResponse's body_file.
+
+    Sent untouched the file goes out as a FileResponse, so under a server with wsgi.file_wrapper (gunicorn, uWSGI) it's
+    copied to the socket by sendfile without passing through Python, and Range requests are answered with the requested
+    slice. With substitutions it's streamed through them instead, never read whole, and always sent in full (byte
+    offsets into a rewritten body mean nothing). Path parameters aren't filled into files, so a pattern rule like
+    /v1/reports/{report} keeps the sendfile path."""
+    path = body_file.path
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+
+    if substituter:
+        return StreamingHttpResponse(substituter.stream(iter_file(f, 0, size)), content_type=content_type)
+
+    try:
+        requested = byte_range(request.META.get('HTTP_RANGE'), size) if request.method in ('GET', 'HEAD') else None
+    except RangeNotSatisfiable:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % size
+        return response
+
+    if requested is None or requested == (0, size):
+        response = BodyFileResponse(f, content_type=content_type)
+        response['Content-Length'] = size
+    else:
+        start, stop = requested
+        response = StreamingHttpResponse(iter_file(f, start, stop), status=206, content_type=content_type)
+        response['Content-Length'] = stop - start
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, stop - 1, size)
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+from collections import defaultdict
+
+from rules.router import is_pattern
+
+# segment shapes that are identifiers rather than part of an API's structure, in the order they're tried
+IDENTIFIER_SHAPES = (
+    ('id', re.compile(r'^\d+$')),
+    ('uuid', re.compile(r'^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$')),
+    ('token', re.compile(r'^[0-9a-fA-F]{16,}$')),
+    ('id', re.compile(r'^[a-zA-Z]{1,8}_(?=[a-zA-Z]*\d)[a-zA-Z0-9]{8,}$')),  # prefixed object ids, e.g. ch_1Ab2Cd3Ef4
+)
+
+
+def _is_parameter(segment):
+    return segment.startswith('{') and segment.endswith('}')
+
+
+def _name_parameters(segments):
+    """Numbers repeated parameter names so each one captures separately, e.g. /{id}/items/{id} -> /{id}/items/{id2}."""
+    seen = defaultdict(int)
+    named = []
+    for segment in segments:
+        if _is_parameter(segment):
+            name = segment[1:-1].rstrip('0123456789')
+            seen[name] += 1
+            segment = '{%s%s}' % (name, seen[name] if seen[name] > 1 else '')
+        named.append(segment)
+    return named
+
+
+def template_for(path):
+    """The path with every segment shaped like an identifier (numbers, UUIDs, long hex tokens, prefixed ids) replaced
+    by a parameter. Returns the path unchanged if nothing in it looks like an identifier."""
+    if is_pattern(path):
+        return path
+
+    segments = []
+    for segment in path.split('/'):
+        for name, shape in IDENTIFIER_SHAPES:
+            if shape.match(segment):
+                segment = '{%s}' % name
+                break
+        segments.append(segment)
+    return '/'.join(_name_parameters(segments))
+
+
+def learn_templates(paths, threshold):
+    """Maps each path to a template, first by identifier shape (template_for) and then by cardinality: wherever at
+    least threshold paths differ only in one segment, that segment becomes a {param}. Paths that don't collapse map to
+    themselves."""
+    templates = dict((path, template_for(path).split('/')) for path in paths)
+
+    changed = True
+    while changed:
+        changed = False
+        siblings = defaultdict(set)
+        for segments in templates.values():
+            for index, segment in enumerate(segments):
+                if not _is_parameter(segment):
+                    siblings[(tuple(segments[:index]), index, tuple(segments[index + 1:]))].add(segment)
+
+        for path, segments in templates.items():
+            for index, segment in enumerate(segments):
+                if _is_parameter(segment):
+                    continue
+                if len(siblings[(tuple(segments[:index]), index, tuple(segments[index + 1:]))]) >= threshold:
+                    templates[path] = segments = segments[:index] + ['{param}'] + segments[index + 1:]
+                    changed = True
+
+    return dict((path, '/'.join(_name_parameters(segments))) for path, segments in templates.items())
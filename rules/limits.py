@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+SLOT = struct.Struct(str('<Qddq'))  # key, tokens, last refill (unix time), requests in flight
+# the kinds of things limited, the high bits of a slot's key
+RULE, VENDOR = 1, 2
+
+
+def limit_key(kind, pk):
+    return (kind << 48) | pk
+
+
+class LimitTable(object):
+    """Token buckets and in-flight counts for rules and vendors with limits, in one fixed size table of slots.
+
+    With STORMCLOUD_LIMITS_PATH set the table is a file every worker process on the host maps, so a limit holds across
+    all of them. A check locks just its own slot (lockf on the slot's bytes, plus a lock between this process' threads)
+    for a read and a write of shared memory, a few microseconds. Without a path each process limits on its own.
+
+    Slots are claimed by linear probing from the key and never given back, so STORMCLOUD_LIMIT_SLOTS needs to be more
+    than the number of limited rules and vendors. A worker killed mid-request leaves its requests counted in flight,
+    delete the file (with StormCloud stopped) to start over."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path = None
+        self._fd = None
+        self._map = None
+        self.offsets = {}  # key -> offset of its slot
+
+    @property
+    def slots(self):
+        return getattr(settings, 'STORMCLOUD_LIMIT_SLOTS', 4096)
+
+    def _open(self):
+        path = getattr(settings, 'STORMCLOUD_LIMITS_PATH', None)
+        if self._map is not None and path == self._path:
+            return
+        with self._lock:
+            if self._map is not None and path == self._path:
+                return
+            size = self.slots * SLOT.size
+            if path:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)  # new pages read as zeros, i.e. empty slots
+                self._map, self._fd = mmap.mmap(fd, size), fd
+            else:
+                self._map, self._fd = mmap.mmap(-1, size), None
+            self._path = path
+            self.offsets = {}
+
+    @contextmanager
+    def _locked(self, offset):
+        with self._lock:
+            if self._fd is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, SLOT.size, offset)
+            try:
+                yield
+            finally:
+                if self._fd is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, SLOT.size, offset)
+
+    def _offset(self, key):
+        offset = self.offsets.get(key)
+        if offset is not None:
+            return offset
+        for probe in range(self.slots):
+            offset = ((key + probe) % self.slots) * SLOT.size
+            with self._locked(offset):
+                slot_key = SLOT.unpack_from(self._map, offset)[0]
+                if slot_key == 0:
+                    SLOT.pack_into(self._map, offset, key, 0.0, 0.0, 0)
+                    slot_key = key
+            if slot_key == key:
+                self.offsets[key] = offset
+                return offset
+        logger.error("All %s rate limit slots are in use, raise STORMCLOUD_LIMIT_SLOTS", self.slots)
+        return None
+
+    @staticmethod
+    def _burst(rate, burst):
+        return float(burst or max(math.ceil(rate or 0), 1))
+
+    def acquire(self, key, rate=None, burst=None, max_in_flight=None):
+        """Takes a token and an in-flight place for a request. Returns (None, None) if it may go ahead, otherwise the
+        status to answer it with - 429 when it's over rate, 503 when too many are in flight - and seconds until it's
+        worth retrying."""
+        self._open()
+        offset = self._offset(key)
+        if offset is None:
+            return None, None
+        burst = self._burst(rate, burst)
+        with self._locked(offset):
+            _, tokens, updated, in_flight = SLOT.unpack_from(self._map, offset)
+            now = time.time()
+            if rate:
+                tokens = min(burst, tokens + (now - updated) * rate) if updated else burst
+                if tokens < 1:
+                    SLOT.pack_into(self._map, offset, key, tokens, now, in_flight)
+                    return 429, int(math.ceil((1 - tokens) / rate))
+            if max_in_flight and in_flight >= max_in_flight:
+                return 503, 1
+            SLOT.pack_into(self._map, offset, key, tokens - 1 if rate else tokens, now,
+                           in_flight + 1 if max_in_flight else in_flight)
+        return None, None
+
+    def release(self, key):
+        """Gives back the in-flight place taken by acquire()."""
+        offset = self.offsets.get(key)
+        if offset is None:
+            return
+        with self._locked(offset):
+            _, tokens, updated, in_flight = SLOT.unpack_from(self._map, offset)
+            SLOT.pack_into(self._map, offset, key, tokens, updated, max(in_flight - 1, 0))
+
+    def refund(self, key, rate=None, burst=None):
+        """Gives back the token taken by acquire(), for a request that was turned away after all."""
+        offset = self.offsets.get(key)
+        if offset is None or not rate:
+            return
+        with self._locked(offset):
+            _, tokens, updated, in_flight = SLOT.unpack_from(self._map, offset)
+            SLOT.pack_into(self._map, offset, key, min(self._burst(rate, burst), tokens + 1), updated, in_flight)
+
+    def clear(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            if self._fd is not None:
+                os.close(self._fd)
+            self._map = self._fd = self._path = None
+            self.offsets = {}
+
+
+limit_table = LimitTable()
+
+
+class InFlight(object):
+    """The in-flight places a request holds, given back when its response is closed (after the last byte is sent)."""
+
+    def __init__(self):
+        self.keys = []
+
+    def close(self):
+        keys, self.keys = self.keys, []
+        for key in keys:
+            limit_table.release(key)
+
+
+def check_limits(request, vendor, rule):
+    """Applies the rule's and then the vendor's rate_limit / max_in_flight to a request. Returns None if it's within
+    them, otherwise the 429 or 503 response to send instead. In-flight places taken are kept on
+    request.stormcloud_in_flight for the middleware to release.
+
+    A request one limit turns away doesn't count against the other: one over the rule's limit never gets as far as the
+    vendor's, and one over the vendor's gets the rule's token back."""
+    taken = []
+    for kind, limited in ((RULE, rule), (VENDOR, vendor)):
+        if limited is None or not (limited.rate_limit or limited.max_in_flight):
+            continue
+        key = limit_key(kind, limited.pk)
+        status, retry_after = limit_table.acquire(key, limited.rate_limit, limited.rate_burst, limited.max_in_flight)
+        if status is not None:
+            for earlier, earlier_key in taken:
+                limit_table.refund(earlier_key, earlier.rate_limit, earlier.rate_burst)
+            in_flight = getattr(request, 'stormcloud_in_flight', None)
+            if in_flight is not None:
+                in_flight.close()  # the rule's place, when it's the vendor that's over its limit
+            response = HttpResponse('', status=status)
+            response['Retry-After'] = retry_after
+            return response
+        taken.append((limited, key))
+        if limited.max_in_flight:
+            if not hasattr(request, 'stormcloud_in_flight'):
+                request.stormcloud_in_flight = InFlight()
+            request.stormcloud_in_flight.keys.append(key)
+    return None
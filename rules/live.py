@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from django.conf import settings
+from django.utils.six.moves import http_cookiejar
+from django.utils.six.moves.urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# headers that only describe a single connection, never forwarded by the streaming proxy
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection',
+                        'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'])
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _RejectCookies(http_cookiejar.DefaultCookiePolicy):
+    """Sessions are shared by every client of a live rule, so one client's upstream cookies mustn't leak to the next."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class SessionPool(object):
+    """Keep-alive requests sessions for live rules, one per upstream scheme + host and shared by every rule whose
+    live_url points there, so a pass-through reuses an open connection rather than paying a new TCP (and TLS)
+    handshake every time.
+
+    Sized and timed by STORMCLOUD_LIVE_POOL_SIZE, STORMCLOUD_LIVE_TIMEOUT and STORMCLOUD_LIVE_RETRIES."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sessions = {}
+
+    def session_for(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        session = self.sessions.get(key)
+        if session is None:
+            with self._lock:
+                session = self.sessions.get(key)
+                if session is None:
+                    session = self.sessions[key] = self.build_session()
+        return session
+
+    def build_session(self):
+        pool_size = getattr(settings, 'STORMCLOUD_LIVE_POOL_SIZE', 10)
+        retries = Retry(total=getattr(settings, 'STORMCLOUD_LIVE_RETRIES', 2), backoff_factor=0.1)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retries)
+
+        session = requests.Session()
+        session.cookies.set_policy(_RejectCookies())
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', getattr(settings, 'STORMCLOUD_LIVE_TIMEOUT', (3.05, 30)))
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def stream(self, method, url, headers=None, body=None):
+        """Opens an upstream request for the streaming proxy, leaving the response body unread and redirects to the
+        client. Only the client's own headers are sent, not the session's defaults (a requests User-Agent, Accept and
+        an Accept-Encoding whose gzip would then be passed back to a client that never asked for it)."""
+        sent = dict((name, None) for name in self.session_for(url).headers if name.lower() not in HOP_BY_HOP)
+        sent.update(headers or {})  # a None value drops the session's header
+        return self.request(method, url, headers=sent, data=body, stream=True, allow_redirects=False)
+
+    def close(self):
+        with self._lock:
+            sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            session.close()
+
+
+live_sessions = SessionPool()
+
+
+def request_headers(meta):
+    """The headers of an incoming request (from its META) to forward upstream."""
+    headers = {}
+    for key, value in meta.items():
+        if key.startswith('HTTP_'):
+            name = key[5:]
+        elif key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = key
+        else:
+            continue
+        name = name.replace('_', '-').title()
+        if value and name.lower() not in HOP_BY_HOP and name.lower() != 'host':  # Host comes from the live_url
+            headers[name] = '%s' % value  # the test client passes CONTENT_LENGTH as an int
+    return headers
+
+
+def response_headers(upstream):
+    """The headers of an upstream response to pass back to the client."""
+    return [(name, value) for name, value in upstream.headers.items() if name.lower() not in HOP_BY_HOP]
+
+
+class RequestBody(object):
+    """Streams an incoming request body upstream in chunks, with its length known up front so it's sent with a
+    Content-Length rather than chunked."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=STREAM_CHUNK_SIZE):
+        return self.stream.read(size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read()
+            if not chunk:
+                break
+            yield chunk
+
+
+def iter_upstream(upstream, chunk_size=STREAM_CHUNK_SIZE, decode_content=False):
+    """The upstream body in chunks, raw (still content-encoded) unless asked to decode it, releasing the connection back
+    to the pool once done."""
+    try:
+        for chunk in upstream.raw.stream(chunk_size, decode_content=decode_content):
+            yield chunk
+    finally:
+        upstream.close()
+
+
+def normalize_params(params):
+    """A hashable, order-independent form of GET/POST parameters (a QueryDict, a dict or None)."""
+    if not params:
+        return ()
+    if hasattr(params, 'lists'):
+        items = params.lists()
+    else:
+        items = ((key, value if isinstance(value, (list, tuple)) else [value]) for key, value in params.items())
+    return tuple(sorted((key, tuple(values)) for key, values in items))
+
+
+class _Pending(object):
+    """An upstream fetch in progress, that identical requests arriving meanwhile wait on instead of repeating."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LiveCache(object):
+    """TTL + LRU cache of upstream responses for a single live rule.
+
+    Entries past their TTL are still served while one background refresh runs, and concurrent misses for the same key
+    are coalesced into a single upstream request. fetch() returns (value, cacheable) so failed upstream responses are
+    passed along without being kept."""
+
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self._lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (value, expires), least recently used first
+        self.inflight = {}  # key -> _Pending
+
+    def _store(self, key, value):
+        with self._lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def _fetch(self, key, fetch, pending):
+        try:
+            value, cacheable = fetch()
+            if cacheable:
+                self._store(key, value)
+            pending.value = value
+        except Exception as e:
+            pending.error = e
+            logger.exception("Live fetch for %s failed", key[0])
+        finally:
+            with self._lock:
+                self.inflight.pop(key, None)
+            pending.done.set()
+
+    def get(self, key, fetch):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # most recently used
+                value, expires = entry
+                if expires <= time.time() and key not in self.inflight:  # stale, serve it and refresh behind it
+                    pending = self.inflight[key] = _Pending()
+                    refresh = threading.Thread(target=self._fetch, args=(key, fetch, pending))
+                    refresh.daemon = True
+                    refresh.start()
+                return value
+
+            pending = self.inflight.get(key)
+            leader = pending is None
+            if leader:
+                pending = self.inflight[key] = _Pending()
+
+        if leader:
+            self._fetch(key, fetch, pending)
+        else:
+            pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+        return pending.value
+
+
+class LiveCacheRegistry(object):
+    """The LiveCache for each rule that opted into caching with live_cache_ttl."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.caches = {}  # rule pk -> LiveCache
+
+    def for_rule(self, rule):
+        cache = self.caches.get(rule.pk)
+        if cache is None or cache.ttl != rule.live_cache_ttl or cache.size != rule.live_cache_size:
+            with self._lock:
+                cache = self.caches.get(rule.pk)
+                if cache is None or cache.ttl != rule.live_cache_ttl or cache.size != rule.live_cache_size:
+                    cache = self.caches[rule.pk] = LiveCache(rule.live_cache_ttl, rule.live_cache_size)
+        return cache
+
+    def discard(self, pk):
+        with self._lock:
+            self.caches.pop(pk, None)
+
+    def clear(self):
+        with self._lock:
+            self.caches = {}
+
+
+live_caches = LiveCacheRegistry()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from rules.benchmarks import compare, run_benchmarks
+from rules.discovery import rule_discovery
+from rules.live import live_sessions
+from rules.stats import rule_stats
+
+
+def _sizes(value):
+    try:
+        sizes = [int(size) for size in value.split(',') if size.strip()]
+    except ValueError:
+        sizes = None
+    if not sizes or any(size < 0 for size in sizes):
+        raise CommandError("Expected a comma separated list of sizes, got %r" % value)
+    return sizes
+
+
+class Command(BaseCommand):
+    help = ("Measures StormCloud's own overhead: drives StormCloudMiddleware through every action (flat, 301/302, "
+            "500, live and proxy against a local stub upstream, and unknown URLs) across rule table sizes, response "
+            "sizes and substitution counts, reporting requests/sec and p50/p99 latency. Runs against a throwaway test "
+            "database, and fails if any scenario regressed past the stored baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help='Timed requests per scenario. Default 1000.')
+        parser.add_argument('--table-sizes', default='100,10000', help='Rule table sizes. Default 100,10000.')
+        parser.add_argument('--response-sizes', default='1024,65536', help='Response sizes. Default 1024,65536.')
+        parser.add_argument('--substitutions', default='0,10', help='Substitution counts. Default 0,10.')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmark-baseline.json'),
+                            help='Baseline results to compare against. Default benchmark-baseline.json in the '
+                                 'project directory.')
+        parser.add_argument('--save-baseline', action='store_true', default=False,
+                            help='Store these results as the new baseline instead of comparing.')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='How much worse than the baseline a result may be, as a fraction. Default 0.25.')
+        parser.add_argument('--with-logging', action='store_true', default=False,
+                            help="Leave logging on. It's off by default, as console output would dominate.")
+
+    def report(self, name, result):
+        self.stdout.write("%-40s %9.0f req/s  p50 %8.3f ms  p99 %8.3f ms"
+                          % (name, result['rps'], result['p50_ms'], result['p99_ms']))
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError("--requests must be at least 1")
+        kwargs = dict(requests=options['requests'], table_sizes=_sizes(options['table_sizes']),
+                      response_sizes=_sizes(options['response_sizes']),
+                      substitution_counts=_sizes(options['substitutions']), report=self.report)
+
+        baseline = {}
+        if not options['save_baseline'] and os.path.exists(options['baseline']):
+            with io.open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        if not options['with_logging']:
+            logging.disable(logging.CRITICAL)
+        try:
+            results = run_benchmarks(**kwargs)
+        finally:
+            logging.disable(logging.NOTSET)
+            rule_discovery.flush()  # nothing may be left to write once the database is gone
+            rule_stats.flush()
+            live_sessions.close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save_baseline']:
+            with io.open(options['baseline'], 'w', encoding='utf-8') as f:
+                f.write('%s\n' % json.dumps(results, indent=2, sort_keys=True))
+            self.stdout.write("Saved %s scenarios as the baseline in %s" % (len(results), options['baseline']))
+            return
+
+        if not baseline:
+            self.stdout.write("No baseline at %s to compare against, store one with --save-baseline."
+                              % options['baseline'])
+            return
+
+        regressions = compare(results, baseline, options['tolerance'])
+        if regressions:
+            raise CommandError("%s regressions past the baseline:\n  %s" % (len(regressions), '\n  '.join(regressions)))
+        self.stdout.write("No regressions past the baseline (tolerance %s%%)." % int(options['tolerance'] * 100))
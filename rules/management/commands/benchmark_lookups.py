@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from rules.models import Rule
+from rules.table import RuleTable
+from vendors.models import Vendor
+
+
+class Command(BaseCommand):
+    help = ("Times rule lookups among --rules generated rules: in the compiled rule table the middleware uses, and as "
+            "the indexed database query refreshes and discovery make. Everything is created in a transaction that is "
+            "rolled back afterwards.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=100000, help='Rules to generate. Default 100000.')
+        parser.add_argument('--lookups', type=int, default=10000, help='Lookups to time for each kind. Default 10000.')
+
+    def report(self, label, seconds, count):
+        self.stdout.write("%-28s %10.2f us/lookup  (%s in %.3fs)" % (label, seconds / count * 1e6, count, seconds))
+
+    def handle(self, *args, **options):
+        if options['rules'] < 1 or options['lookups'] < 1:
+            raise CommandError("--rules and --lookups must be at least 1")
+
+        with transaction.atomic():
+            self.benchmark(options['rules'], options['lookups'])
+            transaction.set_rollback(True)
+
+    def benchmark(self, rule_count, lookups):
+        vendor = Vendor.objects.create(name='StormCloud benchmark', base_url='benchmark.invalid')
+        started = default_timer()
+        Rule.objects.bulk_create((Rule(vendor=vendor, hostname='benchmark.invalid', path='/benchmark/%s/item' % i,
+                                       verb='GET', action='200') for i in range(rule_count)), batch_size=500)
+        self.stdout.write("Created %s rules in %.2fs" % (rule_count, default_timer() - started))
+
+        paths = ['/benchmark/%s/item' % random.randrange(rule_count) for _ in range(lookups)]
+        missing = ['/benchmark/%s/missing' % random.randrange(rule_count) for _ in range(lookups)]
+
+        with override_settings(STORMCLOUD_SNAPSHOT_PATH=None):  # time this table, not a shared snapshot
+            table = RuleTable()
+            started = default_timer()
+            table.load()
+            self.stdout.write("Compiled rule table in %.2fs" % (default_timer() - started))
+
+            started = default_timer()
+            for path in paths:
+                table.match(vendor, path, 'GET')
+            self.report('rule table, hit', default_timer() - started, lookups)
+
+            started = default_timer()
+            for path in missing:
+                table.match(vendor, path, 'GET')
+            self.report('rule table, miss', default_timer() - started, lookups)
+
+        query = Rule.objects.filter(vendor=vendor, verb='GET', match_key='')
+        started = default_timer()
+        for path in paths:
+            list(query.filter(path=path))
+        self.report('database, hit', default_timer() - started, lookups)
+
+        if connection.vendor == 'sqlite':
+            sql, params = query.filter(path=paths[0]).query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                for row in cursor.fetchall():
+                    self.stdout.write("  query plan: %s" % row[-1])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from rules.learning import learn_templates
+from rules.models import Rule
+from rules.router import is_pattern
+
+
+class Command(BaseCommand):
+    help = ("Collapses discovered rules that differ only in ids (numbers, UUIDs, hex tokens, or any segment with at "
+            "least --threshold distinct values) into one pattern rule each. Only rules that were never configured - no "
+            "action, responses or substitutions - are touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=int, default=10,
+                            help='Distinct values a path segment needs among otherwise identical paths to be treated '
+                                 'as a parameter, on top of the id shapes that always are. Default 10.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report what would be compacted.')
+
+    def handle(self, *args, **options):
+        if options['threshold'] < 2:
+            raise CommandError("--threshold must be at least 2")
+
+        candidates = defaultdict(list)  # (vendor_id, verb) -> unconfigured exact rules
+        unconfigured = (Rule.objects.filter(action='', match_params='')
+                        .annotate(response_count=Count('responses', distinct=True),
+                                  substitution_count=Count('substitutions', distinct=True))
+                        .filter(response_count=0, substitution_count=0))
+        for rule in unconfigured.order_by('pk'):
+            if not is_pattern(rule.path):
+                candidates[(rule.vendor_id, rule.verb)].append(rule)
+
+        created = removed = 0
+        with transaction.atomic():
+            for (vendor_id, verb), rules in sorted(candidates.items(), key=lambda item: (item[0][0] or 0, item[0][1])):
+                templates = learn_templates(set(rule.path for rule in rules), options['threshold'])
+
+                groups = defaultdict(list)
+                for rule in rules:
+                    if templates[rule.path] != rule.path:
+                        groups[templates[rule.path]].append(rule)
+
+                for template, members in sorted(groups.items()):
+                    self.stdout.write("%s %s <- %s rules" % (verb, template, len(members)))
+                    if options['dry_run']:
+                        continue
+
+                    template_rule, was_created = Rule.objects.get_or_create(
+                        vendor_id=vendor_id, path=template, verb=verb, match_key='',
+                        defaults={'hostname': members[0].hostname})
+                    Rule.objects.filter(pk__in=[rule.pk for rule in members]).delete()
+                    created += was_created
+                    removed += len(members)
+
+        if options['dry_run']:
+            self.stdout.write("Dry run, nothing was changed.")
+        else:
+            self.stdout.write("Removed %s rules in favor of %s new pattern rules." % (removed, created))
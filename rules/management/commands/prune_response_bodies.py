@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from rules.models import ResponseBody
+
+
+class Command(BaseCommand):
+    help = ("Deletes stored response bodies no response uses any more, left behind when responses are edited or "
+            "deleted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report what would be deleted.')
+
+    def handle(self, *args, **options):
+        unused = ResponseBody.objects.filter(responses=None)
+        totals = unused.aggregate(stored=Sum('size'))
+        count = unused.count()
+        if not options['dry_run']:
+            unused.delete()
+
+        self.stdout.write("%s %s unused bodies (%s bytes uncompressed)." % (
+            'Would delete' if options['dry_run'] else 'Deleted', count, totals['stored'] or 0))
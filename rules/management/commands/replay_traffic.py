@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rules.capture import read_capture
+from rules.replay import Replay
+
+
+class Command(BaseCommand):
+    help = ("Replays traffic recorded with STORMCLOUD_CAPTURE_PATH against a StormCloud instance, at the original pace "
+            "or scaled, and reports throughput and latency per rule, slowest first.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('capture', help='Capture file to replay.')
+        parser.add_argument('--target', default='http://127.0.0.1:8000',
+                            help='StormCloud to send the requests to. Default http://127.0.0.1:8000.')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='How much faster than recorded to go, e.g. 2 for twice the rate. 0 for as fast as '
+                                 'the workers allow. Default 1.')
+        parser.add_argument('--concurrency', type=int, default=10, help='Requests in flight at once. Default 10.')
+        parser.add_argument('--timeout', type=float, default=30, help='Per request timeout in seconds. Default 30.')
+        parser.add_argument('--json', action='store_true', default=False, help='Print the report as JSON.')
+
+    def handle(self, *args, **options):
+        if options['speed'] < 0 or options['concurrency'] < 1:
+            raise CommandError("--speed can't be negative and --concurrency must be at least 1")
+        try:
+            records = read_capture(options['capture'])
+        except (IOError, ValueError, KeyError) as e:
+            raise CommandError("Couldn't read capture %s: %s" % (options['capture'], e))
+
+        report = Replay(records, options['target'], speed=options['speed'], concurrency=options['concurrency'],
+                        timeout=options['timeout']).run()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write("%s requests in %.2fs, %.1f req/s, %s errors, sent up to %.1f ms late"
+                          % (report['requests'], report['elapsed_s'], report['rps'], report['errors'],
+                             report['max_lag_ms']))
+        for label, rule in sorted(report['rules'].items(), key=lambda item: item[1]['p99_ms'], reverse=True):
+            self.stdout.write("%-40s %7s req %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms  %s errors"
+                              % (label, rule['requests'], rule['rps'], rule['p50_ms'], rule['p99_ms'], rule['max_ms'],
+                                 rule['errors']))
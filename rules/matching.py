@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.core.exceptions import RequestDataTooBig
+from django.utils.six import string_types
+from django.utils.six.moves.urllib.parse import parse_qsl
+
+
+def parse_match_params(match_params):
+    """A rule's match_params (query string form, e.g. operation=GetQuote&currency=USD) as sorted (name, value) pairs.
+    A name given twice keeps its last value."""
+    return sorted(dict(parse_qsl(match_params or '', keep_blank_values=True)).items())
+
+
+def match_key_for(pairs):
+    """The hashed, canonical form of a set of (name, value) pairs - what's stored in Rule.match_key and probed for."""
+    if not pairs:
+        return ''
+    canonical = json.dumps(sorted(pairs), separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _json_value(value):
+    if isinstance(value, string_types):
+        return value
+    if isinstance(value, (dict, list)):
+        return None  # only scalars can be matched
+    return json.dumps(value)  # true, 3, 1.5, null
+
+
+class RequestParameters(object):
+    """The parameters of a request that rules can match on: query string, form fields and the fields of a JSON body
+    (nested ones by dotted name, e.g. order.type), looked up in that order. Nothing is parsed until a rule asks.
+
+    Only then is the body read, and in full, so it can still be streamed upstream or handed to Django afterwards. A body
+    over DATA_UPLOAD_MAX_MEMORY_SIZE is left unread and has no fields to match."""
+
+    def __init__(self, request):
+        self.request = request
+        self._json = None
+
+    def body(self):
+        try:
+            return self.request.body
+        except RequestDataTooBig:
+            return None
+
+    def json_body(self):
+        if self._json is None:
+            self._json = {}
+            content_type = self.request.META.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+            if content_type == 'application/json' or content_type.endswith('+json'):
+                try:
+                    self._json = json.loads((self.body() or b'').decode('utf-8'))
+                except ValueError:
+                    pass
+        return self._json
+
+    def get(self, name):
+        """The request's value for a parameter, or None if it doesn't have one."""
+        if name in self.request.GET:
+            return self.request.GET[name]
+        if self.body() is not None and name in self.request.POST:
+            return self.request.POST[name]
+
+        value = self.json_body()
+        for part in name.split('.'):
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+            elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+                value = value[int(part)]
+            else:
+                return None
+        return _json_value(value)
+
+    def match_key(self, names):
+        """The match key for this request's values of the given parameters, None if it's missing any of them."""
+        pairs = []
+        for name in names:
+            value = self.get(name)
+            if value is None:
+                return None
+            pairs.append((name, value))
+        return match_key_for(pairs)
+
+
+class ParameterIndex(object):
+    """The rules sharing a vendor, path and verb, indexed by match_key.
+
+    Matching hashes the request's values for each distinct set of parameter names the rules match on - most names
+    first - and probes for that key, so the cost depends on how many different sets there are rather than how many
+    rules. Rules without match_params are the fallback when no set matches. Entries are (rule, extra) pairs and are
+    returned as given."""
+
+    def __init__(self, entries):
+        self.fields = []  # distinct tuples of parameter names, most names first
+        self.entries = {}  # match_key -> [(rule, extra), ...] - more than one is a configuration error
+        for entry in entries:
+            fields = tuple(name for name, value in entry[0].get_match_params())
+            if fields and fields not in self.fields:
+                self.fields.append(fields)
+            self.entries.setdefault(entry[0].match_key, []).append(entry)
+        self.fields.sort(key=len, reverse=True)
+
+    def match(self, parameters=None):
+        if parameters is not None:
+            for fields in self.fields:
+                key = parameters.match_key(fields)
+                if key is not None and key in self.entries:
+                    return self.entries[key]
+        return self.entries.get('', [])
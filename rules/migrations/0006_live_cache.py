@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0005_auto_20171225_0025'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='live_cache_size',
+            field=models.PositiveIntegerField(default=128, help_text='Most live responses kept for this rule when caching.'),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='live_cache_ttl',
+            field=models.PositiveIntegerField(blank=True, help_text='Reuse live responses for this many seconds (per URL, verb and parameters). Expired responses are still served while they are refreshed in the background. Blank to always fetch.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='rule',
+            name='action',
+            field=models.CharField(blank=True, choices=[('flat', 'Respond with Configured Response (chooses randomly from active if multiple available)'), ('301', 'Respond with a 301 permanent redirect (store URL(s) as Responses to be randomly chosen from)'), ('302', 'Respond with a 302 temporary redirect (store URL(s) as Responses to be randomly chosen from)'), ('500', 'Respond with an internal server error'), ('live', 'Retrieve live URL')], default='', max_length=64),
+        ),
+    ]
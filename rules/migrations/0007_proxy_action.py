@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:44
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0006_live_cache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rule',
+            name='action',
+            field=models.CharField(blank=True, choices=[('flat', 'Respond with Configured Response (chooses randomly from active if multiple available)'), ('301', 'Respond with a 301 permanent redirect (store URL(s) as Responses to be randomly chosen from)'), ('302', 'Respond with a 302 temporary redirect (store URL(s) as Responses to be randomly chosen from)'), ('500', 'Respond with an internal server error'), ('live', 'Retrieve live URL'), ('proxy', 'Stream live URL (any verb, passes request and response headers, body and status through)')], default='', max_length=64),
+        ),
+    ]
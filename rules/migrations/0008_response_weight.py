@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0007_proxy_action'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ruleresponse',
+            name='weight',
+            field=models.PositiveIntegerField(default=1, help_text='How often this response is chosen relative to the other active responses. 0 to never choose it while any others have a weight.'),
+        ),
+    ]
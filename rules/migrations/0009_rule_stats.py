@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0008_response_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RuleStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+                ('action_counts', models.TextField(default='{}', help_text='JSON object of how often each action was taken.')),
+                ('latency_histogram', models.TextField(default='[]', help_text='JSON list of request counts per latency bucket.')),
+                ('latency_p50_ms', models.FloatField(blank=True, null=True)),
+                ('latency_p99_ms', models.FloatField(blank=True, null=True)),
+                ('rule', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='rules.Rule')),
+            ],
+            options={
+                'verbose_name_plural': 'rule stats',
+            },
+        ),
+    ]
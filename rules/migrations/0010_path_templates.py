@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0009_rule_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rule',
+            name='path',
+            field=models.CharField(blank=True, default='', help_text='Matched exactly, unless it is a template: {name} matches any one segment and makes it available to responses and substitutions as {{name}}, * matches any one segment and a final ** the rest of the path. Exact rules take priority.', max_length=256),
+        ),
+    ]
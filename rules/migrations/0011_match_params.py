@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0010_path_templates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='match_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='Hash of match_params, set on save.', max_length=40),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='match_params',
+            field=models.CharField(blank=True, default='', help_text='Only match requests with these parameter values, in query string form (e.g. operation=GetQuote&currency=USD). Looked for in the query string, form fields and JSON body (nested fields as order.type). The rule with the most matching parameters wins, rules without any are the fallback.', max_length=512),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:56
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+def remove_duplicate_rules(apps, schema_editor):
+    """Keeps one rule per (vendor, path, verb, match_key) - the oldest one with an action if there is one, otherwise the
+    oldest. The rest could never be served, every request matching them failed. Rules without a vendor count as
+    duplicates too, though the unique index can't see them (rules.signals adds a partial index for those)."""
+    Rule = apps.get_model('rules', 'Rule')
+    kept = {}
+    duplicates = []
+    for rule in Rule.objects.order_by('pk').values('pk', 'vendor_id', 'path', 'verb', 'match_key', 'action'):
+        key = (rule['vendor_id'], rule['path'], rule['verb'], rule['match_key'])
+        first = kept.get(key)
+        if first is None:
+            kept[key] = rule
+        elif rule['action'] and not first['action']:
+            duplicates.append(first['pk'])
+            kept[key] = rule
+        else:
+            duplicates.append(rule['pk'])
+
+    for start in range(0, len(duplicates), 500):
+        Rule.objects.filter(pk__in=duplicates[start:start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendors', '0002_base_url_prefix'),
+        ('rules', '0011_match_params'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_rules, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='rule',
+            unique_together=set([('path', 'verb', 'vendor', 'match_key')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='ruleresponse',
+            index_together=set([('rule', 'active')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='rulesubstitution',
+            index_together=set([('rule', 'active')]),
+        ),
+    ]
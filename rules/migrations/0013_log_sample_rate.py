@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0012_rule_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='log_sample_rate',
+            field=models.FloatField(blank=True, help_text="Fraction of requests to this rule to log (0 to 1). Blank to use the vendor's rate.", null=True, validators=[django.core.validators.MinValueValidator(0.0), django.core.validators.MaxValueValidator(1.0)]),
+        ),
+    ]
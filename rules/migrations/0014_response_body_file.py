@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0013_log_sample_rate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ruleresponse',
+            name='body_file',
+            field=models.FileField(blank=True, help_text='Serve this file as the body instead of the response text, for large payloads. Sent as stored (with Range support) unless the rule has substitutions. Path parameters are not filled in.', upload_to='responses/'),
+        ),
+    ]
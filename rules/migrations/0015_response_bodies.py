@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:15
+from __future__ import unicode_literals
+
+import hashlib
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# rules.blobs as it was when this migration was written, so that later changes to it (or to settings) can't change
+# what the migration does
+MIN_COMPRESS_SIZE = 256
+
+
+def body_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def compress(data):
+    if len(data) < MIN_COMPRESS_SIZE:
+        return '', data
+    compressed = zlib.compress(data, 9)
+    if len(compressed) >= len(data):
+        return '', data
+    return 'zlib', compressed
+
+
+def decompress(encoding, data):
+    data = bytes(data)
+    if not encoding:
+        return data
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    if encoding == 'zstd':
+        import zstandard  # only bodies stored with STORMCLOUD_BODY_COMPRESSION = 'zstd' need it
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown response body encoding %r" % encoding)
+
+
+def move_responses_to_bodies(apps, schema_editor):
+    """Moves each response's text into the shared body store, one stored body per distinct text."""
+    ResponseBody = apps.get_model('rules', 'ResponseBody')
+    RuleResponse = apps.get_model('rules', 'RuleResponse')
+    stored = set(ResponseBody.objects.values_list('digest', flat=True))
+    for response in RuleResponse.objects.exclude(response__isnull=True).exclude(response='').iterator():
+        data = response.response.encode('utf-8')
+        digest = body_digest(data)
+        if digest not in stored:
+            encoding, compressed = compress(data)
+            ResponseBody.objects.create(digest=digest, encoding=encoding, size=len(data), data=compressed)
+            stored.add(digest)
+        RuleResponse.objects.filter(pk=response.pk).update(body=digest)
+
+
+def restore_responses(apps, schema_editor):
+    ResponseBody = apps.get_model('rules', 'ResponseBody')
+    RuleResponse = apps.get_model('rules', 'RuleResponse')
+    for body in ResponseBody.objects.iterator():
+        text = decompress(body.encoding, body.data).decode('utf-8')
+        RuleResponse.objects.filter(body=body.digest).update(response=text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0014_response_body_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseBody',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('encoding', models.CharField(blank=True, max_length=8)),
+                ('size', models.PositiveIntegerField(help_text='Length of the body in bytes, uncompressed.')),
+                ('data', models.BinaryField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ruleresponse',
+            name='body',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='responses', to='rules.ResponseBody'),
+        ),
+        migrations.RunPython(move_responses_to_bodies, restore_responses),
+        migrations.RemoveField(
+            model_name='ruleresponse',
+            name='response',
+        ),
+    ]
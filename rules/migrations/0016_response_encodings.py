@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:17
+from __future__ import unicode_literals
+
+import gzip
+import io
+import zlib
+
+from django.db import migrations, models
+
+# rules.blobs as it was when this migration was written, so that later changes to it can't change what the migration
+# does
+MIN_COMPRESS_SIZE = 256
+
+
+def gzip_bytes(data):
+    buffer = io.BytesIO()
+    with gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buffer, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def content_encodings(data):
+    if len(data) < MIN_COMPRESS_SIZE:
+        return {}
+    variants = {'gzip': gzip_bytes(data)}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        variants['br'] = brotli.compress(data)
+    return dict((encoding, encoded) for encoding, encoded in variants.items() if len(encoded) < len(data))
+
+
+def decompress(encoding, data):
+    data = bytes(data)
+    if not encoding:
+        return data
+    if encoding == 'zlib':
+        return zlib.decompress(data)
+    if encoding == 'zstd':
+        import zstandard  # only bodies stored with STORMCLOUD_BODY_COMPRESSION = 'zstd' need it
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError("Unknown response body encoding %r" % encoding)
+
+
+def encode_stored_bodies(apps, schema_editor):
+    ResponseBody = apps.get_model('rules', 'ResponseBody')
+    for body in ResponseBody.objects.iterator():
+        variants = content_encodings(decompress(body.encoding, body.data))
+        if variants:
+            ResponseBody.objects.filter(pk=body.pk).update(gzip=variants.get('gzip'), br=variants.get('br'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0015_response_bodies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='responsebody',
+            name='br',
+            field=models.BinaryField(help_text='The body brotli compressed, if brotli was installed when stored.', null=True),
+        ),
+        migrations.AddField(
+            model_name='responsebody',
+            name='gzip',
+            field=models.BinaryField(help_text='The body gzipped, for clients that accept it.', null=True),
+        ),
+        migrations.RunPython(encode_stored_bodies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rules', '0016_response_encodings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='fault_after_bytes',
+            field=models.PositiveIntegerField(blank=True, help_text='Where the truncate and stall actions cut the response off or stall it. Blank for halfway.', null=True),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='stall_ms',
+            field=models.PositiveIntegerField(blank=True, help_text='How long the stall action stops sending for.', null=True),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='throttle_bps',
+            field=models.PositiveIntegerField(blank=True, help_text='Bytes per second to send the response at, for the throttle, truncate and stall actions. Blank for as fast as possible.', null=True),
+        ),
+        migrations.AlterField(
+            model_name='rule',
+            name='action',
+            field=models.CharField(blank=True, choices=[('flat', 'Respond with Configured Response (chooses randomly from active if multiple available)'), ('301', 'Respond with a 301 permanent redirect (store URL(s) as Responses to be randomly chosen from)'), ('302', 'Respond with a 302 temporary redirect (store URL(s) as Responses to be randomly chosen from)'), ('500', 'Respond with an internal server error'), ('live', 'Retrieve live URL'), ('proxy', 'Stream live URL (any verb, passes request and response headers, body and status through)'), ('throttle', 'Respond with Configured Response, sent at throttle_bps bytes per second'), ('truncate', 'Respond with Configured Response, but cut the connection after fault_after_bytes'), ('stall', 'Respond with Configured Response, stalling for stall_ms after fault_after_bytes')], default='', max_length=64),
+        ),
+    ]
@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import random
-import requests
+import json
 
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 
+from rules.blobs import body_cache, body_digest, compress, content_encodings, decompress
+from rules.live import live_caches, live_sessions, normalize_params
+from rules.matching import match_key_for, parse_match_params
+from rules.router import fill_parameters
+from rules.selection import AliasTable, get_random
+from rules.substitution import Substituter
 from vendors.models import Vendor
 
 ACTION_CHOICES = (
@@ -13,71 +19,277 @@ ACTION_CHOICES = (
     ('301', 'Respond with a 301 permanent redirect (store URL(s) as Responses to be randomly chosen from)'),
     ('302', 'Respond with a 302 temporary redirect (store URL(s) as Responses to be randomly chosen from)'),
     ('500', 'Respond with an internal server error'),
-    ('live', 'Retrieve live URL')
+    ('live', 'Retrieve live URL'),
+    ('proxy', 'Stream live URL (any verb, passes request and response headers, body and status through)'),
+    ('throttle', 'Respond with Configured Response, sent at throttle_bps bytes per second'),
+    ('truncate', 'Respond with Configured Response, but cut the connection after fault_after_bytes'),
+    ('stall', 'Respond with Configured Response, stalling for stall_ms after fault_after_bytes'),
 )
 
+# actions sending a configured response paced or cut short, see rules.faults
+PACED_ACTIONS = ('throttle', 'truncate', 'stall')
+
+
+class RuleQuerySet(models.QuerySet):
+    def compiled(self):
+        """Rules with their vendor and only their active responses (with their bodies) and substitutions preloaded, as
+        the middleware needs them. The preloaded lists are picked up by get_active_responses() /
+        get_active_substitutions()."""
+        return self.select_related('vendor').prefetch_related(
+            models.Prefetch('responses', queryset=RuleResponse.objects.filter(active=True).select_related('body')
+                            .order_by('pk'), to_attr='active_responses'),
+            models.Prefetch('substitutions', queryset=RuleSubstitution.objects.filter(active=True).order_by('pk'),
+                            to_attr='active_substitutions'),
+        )
+
 
 class Rule(models.Model):
     vendor = models.ForeignKey(Vendor, null=True, blank=True)
     hostname = models.CharField(max_length=64, null=False, blank=True, default='')
-    path = models.CharField(max_length=256, null=False, blank=True, default='')
+    path = models.CharField(max_length=256, null=False, blank=True, default='',
+                            help_text=u'Matched exactly, unless it is a template: {name} matches any one segment and '
+                                      u'makes it available to responses and substitutions as {{name}}, * matches any '
+                                      u'one segment and a final ** the rest of the path. Exact rules take priority.')
     verb = models.CharField(max_length=32, null=False, blank=False, default='GET')
+    match_params = models.CharField(max_length=512, null=False, blank=True, default='',
+                                    help_text=u'Only match requests with these parameter values, in query string form '
+                                              u'(e.g. operation=GetQuote&currency=USD). Looked for in the query string, '
+                                              u'form fields and JSON body (nested fields as order.type). The rule with '
+                                              u'the most matching parameters wins, rules without any are the fallback.')
+    match_key = models.CharField(max_length=40, null=False, blank=True, default='', editable=False, db_index=True,
+                                 help_text=u'Hash of match_params, set on save.')
     action = models.CharField(max_length=64, null=False, blank=True, default='', choices=ACTION_CHOICES)
     delay_ms = models.PositiveIntegerField(null=True, blank=True,
                                            help_text=u'The response will be delayed by this much time, useful for '
                                                      u'simulating slow connections or causing timeouts.')
+    throttle_bps = models.PositiveIntegerField(null=True, blank=True,
+                                               help_text=u'Bytes per second to send the response at, for the throttle, '
+                                                         u'truncate and stall actions. Blank for as fast as possible.')
+    fault_after_bytes = models.PositiveIntegerField(null=True, blank=True,
+                                                    help_text=u'Where the truncate and stall actions cut the response '
+                                                              u'off or stall it. Blank for halfway.')
+    stall_ms = models.PositiveIntegerField(null=True, blank=True,
+                                           help_text=u'How long the stall action stops sending for.')
     live_url = models.URLField(null=True, blank=True, help_text=u'Used if a live URL should be retrieved.')
+    live_cache_ttl = models.PositiveIntegerField(null=True, blank=True,
+                                                 help_text=u'Reuse live responses for this many seconds (per URL, verb '
+                                                           u'and parameters). Expired responses are still served while '
+                                                           u'they are refreshed in the background. Blank to always '
+                                                           u'fetch.')
+    live_cache_size = models.PositiveIntegerField(default=128,
+                                                  help_text=u'Most live responses kept for this rule when caching.')
+    log_sample_rate = models.FloatField(null=True, blank=True,
+                                        validators=[MinValueValidator(0.0), MaxValueValidator(1.0)],
+                                        help_text=u'Fraction of requests to this rule to log (0 to 1). Blank to use '
+                                                  u"the vendor's rate.")
+    rate_limit = models.FloatField(null=True, blank=True, validators=[MinValueValidator(0.0)],
+                                   help_text=u'Requests per second this rule answers, across all workers. Requests '
+                                             u'over it get a 429 with Retry-After. Blank for no limit.')
+    rate_burst = models.PositiveIntegerField(null=True, blank=True,
+                                             help_text=u'Requests let through at once before rate_limit applies. '
+                                                       u'Blank for one second of rate_limit.')
+    max_in_flight = models.PositiveIntegerField(null=True, blank=True,
+                                                help_text=u'Most requests to this rule being answered at once, across '
+                                                          u'all workers. Requests over it get a 503. Blank for no '
+                                                          u'limit.')
+
+    objects = RuleQuerySet.as_manager()
+
+    class Meta:
+        # what the middleware looks rules up by - a second rule here would make every matching request fail. Rules
+        # without a vendor are covered by a partial index, added after every migrate by
+        # rules.signals.ensure_unique_without_vendor.
+        unique_together = (('path', 'verb', 'vendor', 'match_key'),)
 
     def __unicode__(self):
         return self.path
 
+    def save(self, *args, **kwargs):
+        self.match_key = match_key_for(self.get_match_params())
+        super(Rule, self).save(*args, **kwargs)
+
+    def get_match_params(self):
+        return parse_match_params(self.match_params)
+
+    def get_active_responses(self):
+        if hasattr(self, 'active_responses'):  # preloaded by Rule.objects.compiled()
+            return self.active_responses
+        return list(self.responses.filter(active=True).order_by('pk'))
+
+    def get_active_substitutions(self):
+        if hasattr(self, 'active_substitutions'):  # preloaded by Rule.objects.compiled()
+            return self.active_substitutions
+        return list(self.substitutions.filter(active=True).order_by('pk'))
+
+    def get_substituter(self):
+        """The active substitutions compiled into one matcher. Cached on rules with preloaded substitutions (the ones
+        in the compiled rule table), which are replaced wholesale whenever one of their substitutions changes."""
+        substituter = getattr(self, '_substituter', None)
+        if substituter is None:
+            substituter = Substituter((s.find, s.replace) for s in self.get_active_substitutions())
+            if hasattr(self, 'active_substitutions'):
+                self._substituter = substituter
+        return substituter
+
     def perform_substitutions(self, content):
-        for substitute in self.substitutions.filter(active=True):
-            content = content.replace(substitute.find, substitute.replace)
+        return self.get_substituter()(content)
+
+    def get_alias_table(self):
+        """Weighted sampling table over the active responses, cached like get_substituter()."""
+        table = getattr(self, '_alias_table', None)
+        if table is None:
+            table = AliasTable([r.weight for r in self.get_active_responses()])
+            if hasattr(self, 'active_responses'):
+                self._alias_table = table
+        return table
+
+    def choose_response(self):
+        """One of the active responses picked at random by weight, or None if there aren't any."""
+        active_responses = self.get_active_responses()
+        if len(active_responses) > 1:
+            return active_responses[self.get_alias_table().sample(get_random())]
+        if active_responses:  # only one response, return it
+            return active_responses[0]
 
-        return content
+    def render_content(self, content, params=None):
+        """content with substitutions made and {{name}} filled in from the path parameters."""
+        return fill_parameters(self.perform_substitutions(content), params)
+
+    def render_response(self, chosen, params=None):
+        """The chosen response's body, rendered."""
+        return self.render_content(chosen.response if chosen else '', params)  # fall back to an empty response
 
     @property
     def flat_response(self):
-        response = ''  # fall back to an empty response
-        active_responses = self.responses.filter(active=True)
-        if active_responses.count() > 1:
-            responses = [r.response for r in active_responses]
-            response = random.choice(responses)
-
-        if active_responses.first():  # only one response, return it
-            response = active_responses.first().response
+        return self.render_response(self.choose_response())
 
-        response = self.perform_substitutions(response)
+    def fetch_live(self, get=None, post=None, verb='GET'):
+        """Returns the upstream body and whether it's fit to be cached (only 200s are)."""
+        if verb == 'GET':
+            live_response = live_sessions.request('GET', self.live_url, params=get)
+        else:
+            live_response = live_sessions.request('POST', self.live_url, data=post)
 
-        return response  # fall back to an empty response
+        if live_response.status_code == 200:
+            return live_response.content, True
+        return '', False  # fall back to empty response
 
-    def live_response(self, get=None, post=None, verb='GET'):
+    def live_content(self, get=None, post=None, verb='GET'):
+        """The upstream body, from the live cache if the rule has one."""
         response = ''  # fall back to empty response
 
-        if self.live_url and verb == 'GET':  # require a URL
-            live_response = requests.get(self.live_url, params=get)
-            if live_response.status_code == 200:
-                response = live_response.content
+        if self.live_url and verb in ('GET', 'POST'):  # require a URL
+            if self.live_cache_ttl:
+                key = (self.live_url, verb, normalize_params(get), normalize_params(post))
+                response = live_caches.for_rule(self).get(key, lambda: self.fetch_live(get, post, verb))
+            else:
+                response, cacheable = self.fetch_live(get, post, verb)
+
+        return response
 
-        elif self.live_url and verb == 'POST':  # require a URL
-            live_response = requests.post(self.live_url, data=post)
-            if live_response.status_code == 200:
-                response = live_response.content
+    def live_response(self, get=None, post=None, verb='GET', params=None):
+        return self.render_content(self.live_content(get, post, verb), params)
 
-        response = self.perform_substitutions(response)
 
-        return response
+class ResponseBodyManager(models.Manager):
+    def store(self, text):
+        """The body holding this text, stored (compressed) if no response had it yet."""
+        data = text.encode('utf-8')
+        digest = body_digest(data)
+        if not self.filter(pk=digest).exists():
+            encoding, stored = compress(data)
+            variants = content_encodings(data)
+            body, _ = self.get_or_create(digest=digest, defaults={'encoding': encoding, 'size': len(data),
+                                                                  'data': stored, 'gzip': variants.get('gzip'),
+                                                                  'br': variants.get('br')})
+        body_cache.put(digest, text, len(data))
+        return digest
+
+
+class ResponseBody(models.Model):
+    """A response body shared by every RuleResponse with the same text, addressed by the SHA-256 of its UTF-8 encoding
+    and stored compressed (see rules.blobs). Bodies no response uses any more are removed by
+    `manage.py prune_response_bodies`."""
+
+    digest = models.CharField(max_length=64, primary_key=True)
+    encoding = models.CharField(max_length=8, blank=True)
+    size = models.PositiveIntegerField(help_text=u'Length of the body in bytes, uncompressed.')
+    data = models.BinaryField()
+    gzip = models.BinaryField(null=True, help_text=u'The body gzipped, for clients that accept it.')
+    br = models.BinaryField(null=True, help_text=u'The body brotli compressed, if brotli was installed when stored.')
+
+    objects = ResponseBodyManager()
+
+    def __unicode__(self):
+        return u'Body %s (%s bytes)' % (self.digest[:12], self.size)
+
+    def text(self):
+        """The decoded body, from the in-memory cache if it's been used recently. Otherwise it's decoded from the data
+        loaded with the instance, so a body in the compiled rule table (see RuleQuerySet.compiled() and rules.snapshot)
+        never has to be looked up again, and only the cache holds on to decoded text."""
+        text = body_cache.get(self.digest)
+        if text is None:
+            text = decompress(self.encoding, self.data).decode('utf-8')
+            body_cache.put(self.digest, text, self.size)
+        return text
+
+    @classmethod
+    def text_for(cls, digest):
+        """The decoded body, from the in-memory cache if it's been used recently."""
+        text = body_cache.get(digest)
+        if text is None:
+            text = cls.objects.get(pk=digest).text()
+        return text
+
+    def encoded(self, encoding):
+        """The body in a Content-Encoding ('gzip' or 'br'), or None if it isn't stored in it."""
+        encoded = getattr(self, encoding)
+        return bytes(encoded) if encoded is not None else None
 
 
 class RuleResponse(models.Model):
     rule = models.ForeignKey(Rule, related_name='responses')
-    response = models.TextField(null=True, blank=True, default='')
+    body = models.ForeignKey(ResponseBody, null=True, blank=True, editable=False, related_name='responses',
+                             on_delete=models.PROTECT)
+    body_file = models.FileField(upload_to='responses/', blank=True,
+                                 help_text=u'Serve this file as the body instead of the response text, for large '
+                                           u'payloads. Sent as stored (with Range support) unless the rule has '
+                                           u'substitutions. Path parameters are not filled in.')
     active = models.BooleanField(default=True)
+    weight = models.PositiveIntegerField(default=1,
+                                         help_text=u'How often this response is chosen relative to the other active '
+                                                   u'responses. 0 to never choose it while any others have a weight.')
+
+    class Meta:
+        index_together = (('rule', 'active'),)
 
     def __unicode__(self):
         return u'Response for %s' % self.rule
 
+    @property
+    def response(self):
+        """The response text, kept in the shared body store rather than on the row."""
+        text = getattr(self, '_response', None)
+        if text is None:
+            if not self.body_id:
+                text = ''
+            elif RuleResponse.body.is_cached(self):  # loaded along with the rule
+                text = self.body.text()
+            else:
+                text = ResponseBody.text_for(self.body_id)
+        return text
+
+    @response.setter
+    def response(self, text):
+        self._response = text or ''
+
+    def save(self, *args, **kwargs):
+        text = getattr(self, '_response', None)
+        if text is not None:
+            self.body_id = ResponseBody.objects.store(text) if text else None
+            self._response = None  # read back through the cache, so a response held in memory doesn't pin its text
+        super(RuleResponse, self).save(*args, **kwargs)
+
 
 class RuleSubstitution(models.Model):
     rule = models.ForeignKey(Rule, related_name='substitutions')
@@ -85,5 +297,61 @@ class RuleSubstitution(models.Model):
     replace = models.TextField(null=False, blank=True)
     active = models.BooleanField(default=True)
 
+    class Meta:
+        index_together = (('rule', 'active'),)
+
     def __unicode__(self):
         return u'Replace for rule %s' % self.rule
+
+
+# upper bounds of the latency histogram buckets in ms, anything slower lands in one last overflow bucket
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class RuleStats(models.Model):
+    rule = models.OneToOneField(Rule, related_name='stats')
+    hits = models.PositiveIntegerField(default=0)
+    last_seen = models.DateTimeField(null=True, blank=True)
+    action_counts = models.TextField(default='{}', help_text=u'JSON object of how often each action was taken.')
+    latency_histogram = models.TextField(default='[]', help_text=u'JSON list of request counts per latency bucket.')
+    latency_p50_ms = models.FloatField(null=True, blank=True)
+    latency_p99_ms = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name_plural = 'rule stats'
+
+    def __unicode__(self):
+        return u'Stats for %s' % self.rule
+
+    def get_action_counts(self):
+        return json.loads(self.action_counts or '{}')
+
+    def get_latency_histogram(self):
+        return json.loads(self.latency_histogram or '[]') or [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def merge(self, hits, last_seen, action_counts, latency_histogram):
+        """Adds a batch of counts collected in memory (see rules.stats) and updates the percentiles."""
+        self.hits += hits
+        self.last_seen = max(self.last_seen, last_seen) if self.last_seen else last_seen
+
+        counts = self.get_action_counts()
+        for action, count in action_counts.items():
+            counts[action] = counts.get(action, 0) + count
+        self.action_counts = json.dumps(counts, sort_keys=True)
+
+        histogram = [a + b for a, b in zip(self.get_latency_histogram(), latency_histogram)]
+        self.latency_histogram = json.dumps(histogram)
+        self.latency_p50_ms = histogram_percentile(histogram, 0.5)
+        self.latency_p99_ms = histogram_percentile(histogram, 0.99)
+
+
+def histogram_percentile(histogram, fraction):
+    """The upper bound of the bucket the given fraction of requests fall within (overflow reports the last bound)."""
+    total = sum(histogram)
+    if not total:
+        return None
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS + (LATENCY_BUCKETS_MS[-1],), histogram):
+        seen += count
+        if seen >= total * fraction:
+            return float(bound)
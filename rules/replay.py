@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+from timeit import default_timer
+
+import requests
+from django.utils.six.moves import queue
+from django.utils.six.moves.urllib.parse import urlencode
+
+from rules.benchmarks import percentile
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+
+def build_request(record, target):
+    """(method, url, kwargs) to send a captured request to the StormCloud at target. Form posts are sent again from
+    their captured fields (url encoded, even if they were multipart), other bodies (of which only a hash was kept) as
+    that many zero bytes."""
+    url = target.rstrip('/') + record['path']
+    if record['params']['get']:
+        url += '?' + urlencode(sorted(record['params']['get'].items()), doseq=True)
+
+    headers = {'Host': record['host']} if record['host'] else {}  # so it's matched to the vendor it was captured for
+    if record['params']['post']:
+        body = urlencode(sorted(record['params']['post'].items()), doseq=True)
+        headers['Content-Type'] = FORM_CONTENT_TYPE
+    elif record['body_length']:
+        body = b'\0' * record['body_length']
+        headers['Content-Type'] = record['content_type'] or 'application/octet-stream'
+    else:
+        body = None
+    return record['verb'], url, dict(headers=headers, data=body, allow_redirects=False)
+
+
+def rule_label(record):
+    if record.get('rule') is not None:
+        return 'rule %s' % record['rule']
+    return '%s %s' % (record['verb'], record['path'])  # nothing matched when it was captured
+
+
+class Replay(object):
+    """Fires captured requests at a StormCloud instance, paced as they arrived divided by speed (0 for as fast as
+    possible), from concurrency worker threads each with its own keep-alive session.
+
+    A request's latency runs from sending it until its body is read. When every worker is busy requests go out late,
+    which is reported as lag rather than counted as latency."""
+
+    def __init__(self, records, target, speed=1.0, concurrency=10, timeout=30):
+        self.records = records
+        self.target = target
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.latencies = OrderedDict()  # rule label -> [seconds, ...]
+        self.errors = OrderedDict()  # rule label -> failed requests, and 5xx responses to ones that weren't 5xx before
+        self.max_lag = 0.0
+
+    def _record(self, label, latency, failed):
+        with self._lock:
+            self.latencies.setdefault(label, []).append(latency)
+            self.errors[label] = self.errors.get(label, 0) + failed
+
+    def _work(self, work):
+        session = requests.Session()
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            record, due = item
+            lag = time.time() - due
+            method, url, kwargs = build_request(record, self.target)
+            started = default_timer()
+            try:
+                response = session.request(method, url, timeout=self.timeout, **kwargs)
+                response.content
+                failed = response.status_code >= 500 and record.get('status', 200) < 500
+            except requests.RequestException:
+                failed = True
+            self._record(rule_label(record), default_timer() - started, failed)
+            with self._lock:
+                self.max_lag = max(self.max_lag, lag)
+        session.close()
+
+    def run(self):
+        """Plays the whole capture back and returns the report."""
+        work = queue.Queue(maxsize=self.concurrency * 2)
+        workers = [threading.Thread(target=self._work, args=(work,)) for _ in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        started = time.time()
+        first = self.records[0]['ts'] if self.records else 0
+        for record in self.records:
+            due = started + ((record['ts'] - first) / self.speed if self.speed else 0)
+            wait = due - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            work.put((record, due))
+        for worker in workers:
+            work.put(None)
+        for worker in workers:
+            worker.join()
+
+        return self.report(time.time() - started)
+
+    def report(self, elapsed):
+        rules = OrderedDict()
+        for label, latencies in self.latencies.items():
+            latencies = sorted(latencies)
+            rules[label] = OrderedDict([
+                ('requests', len(latencies)),
+                ('rps', len(latencies) / elapsed if elapsed else 0.0),
+                ('errors', self.errors[label]),
+                ('p50_ms', percentile(latencies, 0.5) * 1000.0),
+                ('p99_ms', percentile(latencies, 0.99) * 1000.0),
+                ('max_ms', latencies[-1] * 1000.0),
+            ])
+        total = sum(rule['requests'] for rule in rules.values())
+        return OrderedDict([
+            ('requests', total),
+            ('errors', sum(rule['errors'] for rule in rules.values())),
+            ('elapsed_s', elapsed),
+            ('rps', total / elapsed if elapsed else 0.0),
+            ('max_lag_ms', self.max_lag * 1000.0),
+            ('rules', rules),
+        ])
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+
+from django.http.request import split_domain_port
+
+from rules.matching import ParameterIndex
+
+# {{name}} in a response or substitution is filled in with the path parameter captured under that name
+PARAMETER_PLACEHOLDER = re.compile(r'\{\{(\w+)\}\}')
+PARAMETER_PLACEHOLDER_BYTES = re.compile(br'\{\{(\w+)\}\}')
+
+
+def is_pattern(path):
+    """Whether a rule's path is a template rather than a path to match exactly."""
+    return any(segment == '*' or segment == '**' or _parameter_name(segment) for segment in path.split('/'))
+
+
+def _parameter_name(segment):
+    if len(segment) > 2 and segment.startswith('{') and segment.endswith('}'):
+        return segment[1:-1]
+
+
+def fill_parameters(content, params):
+    """Replaces {{name}} placeholders with captured path parameters, leaving any it has no parameter for alone."""
+    if not params or not content:
+        return content
+    if isinstance(content, bytes):
+        encoded = dict((name.encode('utf-8'), value.encode('utf-8')) for name, value in params.items())
+        return PARAMETER_PLACEHOLDER_BYTES.sub(lambda match: encoded.get(match.group(1), match.group(0)), content)
+    return PARAMETER_PLACEHOLDER.sub(lambda match: params.get(match.group(1), match.group(0)), content)
+
+
+class _Node(object):
+    __slots__ = ('literals', 'parameter', 'wildcard', 'rest', 'rules', 'index')
+
+    def __init__(self):
+        self.literals = {}
+        self.parameter = None  # {name} - any one non-empty segment, captured
+        self.wildcard = None  # * - any one non-empty segment
+        self.rest = None  # ** as the last segment - whatever is left of the path
+        self.rules = []  # (rule, [(segment index, parameter name), ...]) ending here
+        self.index = None  # ParameterIndex of those rules, built on first match
+
+
+class PathTrie(object):
+    """The pattern rules for one vendor and verb, as a trie of path segments.
+
+    A path template is split on / and each segment is either literal, {name} (one segment, captured as a parameter),
+    * (one segment) or, last, ** (the rest of the path, possibly nothing). Matching walks the request path a segment
+    at a time preferring literal over parameter over * over ** and backing up when a branch dead-ends, so the cost
+    depends on the depth of the path rather than the number of rules."""
+
+    def __init__(self, rules=()):
+        self.root = _Node()
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        node = self.root
+        captures = []
+        segments = rule.path.split('/')
+        for index, segment in enumerate(segments):
+            if segment == '**' and index == len(segments) - 1:
+                node.rest = node.rest or _Node()
+                node = node.rest
+            elif segment == '*':
+                node.wildcard = node.wildcard or _Node()
+                node = node.wildcard
+            elif _parameter_name(segment):
+                node.parameter = node.parameter or _Node()
+                node = node.parameter
+                captures.append((index, _parameter_name(segment)))
+            else:
+                node = node.literals.setdefault(segment, _Node())
+        node.rules.append((rule, captures))
+        node.index = None
+
+    def match(self, path, parameters=None):
+        """Returns [(rule, {parameter: value}), ...] for the most specific template matching the path, narrowed down by
+        the request's parameters (a RequestParameters), usually just the one (more than one is a configuration
+        error)."""
+        segments = path.split('/')
+        node = self._match(self.root, segments, 0)
+        if node is None:
+            return []
+        if node.index is None:
+            node.index = ParameterIndex(node.rules)
+        found = node.index.match(parameters)
+        return [(rule, dict((name, segments[index]) for index, name in captures)) for rule, captures in found]
+
+    def _match(self, node, segments, index):
+        """The node holding the rules for the most specific template matching the path, or None."""
+        if index == len(segments):
+            if node.rules:
+                return node
+            return node.rest if node.rest is not None and node.rest.rules else None
+
+        segment = segments[index]
+        child = node.literals.get(segment)
+        if child is not None:
+            found = self._match(child, segments, index + 1)
+            if found is not None:
+                return found
+        if segment:
+            for child in (node.parameter, node.wildcard):
+                if child is not None:
+                    found = self._match(child, segments, index + 1)
+                    if found is not None:
+                        return found
+        if node.rest is not None and node.rest.rules:
+            return node.rest
+
+
+def split_base_url(base_url):
+    """A vendor's base_url as (host, path prefix), e.g. 'http://localhost:8000/stripe/' -> ('localhost', '/stripe').
+    The scheme and port are ignored, since requests are matched on their hostname (see request_host)."""
+    base_url = (base_url or '').strip()
+    if '://' in base_url:
+        base_url = base_url.split('://', 1)[1]
+    host, slash, prefix = base_url.partition('/')
+    return host.split(':', 1)[0].lower(), ('/' + prefix).rstrip('/')
+
+
+def request_host(meta):
+    """The hostname a request (its META, or a WSGI environ) was sent to, from its Host header with the port left off,
+    falling back on SERVER_NAME. Not request.get_host(), which turns away any host missing from ALLOWED_HOSTS - a mock
+    pointed at by DNS overrides answers for every vendor's hostname."""
+    host, _ = split_domain_port(meta.get('HTTP_HOST', ''))
+    return host or meta.get('SERVER_NAME', '')
+
+
+def path_prefixes(path):
+    """Every prefix of a path that ends on a segment boundary, longest first - '/a/b' -> '/a/b', '/a', ''."""
+    prefix = path.rstrip('/')
+    while prefix:
+        yield prefix
+        prefix = prefix.rsplit('/', 1)[0]
+    yield ''
+
+
+class VendorIndex(object):
+    """Vendors by host and path prefix, so that several vendors can be mocked on one host (e.g. localhost/stripe and
+    localhost/twilio). A request goes to the vendor with the longest prefix of its path, found by probing once per path
+    segment rather than comparing against every vendor."""
+
+    def __init__(self, vendors=()):
+        self.prefixes = {}  # (host, prefix) -> [Vendor, ...] - more than one is a configuration error
+        for vendor in vendors:
+            self.prefixes.setdefault(split_base_url(vendor.base_url), []).append(vendor)
+
+    def match(self, host, path):
+        host = host.lower()
+        for prefix in path_prefixes(path):
+            vendors = self.prefixes.get((host, prefix))
+            if vendors:
+                return vendors
+        return []
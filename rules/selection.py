@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import threading
+
+from django.conf import settings
+
+_random = {'seed': None, 'rng': random.Random()}
+_random_lock = threading.Lock()
+
+
+def get_random():
+    """The random number generator response selection draws from. Seeded from STORMCLOUD_RANDOM_SEED when that's set, so
+    a chaos run picks the same responses in the same order every time it's replayed."""
+    seed = getattr(settings, 'STORMCLOUD_RANDOM_SEED', None)
+    if seed != _random['seed']:
+        reset_random()
+    return _random['rng']
+
+
+def reset_random():
+    """Starts the sequence over, from STORMCLOUD_RANDOM_SEED if it's set."""
+    with _random_lock:
+        seed = getattr(settings, 'STORMCLOUD_RANDOM_SEED', None)
+        _random['seed'], _random['rng'] = seed, random.Random(seed)
+
+
+class AliasTable(object):
+    """Vose's alias method - built once in O(n) from a list of weights, then every weighted pick is O(1) whatever the
+    number of choices. Zero weights are never picked, unless every weight is zero and the choice is uniform."""
+
+    def __init__(self, weights):
+        if not any(weights):
+            weights = [1] * len(weights)
+        self.size = len(weights)
+        total = float(sum(weights))
+        scaled = [weight * self.size / total for weight in weights]
+
+        self.probability = [0.0] * self.size
+        self.alias = [0] * self.size
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1.0
+            (small if scaled[more] < 1.0 else large).append(more)
+        for i in large + small:  # whatever's left is 1.0 give or take floating point error
+            self.probability[i] = 1.0
+
+    def sample(self, rng):
+        i = int(rng.random() * self.size)
+        return i if rng.random() < self.probability[i] else self.alias[i]
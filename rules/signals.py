@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connections
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from rules.live import live_caches
+from rules.models import Rule, RuleResponse, RuleSubstitution
+from rules.snapshot import get_snapshot
+from rules.table import rule_table
+from vendors.models import Vendor
+
+
+# NULLs never collide in a unique index, so Rule's unique_together doesn't cover rules without a vendor
+UNIQUE_WITHOUT_VENDOR = ('CREATE UNIQUE INDEX IF NOT EXISTS rules_rule_unique_without_vendor '
+                         'ON rules_rule (path, verb, match_key) WHERE vendor_id IS NULL')
+
+
+def publish_snapshot():
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        snapshot.schedule_publish()
+
+
+@receiver(post_save, sender=Rule)
+def rule_saved(sender, instance, **kwargs):
+    rule_table.refresh_rule(instance.pk)
+    publish_snapshot()
+
+
+@receiver(post_delete, sender=Rule)
+def rule_deleted(sender, instance, **kwargs):
+    rule_table.discard_rule(instance.pk)
+    live_caches.discard(instance.pk)
+    publish_snapshot()
+
+
+@receiver(post_save, sender=RuleResponse)
+@receiver(post_delete, sender=RuleResponse)
+@receiver(post_save, sender=RuleSubstitution)
+@receiver(post_delete, sender=RuleSubstitution)
+def rule_child_changed(sender, instance, **kwargs):
+    rule_table.refresh_rule(instance.rule_id)
+    publish_snapshot()
+
+
+@receiver(post_save, sender=Vendor)
+def vendor_saved(sender, instance, **kwargs):
+    rule_table.refresh_vendor(instance)
+    publish_snapshot()
+
+
+@receiver(post_delete, sender=Vendor)
+def vendor_deleted(sender, instance, **kwargs):
+    rule_table.discard_vendor(instance.pk)
+    publish_snapshot()
+
+
+@receiver(post_migrate)
+def ensure_unique_without_vendor(sender, using, **kwargs):
+    """Adds the partial unique index for rules without a vendor where the database supports one. Done after every
+    migrate rather than in a migration, as SQLite drops indexes Django doesn't know about whenever it rebuilds a table."""
+    connection = connections[using]
+    if sender.name == 'rules' and connection.vendor in ('sqlite', 'postgresql'):
+        with connection.cursor() as cursor:
+            cursor.execute(UNIQUE_WITHOUT_VENDOR)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import base64
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+from rules.models import ResponseBody, Rule, RuleResponse, RuleSubstitution
+from vendors.models import Vendor
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'STRMSNAP'
+HEADER = struct.Struct(str('<8sQQ'))  # magic, version, payload length
+VERSION = struct.Struct(str('<Q'))
+
+SNAPSHOT_MODELS = (
+    ('vendors', Vendor),
+    ('rules', Rule),
+    ('responses', RuleResponse),
+    ('substitutions', RuleSubstitution),
+)
+
+
+def _encode(data):
+    return base64.b64encode(bytes(data)).decode('ascii') if data is not None else None
+
+
+def _decode(text):
+    return base64.b64decode(text) if text is not None else None
+
+
+def dump_payload():
+    """Everything the compiled rule table is built from, in Django's python serialization format - and the bodies of
+    the active responses, by hand, since that format can't tell an empty BinaryField from a missing one."""
+    payload = dict((name, serializers.serialize('python', model.objects.order_by('pk')))
+                   for name, model in SNAPSHOT_MODELS)
+    bodies = ResponseBody.objects.filter(pk__in=RuleResponse.objects.filter(active=True).values('body'))
+    payload['bodies'] = [{'digest': body.digest, 'encoding': body.encoding, 'size': body.size,
+                          'data': _encode(body.data), 'gzip': _encode(body.gzip), 'br': _encode(body.br)}
+                         for body in bodies.order_by('pk')]
+    return payload
+
+
+def _deserialize(records):
+    return [deserialized.object for deserialized in serializers.deserialize('python', records)]
+
+
+def payload_objects(payload):
+    """Rebuilds (rules, vendors) from a snapshot payload the same shape Rule.objects.compiled() returns them in, without
+    a database query."""
+    vendors = dict((vendor.pk, vendor) for vendor in _deserialize(payload['vendors']))
+    bodies = dict((record['digest'], ResponseBody(digest=record['digest'], encoding=record['encoding'],
+                                                  size=record['size'], data=_decode(record['data']),
+                                                  gzip=_decode(record['gzip']), br=_decode(record['br'])))
+                  for record in payload.get('bodies', ()))  # not in snapshots written before bodies were shared
+
+    responses = defaultdict(list)
+    for response in _deserialize(payload['responses']):
+        if response.active:
+            if response.body_id in bodies:
+                response.body = bodies[response.body_id]  # one instance per body, decoded once for every rule using it
+            responses[response.rule_id].append(response)
+
+    substitutions = defaultdict(list)
+    for substitution in _deserialize(payload['substitutions']):
+        if substitution.active:
+            substitutions[substitution.rule_id].append(substitution)
+
+    rules = _deserialize(payload['rules'])
+    for rule in rules:
+        if rule.vendor_id in vendors:
+            rule.vendor = vendors[rule.vendor_id]
+        rule.active_responses = responses[rule.pk]
+        rule.active_substitutions = substitutions[rule.pk]
+
+    return rules, sorted(vendors.values(), key=lambda vendor: vendor.pk)
+
+
+class RuleSnapshot(object):
+    """A versioned snapshot of all rule data shared by every worker process on the host.
+
+    The snapshot itself is a single file (header + JSON payload) that's replaced atomically with a rename, next to it
+    sits an 8 byte version counter every worker keeps memory-mapped read-only. Checking for a new snapshot is then a
+    read from shared memory rather than a database query, and an admin save in any worker reaches all of them as soon
+    as the counter is bumped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.version_path = path + '.version'
+        self.lock_path = path + '.lock'
+        self._version_map = None
+        self._lock = threading.Lock()
+        self.changes = 0
+        self.published = 0
+
+    @contextmanager
+    def _locked(self):
+        """Serializes writers across processes."""
+        with open(self.lock_path, 'a+b') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _map_version(self):
+        if self._version_map is None:
+            with self._locked():
+                if not os.path.exists(self.version_path) or os.path.getsize(self.version_path) < VERSION.size:
+                    with open(self.version_path, 'wb') as version_file:
+                        version_file.write(VERSION.pack(0))
+            with open(self.version_path, 'rb') as version_file:
+                self._version_map = mmap.mmap(version_file.fileno(), VERSION.size, access=mmap.ACCESS_READ)
+        return self._version_map
+
+    def version(self):
+        return VERSION.unpack_from(self._map_version(), 0)[0]
+
+    def read(self):
+        """Maps the current snapshot read-only. Returns (version, payload), or (0, None) if none was written yet."""
+        try:
+            snapshot_file = open(self.path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return 0, None
+            raise
+
+        with snapshot_file:
+            mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, length = HEADER.unpack_from(mapped, 0)
+            if magic != MAGIC:
+                raise ValueError("%s is not a StormCloud rule snapshot" % self.path)
+            payload = json.loads(mapped[HEADER.size:HEADER.size + length].decode('utf-8'))
+        finally:
+            mapped.close()
+
+        return version, payload
+
+    def write(self, payload):
+        data = json.dumps(payload, cls=DjangoJSONEncoder).encode('utf-8')
+        self._map_version()  # make sure the counter exists before taking the lock for the write
+        with self._locked():
+            version = self.version() + 1
+            temp_path = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(temp_path, 'wb') as snapshot_file:
+                snapshot_file.write(HEADER.pack(MAGIC, version, len(data)))
+                snapshot_file.write(data)
+            os.rename(temp_path, self.path)  # readers still holding the old file keep a consistent copy
+
+            with open(self.version_path, 'r+b') as version_file:  # bump last, so the new file is in place first
+                version_file.write(VERSION.pack(version))
+
+        logger.info("Published rule snapshot version %s (%s bytes)", version, len(data))
+        return version
+
+    def publish(self):
+        """Writes a fresh snapshot from the database unless one already went out since the last change."""
+        with self._lock:
+            if self.published >= self.changes and os.path.exists(self.path):
+                return
+            self.published = self.changes
+        return self.write(dump_payload())
+
+    def schedule_publish(self):
+        """Called for every rule data change, publishes once the surrounding transaction commits. An admin save that
+        touches a rule and all its inlines still only writes one snapshot."""
+        with self._lock:
+            self.changes += 1
+        transaction.on_commit(self.publish)
+
+
+_snapshots = {}
+
+
+def get_snapshot():
+    """The shared snapshot configured by STORMCLOUD_SNAPSHOT_PATH, or None when each process keeps its own table."""
+    path = getattr(settings, 'STORMCLOUD_SNAPSHOT_PATH', None)
+    if not path:
+        return None
+    snapshot = _snapshots.get(path)
+    if snapshot is None:
+        snapshot = _snapshots.setdefault(path, RuleSnapshot(path))
+    return snapshot
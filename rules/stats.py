@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import atexit
+import bisect
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.utils.timezone import now
+
+from rules.models import LATENCY_BUCKETS_MS, Rule, RuleStats
+
+logger = logging.getLogger(__name__)
+
+
+class _Counter(object):
+    __slots__ = ('hits', 'last_seen', 'actions', 'histogram')
+
+    def __init__(self):
+        self.hits = 0
+        self.last_seen = None
+        self.actions = {}
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, other):
+        self.hits += other.hits
+        if other.last_seen is not None and (self.last_seen is None or other.last_seen > self.last_seen):
+            self.last_seen = other.last_seen
+        for action, count in other.actions.items():
+            self.actions[action] = self.actions.get(action, 0) + count
+        self.histogram = [mine + theirs for mine, theirs in zip(self.histogram, other.histogram)]
+
+
+class RuleStatsCollector(object):
+    """Per rule hit counts, actions taken, last seen time and a latency histogram, kept in memory and written out to
+    RuleStats every STORMCLOUD_STATS_FLUSH_INTERVAL seconds, so counting a request costs an uncontended lock and a few
+    additions rather than an UPDATE. Whatever is still counted at exit is written then."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flusher = None
+        self._stopping = False
+        self.counters = {}  # rule pk -> _Counter
+
+    def record(self, rule_pk, action, latency_ms):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, latency_ms)
+        seen = now()
+        with self._lock:
+            counter = self.counters.get(rule_pk)
+            if counter is None:
+                counter = self.counters[rule_pk] = _Counter()
+            counter.hits += 1
+            counter.actions[action] = counter.actions.get(action, 0) + 1
+            counter.histogram[bucket] += 1
+            counter.last_seen = seen
+        self._start_flusher()
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._run, name='stormcloud-rule-stats')
+                    self._flusher.daemon = True
+                    self._flusher.start()
+                    atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(getattr(settings, 'STORMCLOUD_STATS_FLUSH_INTERVAL', 10.0))
+            if self._stopping:
+                break  # the exit flush writes what's left
+            try:
+                if self.flush():
+                    connection.close()  # don't hold this thread's connection open between flushes
+            except Exception:
+                logger.exception("Writing rule stats failed, they'll be added in with the next flush")
+                connection.close()
+
+    def _flush_at_exit(self):
+        # stop the flusher first, rather than leave it waiting while the interpreter tears down the modules it uses
+        self._stopping = True
+        self._wake.set()
+        self._flusher.join(5)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Writing rule stats at exit failed")
+
+    def _put_back(self, counters):
+        with self._lock:
+            for rule_pk, counter in counters.items():
+                since = self.counters.get(rule_pk)
+                if since is not None:
+                    counter.add(since)
+                self.counters[rule_pk] = counter
+
+    def flush(self):
+        """Adds everything counted since the last flush to RuleStats, returns how many rules were updated. Counts the
+        database failed to take are put back for the next flush, and the (last) error raised."""
+        with self._lock:
+            counters, self.counters = self.counters, {}
+        if not counters:
+            return 0
+
+        try:
+            existing = set(Rule.objects.filter(pk__in=list(counters)).values_list('pk', flat=True))
+        except DatabaseError:
+            self._put_back(counters)
+            raise
+        failed, error = {}, None
+        for rule_pk, counter in counters.items():
+            if rule_pk not in existing:  # deleted since it was hit
+                continue
+            try:
+                self.write(rule_pk, counter)
+            except DatabaseError as e:
+                failed[rule_pk], error = counter, e
+        if failed:
+            self._put_back(failed)
+            raise error
+        return len(existing)
+
+    def write(self, rule_pk, counter):
+        """Adds one rule's counts to its RuleStats row."""
+        try:
+            with transaction.atomic():
+                stats, created = RuleStats.objects.select_for_update().get_or_create(rule_id=rule_pk)
+                stats.merge(counter.hits, counter.last_seen, counter.actions, counter.histogram)
+                stats.save()
+        except IntegrityError:  # another worker created the row first, add to theirs
+            with transaction.atomic():
+                stats = RuleStats.objects.select_for_update().get(rule_id=rule_pk)
+                stats.merge(counter.hits, counter.last_seen, counter.actions, counter.histogram)
+                stats.save()
+
+
+rule_stats = RuleStatsCollector()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import re
+from collections import OrderedDict
+
+
+class Substituter(object):
+    """A rule's active find/replace pairs compiled into one regular expression, so a body is rewritten in a single
+    pass however many substitutions there are.
+
+    Where finds overlap the longest one wins, and the first pair configured for a find is the one used. Unlike the
+    str.replace per substitution this replaces, a replacement is never matched again by another substitution."""
+
+    def __init__(self, pairs):
+        self.replacements = OrderedDict()
+        for find, replace in pairs:
+            if find and find not in self.replacements:
+                self.replacements[find] = replace or ''
+
+        self.text_pattern = self.bytes_pattern = None
+        if self.replacements:
+            finds = sorted(self.replacements, key=len, reverse=True)
+            self.text_pattern = re.compile('|'.join(re.escape(find) for find in finds))
+
+            self.bytes_replacements = dict((find.encode('utf-8'), replace.encode('utf-8'))
+                                           for find, replace in self.replacements.items())
+            self.bytes_pattern = re.compile(b'|'.join(re.escape(find.encode('utf-8')) for find in finds))
+            self.longest = max(len(find) for find in self.bytes_replacements)
+
+    def __bool__(self):
+        return bool(self.replacements)
+    __nonzero__ = __bool__
+
+    def __call__(self, content):
+        if not self.replacements or not content:
+            return content
+        if isinstance(content, bytes):
+            return self.bytes_pattern.sub(lambda match: self.bytes_replacements[match.group(0)], content)
+        return self.text_pattern.sub(lambda match: self.replacements[match.group(0)], content)
+
+    def stream(self, chunks):
+        """Substitutes across an iterable of byte chunks, holding back just enough of each chunk's end that a find split
+        over two chunks is still matched. Produces the same output as substituting the joined body."""
+        if not self.replacements:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        tail = b''
+        for chunk in chunks:
+            buffer = tail + chunk
+            limit = len(buffer) - (self.longest - 1)  # any find starting before here is entirely inside the buffer
+            output = []
+            position = 0
+            for match in self.bytes_pattern.finditer(buffer):
+                if match.start() >= limit:
+                    break
+                output.append(buffer[position:match.start()])
+                output.append(self.bytes_replacements[match.group(0)])
+                position = match.end()
+            cut = max(position, limit)
+            output.append(buffer[position:cut])
+            tail = buffer[cut:]
+
+            output = b''.join(output)
+            if output:
+                yield output
+
+        if tail:
+            yield self(tail)
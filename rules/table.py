@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+from django.db import DatabaseError, connections
+
+from rules.matching import ParameterIndex
+from rules.models import Rule
+from rules.router import PathTrie, VendorIndex, is_pattern
+from rules.snapshot import get_snapshot, payload_objects
+from vendors.models import Vendor
+
+logger = logging.getLogger(__name__)
+
+
+def rule_key(rule):
+    return rule.vendor_id, rule.path, rule.verb
+
+
+class RuleTable(object):
+    """In-process compiled copy of every Rule (with its active responses and substitutions) and every Vendor, so that
+    the middleware can answer a request without touching the database.
+
+    The table is loaded in full the first time it's used and from then on kept current one rule at a time by the
+    receivers in rules.signals. Readers never take the lock - entries are only ever swapped in whole, and a dict
+    get/set is atomic.
+
+    Rules whose path is a template (see rules.router) are also compiled into a PathTrie per vendor and verb, consulted
+    when no rule matches the path exactly. Rules that share a path but match on different request parameters are told
+    apart by a ParameterIndex (see rules.matching), built the first time the path is requested. Vendors are kept in a
+    VendorIndex by host and path prefix.
+
+    With STORMCLOUD_SNAPSHOT_PATH set the table is loaded from the shared rule snapshot instead, and swapped for a new
+    one whenever the snapshot's version counter moves (see rules.snapshot).
+
+    A new table is built by one thread at a time outside the lock, which is only held to swap it in. Until then other
+    threads go on answering from the table there is, only waiting if there's none yet - stormcloud.wsgi loads it at
+    startup (see warm_up) so that isn't a request's to pay for."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loading = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget everything, the next lookup reloads the whole table from the database."""
+        with self._lock:
+            self.loaded = False
+            self.version = None  # snapshot version the table was loaded from
+            self.rules = {}  # (vendor_id, path, verb) -> [Rule, ...] - more than one per match_key is an error
+            self.parameter_indexes = {}  # (vendor_id, path, verb) -> (the list in self.rules, its ParameterIndex)
+            self.rule_keys = {}  # rule pk -> key, so a rule that changes vendor/path/verb can be moved
+            self.pattern_keys = {}  # (vendor_id, verb) -> set of keys in self.rules whose path is a template
+            self.tries = {}  # (vendor_id, verb) -> PathTrie of those rules
+            self.vendors = {}  # base_url -> [Vendor, ...]
+            self.vendor_urls = {}  # vendor pk -> base_url
+            self.vendor_index = VendorIndex()  # of the vendors above, rebuilt whenever one changes
+
+    def install(self, rule_list, vendor_list, version=None):
+        rules = {}
+        rule_keys = {}
+        for rule in rule_list:
+            key = rule_key(rule)
+            rules.setdefault(key, []).append(rule)
+            rule_keys[rule.pk] = key
+
+        pattern_keys = {}
+        for key in rules:
+            if is_pattern(key[1]):
+                pattern_keys.setdefault((key[0], key[2]), set()).add(key)
+        tries = dict((group, PathTrie(sorted((rule for key in keys for rule in rules[key]), key=lambda r: r.pk)))
+                     for group, keys in pattern_keys.items())
+
+        vendor_list = list(vendor_list)
+        vendors = {}
+        vendor_urls = {}
+        for vendor in vendor_list:
+            vendors.setdefault(vendor.base_url, []).append(vendor)
+            vendor_urls[vendor.pk] = vendor.base_url
+
+        with self._lock:
+            self.rules, self.rule_keys, self.parameter_indexes = rules, rule_keys, {}
+            self.pattern_keys, self.tries = pattern_keys, tries
+            self.vendors, self.vendor_urls = vendors, vendor_urls
+            self.vendor_index = VendorIndex(vendor_list)
+            self.version = version
+            self.loaded = True
+
+        logger.debug("Compiled rule table loaded with %s rules and %s vendors (snapshot version %s)",
+                     len(rule_keys), len(vendor_urls), version)
+
+    def load(self):
+        self.install(Rule.objects.compiled().order_by('pk'), Vendor.objects.order_by('pk'))
+
+    def load_snapshot(self, snapshot):
+        version, payload = snapshot.read()
+        if payload is None:  # first worker up on this host
+            snapshot.publish()
+            version, payload = snapshot.read()
+        rules, vendors = payload_objects(payload)
+        self.install(rules, vendors, version=version)
+
+    def ensure_loaded(self):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            if not self.loaded or snapshot.version() != self.version:
+                self._reload(lambda: self.load_snapshot(snapshot),
+                             lambda: self.loaded and snapshot.version() == self.version)
+        elif not self.loaded:
+            self._reload(self.load, lambda: self.loaded)
+
+    def _reload(self, load, current):
+        if self.loaded:
+            if not self._loading.acquire(False):
+                return  # another thread is building the new table, keep answering from this one meanwhile
+        else:
+            self._loading.acquire()
+        try:
+            if not current():
+                load()
+        finally:
+            self._loading.release()
+
+    def vendors_for(self, hostname, path='/'):
+        """The vendors whose base_url is the request's host with the longest prefix of its path."""
+        self.ensure_loaded()
+        return self.vendor_index.match(hostname, path)
+
+    def rules_for(self, vendor, path, verb):
+        self.ensure_loaded()
+        return self.rules.get((vendor.pk if vendor else None, path, verb), [])
+
+    def match(self, vendor, path, verb, parameters=None):
+        """[(rule, {parameter: value}), ...] for a request - the rules for exactly that path if any of them match its
+        parameters (a RequestParameters), otherwise the most specific pattern rule."""
+        self.ensure_loaded()
+        vendor_id = vendor.pk if vendor else None
+        key = (vendor_id, path, verb)
+        rules = self.rules.get(key)
+        if rules:
+            indexed = self.parameter_indexes.get(key)
+            if indexed is None or indexed[0] is not rules:  # lists are only ever replaced, never changed in place
+                indexed = self.parameter_indexes[key] = (rules, ParameterIndex([(rule, {}) for rule in rules]))
+            found = indexed[1].match(parameters)
+            if found:
+                return found
+        trie = self.tries.get((vendor_id, verb))
+        return trie.match(path, parameters) if trie is not None else []
+
+    # incremental maintenance, called from rules.signals
+
+    def _remove(self, index, keys, pk):
+        key = keys.pop(pk, None)
+        if key is None:
+            return
+        remaining = [obj for obj in index.get(key, []) if obj.pk != pk]
+        if remaining:
+            index[key] = remaining
+        else:
+            index.pop(key, None)
+
+    def _insert(self, index, keys, key, obj):
+        keys[obj.pk] = key
+        index[key] = sorted([o for o in index.get(key, []) if o.pk != obj.pk] + [obj], key=lambda o: o.pk)
+
+    def _rebuild_trie(self, vendor_id, verb):
+        group = (vendor_id, verb)
+        rules = [rule for key in self.pattern_keys.get(group, ()) for rule in self.rules.get(key, [])]
+        if rules:
+            self.tries[group] = PathTrie(sorted(rules, key=lambda r: r.pk))
+        else:
+            self.tries.pop(group, None)
+            self.pattern_keys.pop(group, None)
+
+    def _unset_rule(self, pk):
+        key = self.rule_keys.get(pk)
+        self._remove(self.rules, self.rule_keys, pk)
+        self.parameter_indexes.pop(key, None)
+        if key is not None and is_pattern(key[1]):
+            if key not in self.rules:
+                self.pattern_keys.get((key[0], key[2]), set()).discard(key)
+            self._rebuild_trie(key[0], key[2])
+
+    def _set_rule(self, rule):
+        key = rule_key(rule)
+        self._insert(self.rules, self.rule_keys, key, rule)
+        self.parameter_indexes.pop(key, None)
+        if is_pattern(rule.path):
+            self.pattern_keys.setdefault((key[0], key[2]), set()).add(key)
+            self._rebuild_trie(key[0], key[2])
+
+    def refresh_rule(self, pk):
+        """Reload a single rule (and its responses and substitutions), dropping it if it no longer exists."""
+        if not self.loaded:
+            return  # nothing to keep current, the first lookup will load everything
+        rule = Rule.objects.compiled().filter(pk=pk).first()
+        with self._lock:
+            self._unset_rule(pk)
+            if rule is not None:
+                self._set_rule(rule)
+
+    def refresh_rules(self, queryset):
+        """Reload a batch of rules at once, for changes made without signals (e.g. bulk_create)."""
+        if not self.loaded:
+            return
+        rules = list(queryset.compiled())
+        with self._lock:
+            for rule in rules:
+                self._unset_rule(rule.pk)
+                self._set_rule(rule)
+
+    def discard_rule(self, pk):
+        with self._lock:
+            self._unset_rule(pk)
+
+    def _rebuild_vendor_index(self):
+        self.vendor_index = VendorIndex(sorted((v for vendors in self.vendors.values() for v in vendors),
+                                               key=lambda v: v.pk))
+
+    def refresh_vendor(self, vendor):
+        if not self.loaded:
+            return
+        with self._lock:
+            self._remove(self.vendors, self.vendor_urls, vendor.pk)
+            self._insert(self.vendors, self.vendor_urls, vendor.base_url, vendor)
+            self._rebuild_vendor_index()
+
+    def discard_vendor(self, pk):
+        with self._lock:
+            self._remove(self.vendors, self.vendor_urls, pk)
+            self._rebuild_vendor_index()
+
+
+rule_table = RuleTable()
+
+
+def warm_up():
+    """Loads the rule table before the first request, which would otherwise wait for it. A database that isn't there or
+    isn't migrated yet is left for that first request to find."""
+    try:
+        rule_table.ensure_loaded()
+    except DatabaseError:
+        logger.warning("Rule table not loaded at startup, the first request will load it", exc_info=True)
+    finally:
+        connections.close_all()  # not to be shared by the workers a preloading server forks from here
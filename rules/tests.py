@@ -1,20 +1,114 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import contextlib
 import datetime
+import gzip
+import io
 import json
+import logging
+import os
+import pstats
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from unittest import skipIf
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, transaction
+from django.http import FileResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import six
+from django.utils.six import StringIO
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from wsgiref.util import FileWrapper
 from django.utils.timezone import now
 
-from rules.models import Rule, RuleResponse, RuleSubstitution
+from rules.benchmarks import compare, make_body, run_benchmarks
+from rules.blobs import body_cache, gzip_bytes
+from rules.capture import read_capture, traffic_capture
+from rules.discovery import RuleDiscovery, rule_discovery
+from rules.encoding import ranked_encodings
+from rules.faults import PACER, SERVER_PACES, TruncatedResponse, paced_chunks
+from rules.learning import learn_templates, template_for
+from rules.limits import RULE, LimitTable, limit_key, limit_table
+from rules.live import LiveCache, live_caches, live_sessions
+from rules.matching import match_key_for
+from rules.models import ResponseBody, Rule, RuleResponse, RuleStats, RuleSubstitution
+from rules.router import PathTrie, request_host, split_base_url
+from rules.replay import Replay, build_request
+from rules.selection import AliasTable, reset_random
+from rules.snapshot import get_snapshot
+from rules.stats import RuleStatsCollector, rule_stats
+from rules.substitution import Substituter
+from rules.table import RuleTable, rule_table
+from rules.timing import PhaseTimer
+from stormcloud.dispatch import StormCloudApplication
+from stormcloud.log import JSONFormatter, QueueStreamHandler, request_logger
+from stormcloud.middleware import DELAY_SERVED, StormCloudMiddleware
+from vendors.models import Vendor
+
+
+class StubUpstream(object):
+    """A local HTTP server standing in for a vendor behind a live rule, recording what it's sent."""
+
+    def __init__(self, body=b'live', status=200, headers=()):
+        self.body, self.status, self.headers = body, status, list(headers)
+        self.connections = 0
+        self.requests = []
+        upstream = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                upstream.connections += 1
+
+            def respond(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                upstream.requests.append((self.command, self.path, self.headers, self.rfile.read(length)))
+                self.send_response(upstream.status)
+                for name, value in upstream.headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(upstream.body)))
+                self.end_headers()
+                self.wfile.write(upstream.body)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
 
 
 class StormCloudMiddlewareTests(TestCase):
+    def setUp(self):
+        rule_table.clear()  # test transactions roll back without sending post_delete, so start from a fresh table
+
     def test_request_creates_rule_entry(self):
         self.assertEqual(Rule.objects.all().count(), 0)
 
         response = self.client.get('/stripe/post/')
+        rule_discovery.flush()  # normally done by the background writer
 
         self.assertEqual(Rule.objects.all().count(), 1)
 
@@ -217,3 +311,1398 @@ class StormCloudMiddlewareTests(TestCase):
         response = self.client.post(rule.path, test_payload)
         response_data = json.loads(response.content)  # response.json() won't work because it doesn't return as application/json
         self.assertEqual(response_data['form'], test_payload)
+
+
+class RuleTableTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def test_known_rule_served_without_queries(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response='unicycle cat', active=True)
+        RuleSubstitution.objects.create(rule=rule, find='unicycle', replace='toboggan', active=True)
+
+        self.client.get(rule.path)  # loads the table
+
+        with self.assertNumQueries(0):
+            response = self.client.get(rule.path)
+        self.assertEqual(response.content, b'toboggan cat')
+
+    def test_table_follows_response_changes(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='flat')
+        static = RuleResponse.objects.create(rule=rule, response='unicycle cat', active=True)
+        self.assertEqual(self.client.get(rule.path).content, b'unicycle cat')
+
+        static.response = 'tricycle ant'
+        static.save()
+        self.assertEqual(self.client.get(rule.path).content, b'tricycle ant')
+
+        static.delete()
+        self.assertEqual(self.client.get(rule.path).content, b'')
+
+    def test_table_follows_rule_changes(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='500')
+        self.assertEqual(self.client.get(rule.path).status_code, 500)
+
+        rule.path = '/stormcloud-moved/'
+        rule.save()
+        self.assertEqual(self.client.get('/stormcloud-moved/').status_code, 500)
+        self.assertEqual(rule_table.rules_for(None, '/stormcloud-test/', 'GET'), [])
+
+        rule.delete()
+        self.assertEqual(rule_table.rules_for(None, '/stormcloud-moved/', 'GET'), [])
+
+
+class RuleSnapshotTests(TestCase):
+    def setUp(self):
+        self.snapshot_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(STORMCLOUD_SNAPSHOT_PATH='%s/rules.snapshot' % self.snapshot_dir)
+        self.settings_override.enable()
+        rule_table.clear()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.snapshot_dir)
+
+    def test_worker_loads_snapshot_without_queries(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response='unicycle cat', active=True)
+        RuleResponse.objects.create(rule=rule, response='inactive', active=False)
+        get_snapshot().publish()
+        body_cache.clear()  # nothing decoded in this process yet, as in a fresh worker
+
+        worker = RuleTable()  # stands in for another process on the host
+        with self.assertNumQueries(0):
+            rules = worker.rules_for(None, rule.path, 'GET')
+            self.assertEqual(rules[0].flat_response, u'unicycle cat')  # the body came with the snapshot
+        self.assertEqual([r.pk for r in rules], [rule.pk])
+
+    def test_worker_swaps_on_version_bump(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='500')
+        snapshot = get_snapshot()
+        snapshot.publish()
+
+        worker = RuleTable()
+        self.assertEqual(worker.rules_for(None, rule.path, 'GET')[0].action, '500')
+        version = worker.version
+
+        rule.action = '503'
+        rule.save()  # on_commit never fires inside a TestCase, publish by hand
+        snapshot.publish()
+
+        self.assertEqual(snapshot.version(), version + 1)
+        self.assertEqual(worker.rules_for(None, rule.path, 'GET')[0].action, '503')
+        self.assertEqual(worker.version, version + 1)
+        self.assertEqual(self.client.get(rule.path).status_code, 503)
+
+    def test_readers_not_held_up_by_reload(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='500')
+        snapshot = get_snapshot()
+        snapshot.publish()
+        worker = RuleTable()
+        worker.ensure_loaded()
+
+        rule.action = '503'
+        rule.save()
+        snapshot.publish()
+        worker._loading.acquire()  # as if another thread were building the new table
+        try:
+            self.assertEqual(worker.rules_for(None, rule.path, 'GET')[0].action, '500')  # the old one, without waiting
+        finally:
+            worker._loading.release()
+        self.assertEqual(worker.rules_for(None, rule.path, 'GET')[0].action, '503')
+
+
+class LiveSessionTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        live_sessions.close()
+        self.upstream = StubUpstream()
+
+    def tearDown(self):
+        live_sessions.close()
+        self.upstream.stop()
+
+    def test_live_requests_reuse_upstream_connection(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='live',
+                                   live_url=self.upstream.url + '/stormcloud.txt')
+
+        for i in range(3):
+            self.assertEqual(self.client.get(rule.path).content, b'live')
+
+        self.assertEqual(len(self.upstream.requests), 3)
+        self.assertEqual(self.upstream.connections, 1)
+
+    def test_sessions_shared_per_upstream_host(self):
+        session = live_sessions.session_for('https://api.example.com/v1/charges')
+        self.assertIs(live_sessions.session_for('https://api.example.com/v1/refunds'), session)
+        self.assertIsNot(live_sessions.session_for('http://api.example.com/v1/charges'), session)
+        self.assertIsNot(live_sessions.session_for('https://other.example.com/v1/charges'), session)
+
+
+class LiveCacheTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        live_caches.clear()
+        self.upstream = StubUpstream()
+
+    def tearDown(self):
+        live_sessions.close()
+        self.upstream.stop()
+
+    def test_cached_live_rule_fetches_once_per_params(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='live',
+                                   live_url=self.upstream.url + '/catalog', live_cache_ttl=60)
+
+        for i in range(3):
+            self.assertEqual(self.client.get(rule.path, {'a': '1', 'b': '2'}).content, b'live')
+        self.assertEqual(self.client.get(rule.path, {'b': '2', 'a': '1'}).content, b'live')  # same params reordered
+        self.assertEqual(len(self.upstream.requests), 1)
+
+        self.client.get(rule.path, {'a': '2'})
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    def test_uncached_live_rule_always_fetches(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='live',
+                                   live_url=self.upstream.url + '/catalog')
+
+        self.client.get(rule.path)
+        self.client.get(rule.path)
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    def test_failed_upstream_response_not_cached(self):
+        self.upstream.status = 503
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='live',
+                                   live_url=self.upstream.url + '/catalog', live_cache_ttl=60)
+
+        self.assertEqual(self.client.get(rule.path).content, b'')
+        self.upstream.status = 200
+        self.assertEqual(self.client.get(rule.path).content, b'live')
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    def test_stale_entry_served_while_refreshing(self):
+        cache = LiveCache(ttl=60, size=10)
+        cache.get('key', lambda: ('old', True))
+        cache.entries['key'] = ('old', time.time() - 1)  # expire it
+
+        refreshed = threading.Event()
+
+        def refresh():
+            refreshed.set()
+            return 'new', True
+
+        self.assertEqual(cache.get('key', refresh), 'old')
+        self.assertTrue(refreshed.wait(5))
+        for i in range(50):  # the refresh stores its result just after fetching
+            if cache.entries['key'][0] == 'new':
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.get('key', refresh), 'new')
+
+    def test_concurrent_misses_coalesced(self):
+        cache = LiveCache(ttl=60, size=10)
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait(5)
+            return 'value', True
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key', fetch))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['value'] * 5)
+
+    def test_lru_eviction(self):
+        cache = LiveCache(ttl=60, size=2)
+        cache.get('a', lambda: ('a', True))
+        cache.get('b', lambda: ('b', True))
+        cache.get('a', lambda: ('a', True))  # a is now the most recently used
+        cache.get('c', lambda: ('c', True))
+        self.assertEqual(list(cache.entries), ['a', 'c'])
+
+
+class StreamingProxyTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        self.upstream = StubUpstream(body=b'created', status=201, headers=[('X-Vendor-Request', 'req_123')])
+
+    def tearDown(self):
+        live_sessions.close()
+        self.upstream.stop()
+
+    def test_proxy_forwards_verb_headers_and_body(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='PUT', action='proxy',
+                                   live_url=self.upstream.url + '/v1/charges')
+
+        response = self.client.put(rule.path + '?expand=customer', data=b'{"amount": 100}',
+                                   content_type='application/json', HTTP_X_API_KEY='sk_test')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), b'created')
+        self.assertEqual(response['X-Vendor-Request'], 'req_123')
+
+        method, path, headers, body = self.upstream.requests[0]
+        self.assertEqual(method, 'PUT')
+        self.assertEqual(path, '/v1/charges?expand=customer')
+        self.assertEqual(body, b'{"amount": 100}')
+        self.assertEqual(headers.get('X-Api-Key'), 'sk_test')
+        self.assertEqual(headers.get('Content-Type'), 'application/json')
+
+    def test_proxy_sends_only_client_headers(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='proxy',
+                                   live_url=self.upstream.url + '/v1/charges')
+
+        response = self.client.get(rule.path)  # no Accept-Encoding, User-Agent or Accept
+        self.assertEqual(b''.join(response.streaming_content), b'created')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        headers = self.upstream.requests[0][2]
+        self.assertIn(headers.get('Accept-Encoding'), (None, 'identity'))  # http.client's own "no coding, please"
+        self.assertIsNone(headers.get('User-Agent'))
+        self.assertIsNone(headers.get('Accept'))
+
+    def test_proxy_passes_redirects_through(self):
+        self.upstream.status = 302
+        self.upstream.headers = [('Location', 'https://vendor.example.com/elsewhere')]
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='proxy',
+                                   live_url=self.upstream.url + '/moved')
+
+        response = self.client.get(rule.path)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], 'https://vendor.example.com/elsewhere')
+        self.assertEqual(len(self.upstream.requests), 1)
+
+
+class SubstitutionTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def test_single_pass_substitution(self):
+        substituter = Substituter([('cat', 'dog'), ('dog', 'cat'), ('category', 'genre'), ('cat', 'ignored')])
+        self.assertEqual(substituter(u'cat dog category'), u'dog cat genre')  # swaps without chaining
+        self.assertEqual(substituter(b'cat dog category'), b'dog cat genre')
+
+    def test_streamed_substitution_matches_across_chunks(self):
+        substituter = Substituter([('unicycle', 'toboggan'), ('cat', 'llama'), ('catalog', 'index')])
+        body = b'unicycle cat catalog ' * 50
+        expected = substituter(body)
+        for size in (1, 3, 7, 8, 64, 1000):
+            chunks = [body[i:i + size] for i in range(0, len(body), size)]
+            self.assertEqual(b''.join(substituter.stream(chunks)), expected)
+
+    def test_no_substitutions_passes_through(self):
+        substituter = Substituter([])
+        self.assertFalse(substituter)
+        self.assertEqual(substituter(u'unicycle cat'), u'unicycle cat')
+        self.assertEqual(list(substituter.stream([b'a', b'b'])), [b'a', b'b'])
+
+    def test_compiled_substitutions_follow_changes(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response='unicycle cat', active=True)
+        substitute = RuleSubstitution.objects.create(rule=rule, find='unicycle', replace='toboggan', active=True)
+        self.assertEqual(self.client.get(rule.path).content, b'toboggan cat')
+
+        substitute.replace = 'sled'
+        substitute.save()
+        self.assertEqual(self.client.get(rule.path).content, b'sled cat')
+
+    def test_proxy_substitutes_streamed_body(self):
+        upstream = StubUpstream(body=b'<wsdl location="https://api.vendor.example.com/soap"/>' * 1000)
+        try:
+            rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='proxy',
+                                       live_url=upstream.url + '/service.wsdl')
+            RuleSubstitution.objects.create(rule=rule, find='https://api.vendor.example.com',
+                                            replace='http://stormcloud.local', active=True)
+
+            response = self.client.get(rule.path)
+            self.assertEqual(b''.join(response.streaming_content),
+                             b'<wsdl location="http://stormcloud.local/soap"/>' * 1000)
+            self.assertFalse(response.has_header('Content-Length'))
+        finally:
+            live_sessions.close()
+            upstream.stop()
+
+
+class ResponseSelectionTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def test_alias_table_follows_weights(self):
+        table = AliasTable([1, 0, 3])
+        rng = random.Random(1)
+        counts = [0, 0, 0]
+        for i in range(4000):
+            counts[table.sample(rng)] += 1
+        self.assertEqual(counts[1], 0)
+        self.assertTrue(800 < counts[0] < 1200)
+        self.assertTrue(2800 < counts[2] < 3200)
+
+    def test_all_zero_weights_choose_uniformly(self):
+        table = AliasTable([0, 0])
+        rng = random.Random(1)
+        self.assertEqual(set(table.sample(rng) for i in range(100)), set([0, 1]))
+
+    def test_every_active_response_is_chosen(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response='unicycle cat', active=True)
+        RuleResponse.objects.create(rule=rule, response='tricycle ant', active=True)
+        RuleResponse.objects.create(rule=rule, response='never', active=True, weight=0)
+
+        seen = set(self.client.get(rule.path).content for i in range(50))
+        self.assertEqual(seen, set([b'unicycle cat', b'tricycle ant']))
+
+    def test_seeded_selection_is_reproducible(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='302')
+        for i in range(5):
+            RuleResponse.objects.create(rule=rule, response='http://www.google%s.com' % i, active=True)
+
+        with override_settings(STORMCLOUD_RANDOM_SEED=1234):
+            reset_random()
+            first = [self.client.get(rule.path).url for i in range(20)]
+            reset_random()
+            second = [self.client.get(rule.path).url for i in range(20)]
+
+        self.assertEqual(first, second)
+        self.assertTrue(len(set(first)) > 1)
+
+
+class RuleDiscoveryTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        rule_discovery.flush()
+
+    def tearDown(self):
+        rule_discovery.flush()
+
+    def test_unknown_request_does_not_touch_database(self):
+        Rule.objects.create(hostname='testserver', path='/stormcloud-known/', verb='GET', action='500')
+        self.client.get('/stormcloud-known/')  # loads the table
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/stripe/post/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+
+    def test_discoveries_deduplicated_and_batched(self):
+        for i in range(3):
+            self.client.get('/stripe/post/')
+            self.client.post('/stripe/post/')
+            self.client.get('/stripe/charges/')
+
+        self.assertEqual(rule_discovery.flush(), 3)
+        self.assertEqual(sorted(Rule.objects.values_list('path', 'verb')),
+                         [('/stripe/charges/', 'GET'), ('/stripe/post/', 'GET'), ('/stripe/post/', 'POST')])
+
+        self.client.get('/stripe/post/')  # now known to the rule table, nothing more to discover
+        self.assertEqual(rule_discovery.flush(), 0)
+        self.assertEqual(Rule.objects.count(), 3)
+
+    def test_failed_batch_kept(self):
+        class LockedOnce(RuleDiscovery):
+            def write(self, batch):
+                if not hasattr(self, 'failed'):
+                    self.failed = True
+                    raise OperationalError('database is locked')
+                return super(LockedOnce, self).write(batch)
+
+        discovery = LockedOnce()
+        discovery.pending[(None, '/v1/charges', 'GET')] = dict(vendor=None, hostname='testserver', path='/v1/charges',
+                                                               verb='GET')
+        with self.assertRaises(OperationalError):
+            discovery.flush()
+        discovery.pending[(None, '/v1/refunds', 'GET')] = dict(vendor=None, hostname='testserver', path='/v1/refunds',
+                                                               verb='GET')  # discovered meanwhile
+        self.assertEqual(discovery.flush(), 2)
+        self.assertEqual(sorted(Rule.objects.values_list('path', flat=True)), ['/v1/charges', '/v1/refunds'])
+
+    def test_rule_created_meanwhile_is_not_duplicated(self):
+        self.client.get('/stripe/post/')
+        Rule.objects.create(hostname='testserver', path='/stripe/post/', verb='GET', action='500')
+
+        self.assertEqual(rule_discovery.flush(), 0)
+        self.assertEqual(Rule.objects.count(), 1)
+
+
+class RuleStatsTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        rule_stats.flush()
+
+    def test_hits_counted_in_memory_and_flushed(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='500')
+        self.client.get(rule.path)  # loads the table
+
+        with self.assertNumQueries(0):
+            for i in range(4):
+                self.client.get(rule.path)
+        self.assertFalse(RuleStats.objects.exists())
+
+        self.assertEqual(rule_stats.flush(), 1)
+        stats = RuleStats.objects.get(rule=rule)
+        self.assertEqual(stats.hits, 5)
+        self.assertEqual(stats.get_action_counts(), {'500': 5})
+        self.assertEqual(sum(stats.get_latency_histogram()), 5)
+        self.assertIsNotNone(stats.last_seen)
+        self.assertIsNotNone(stats.latency_p99_ms)
+
+        rule.action = '503'
+        rule.save()
+        self.client.get(rule.path)
+        rule_stats.flush()
+        stats = RuleStats.objects.get(rule=rule)
+        self.assertEqual(stats.hits, 6)
+        self.assertEqual(stats.get_action_counts(), {'500': 5, '503': 1})
+
+    def test_failed_counts_kept(self):
+        first = Rule.objects.create(hostname='testserver', path='/v1/first', verb='GET', action='500')
+        second = Rule.objects.create(hostname='testserver', path='/v1/second', verb='GET', action='500')
+
+        class LockedOnce(RuleStatsCollector):
+            def write(self, rule_pk, counter):
+                if rule_pk == first.pk and not hasattr(self, 'failed'):
+                    self.failed = True
+                    raise OperationalError('database is locked')
+                super(LockedOnce, self).write(rule_pk, counter)
+
+        collector = LockedOnce()
+        collector.record(first.pk, '500', 1.5)
+        collector.record(second.pk, '500', 1.5)
+        with self.assertRaises(OperationalError):
+            collector.flush()
+        self.assertEqual(RuleStats.objects.get(rule=second).hits, 1)  # the rest of the batch was still written
+
+        collector.record(first.pk, '503', 1.5)  # counted meanwhile
+        self.assertEqual(collector.flush(), 1)
+        stats = RuleStats.objects.get(rule=first)
+        self.assertEqual((stats.hits, stats.get_action_counts()), (2, {'500': 1, '503': 1}))
+
+    def test_latency_excludes_configured_delay(self):
+        rule = Rule.objects.create(hostname='testserver', path='/stormcloud-test/', verb='GET', action='500',
+                                   delay_ms=200)
+        self.client.get(rule.path)
+        rule_stats.flush()
+        self.assertTrue(RuleStats.objects.get(rule=rule).latency_p50_ms < 200)
+
+    def test_admin_sorts_by_hits(self):
+        quiet = Rule.objects.create(hostname='testserver', path='/stormcloud-quiet/', verb='GET', action='500')
+        busy = Rule.objects.create(hostname='testserver', path='/stormcloud-busy/', verb='GET', action='500')
+        for i in range(3):
+            rule_stats.record(busy.pk, '500', 1.5)
+        rule_stats.record(quiet.pk, '500', 1.5)
+        rule_stats.flush()
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get('/admin/rules/rule/', {'o': '-8'})  # hits, descending
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.context['cl'].result_list), [busy, quiet])
+
+
+class PatternRuleTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def test_parameter_captured_into_response(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response='{"id": "{{charge}}", "status": "failed"}', active=True)
+        RuleSubstitution.objects.create(rule=rule, find='failed', replace='refunded to {{charge}}', active=True)
+
+        response = self.client.get('/v1/charges/ch_123')
+        self.assertEqual(response.content, b'{"id": "ch_123", "status": "refunded to ch_123"}')
+        self.assertEqual(self.client.get('/v1/charges/ch_456').content,
+                         b'{"id": "ch_456", "status": "refunded to ch_456"}')
+
+    def test_exact_rule_takes_priority(self):
+        Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='500')
+        Rule.objects.create(hostname='testserver', path='/v1/charges/ch_123', verb='GET', action='404')
+
+        self.assertEqual(self.client.get('/v1/charges/ch_123').status_code, 404)
+        self.assertEqual(self.client.get('/v1/charges/ch_456').status_code, 500)
+
+    def test_pattern_rules_follow_changes(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='500')
+        self.assertEqual(self.client.get('/v1/charges/ch_123').status_code, 500)
+
+        rule.path = '/v1/refunds/{refund}'
+        rule.save()
+        self.assertEqual(rule_table.match(None, '/v1/charges/ch_123', 'GET'), [])
+        self.assertEqual(self.client.get('/v1/refunds/re_1').status_code, 500)
+
+        rule.delete()
+        self.assertEqual(rule_table.match(None, '/v1/refunds/re_1', 'GET'), [])
+        self.assertEqual(rule_table.tries, {})
+
+    def test_trie_specificity_and_backtracking(self):
+        rules = dict((path, Rule(pk=i, path=path)) for i, path in enumerate([
+            '/v1/customers/{customer}/cards/{card}',
+            '/v1/customers/{customer}/cards/default',
+            '/v1/customers/*/sources',
+            '/v1/customers/special/{anything}',
+            '/v1/files/**',
+        ]))
+        trie = PathTrie(rules.values())
+
+        def match(path):
+            return [(rule.path, params) for rule, params in trie.match(path)]
+
+        self.assertEqual(match('/v1/customers/cus_1/cards/card_9'),
+                         [('/v1/customers/{customer}/cards/{card}', {'customer': 'cus_1', 'card': 'card_9'})])
+        self.assertEqual(match('/v1/customers/cus_1/cards/default'),
+                         [('/v1/customers/{customer}/cards/default', {'customer': 'cus_1'})])
+        self.assertEqual(match('/v1/customers/cus_1/sources'), [('/v1/customers/*/sources', {})])
+        # 'special' is tried as a literal first, then backs up to the parameter branch
+        self.assertEqual(match('/v1/customers/special/cards/default'),
+                         [('/v1/customers/{customer}/cards/default', {'customer': 'special'})])
+        self.assertEqual(match('/v1/files/a/b/c.pdf'), [('/v1/files/**', {})])
+        self.assertEqual(match('/v1/customers//sources'), [])  # parameters and * need a non-empty segment
+        self.assertEqual(match('/v2/customers/cus_1/sources'), [])
+
+
+class ParameterMatchingTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        rule_discovery.flush()
+
+    def tearDown(self):
+        rule_discovery.flush()
+
+    def test_match_key_is_canonical(self):
+        rule = Rule.objects.create(path='/soap', verb='POST', match_params='currency=USD&operation=GetQuote')
+        self.assertEqual(len(rule.match_key), 40)
+        self.assertEqual(rule.match_key, match_key_for([('operation', 'GetQuote'), ('currency', 'USD')]))
+        self.assertEqual(Rule.objects.get(match_key=rule.match_key), rule)
+        self.assertEqual(Rule.objects.create(path='/soap').match_key, '')
+
+    def test_rules_chosen_by_form_query_and_json_parameters(self):
+        Rule.objects.create(hostname='testserver', path='/quote', verb='POST', action='200')
+        Rule.objects.create(hostname='testserver', path='/quote', verb='POST', action='500',
+                            match_params='operation=GetQuote')
+        Rule.objects.create(hostname='testserver', path='/quote', verb='POST', action='503',
+                            match_params='operation=GetQuote&currency=EUR')
+        Rule.objects.create(hostname='testserver', path='/quote', verb='POST', action='404',
+                            match_params='order.type=limit')
+
+        self.assertEqual(self.client.post('/quote', {'operation': 'GetQuote'}).status_code, 500)
+        self.assertEqual(self.client.post('/quote?currency=EUR', {'operation': 'GetQuote'}).status_code, 503)
+        self.assertEqual(self.client.post('/quote', {'operation': 'Cancel'}).status_code, 200)
+        self.assertEqual(self.client.post('/quote?operation=GetQuote').status_code, 500)
+        self.assertEqual(self.client.post('/quote', json.dumps({'order': {'type': 'limit'}}),
+                                          content_type='application/json').status_code, 404)
+        self.assertEqual(self.client.post('/quote', json.dumps({'order': {'type': 'market'}}),
+                                          content_type='application/json').status_code, 200)
+
+    def test_pattern_rules_match_parameters(self):
+        Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='500')
+        Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='402',
+                            match_params='expand=customer')
+
+        self.assertEqual(self.client.get('/v1/charges/ch_1', {'expand': 'customer'}).status_code, 402)
+        self.assertEqual(self.client.get('/v1/charges/ch_1').status_code, 500)
+
+    def test_unmatched_parameters_discover_fallback_rule(self):
+        rule = Rule.objects.create(hostname='testserver', path='/quote', verb='GET', action='500',
+                                   match_params='operation=GetQuote')
+        self.assertEqual(self.client.get('/quote', {'operation': 'GetQuote'}).status_code, 500)
+
+        self.assertEqual(self.client.get('/quote', {'operation': 'Cancel'}).status_code, 200)
+        self.assertEqual(rule_discovery.flush(), 1)
+        fallback = Rule.objects.exclude(pk=rule.pk).get()
+        self.assertEqual((fallback.path, fallback.match_params, fallback.match_key), ('/quote', '', ''))
+        self.assertEqual(self.client.get('/quote', {'operation': 'GetQuote'}).status_code, 500)
+
+
+class VendorLookupTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        self.middleware = StormCloudMiddleware(get_response=None)
+
+    def test_base_url_split(self):
+        self.assertEqual(split_base_url('http://LocalHost:8000/stripe/'), ('localhost', '/stripe'))
+        self.assertEqual(split_base_url('api.stripe.com'), ('api.stripe.com', ''))
+
+    def test_longest_prefix_wins(self):
+        host = Vendor.objects.create(name='Anything on localhost', base_url='localhost')
+        stripe = Vendor.objects.create(name='Stripe', base_url='localhost/stripe')
+        connect = Vendor.objects.create(name='Stripe Connect', base_url='localhost/stripe/connect')
+
+        self.assertEqual(self.middleware.vendor_lookup('localhost', '/stripe/v1/charges'), stripe)
+        self.assertEqual(self.middleware.vendor_lookup('localhost', '/stripe/connect/accounts'), connect)
+        self.assertEqual(self.middleware.vendor_lookup('localhost', '/stripeish/'), host)
+        self.assertEqual(self.middleware.vendor_lookup('localhost', '/'), host)
+        self.assertIsNone(self.middleware.vendor_lookup('example.com', '/stripe/v1/charges'))
+
+    def test_rules_scoped_to_vendor(self):
+        stripe = Vendor.objects.create(name='Stripe', base_url='testserver/stripe')
+        twilio = Vendor.objects.create(name='Twilio', base_url='testserver/twilio')
+        Rule.objects.create(vendor=stripe, path='/stripe/health', verb='GET', action='500')
+        Rule.objects.create(vendor=twilio, path='/twilio/health', verb='GET', action='503')
+
+        self.assertEqual(self.client.get('/stripe/health').status_code, 500)
+        self.assertEqual(self.client.get('/twilio/health').status_code, 503)
+
+        twilio.base_url = 'elsewhere/twilio'  # the index follows vendor changes
+        twilio.save()
+        self.assertIsNone(self.middleware.vendor_lookup('testserver', '/twilio/health'))
+
+    def test_matched_on_host_header(self):
+        self.assertEqual(request_host({'HTTP_HOST': 'API.Example.com:8443', 'SERVER_NAME': 'localhost'}),
+                         'api.example.com')
+        self.assertEqual(request_host({'HTTP_HOST': '[::1]:8000'}), '[::1]')
+        self.assertEqual(request_host({'SERVER_NAME': 'localhost'}), 'localhost')
+
+        vendor = Vendor.objects.create(name='Example', base_url='api.example.com')
+        Rule.objects.create(vendor=vendor, path='/v1/health', verb='GET', action='503')
+        # as curl -H 'Host: api.example.com' against runserver on localhost, say
+        self.assertEqual(self.client.get('/v1/health', HTTP_HOST='api.example.com:8000').status_code, 503)
+
+        rule_discovery.flush()
+        self.client.get('/v1/thing', HTTP_HOST='api.example.com')
+        rule_discovery.flush()
+        self.assertEqual(list(Rule.objects.filter(path='/v1/thing').values_list('hostname', 'vendor')),
+                         [('api.example.com', vendor.pk)])
+
+    def test_duplicate_vendors_do_not_raise(self):
+        first = Vendor.objects.create(name='First', base_url='localhost')
+        Vendor.objects.create(name='Second', base_url='localhost')
+        self.assertEqual(self.middleware.vendor_lookup('localhost', '/'), first)
+
+
+class RuleConstraintTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def test_duplicate_rules_rejected(self):
+        vendor = Vendor.objects.create(name='Stripe', base_url='api.stripe.com')
+        Rule.objects.create(vendor=vendor, path='/v1/charges', verb='GET')
+        Rule.objects.create(path='/v1/charges', verb='GET')
+        Rule.objects.create(path='/v1/charges', verb='GET', match_params='expand=customer')
+
+        for duplicate in (dict(vendor=vendor), dict()):
+            with transaction.atomic(), self.assertRaises(IntegrityError):
+                Rule.objects.create(path='/v1/charges', verb='GET', **duplicate)
+
+    def test_discovery_get_or_create(self):
+        self.assertTrue(rule_discovery.get_or_create(Rule(path='/v1/charges', verb='GET')))
+        self.assertFalse(rule_discovery.get_or_create(Rule(path='/v1/charges', verb='GET')))
+        self.assertEqual(Rule.objects.count(), 1)
+
+
+class TemplateLearningTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        rule_discovery.flush()
+
+    def tearDown(self):
+        rule_discovery.flush()
+
+    def test_identifier_segments_become_parameters(self):
+        self.assertEqual(template_for('/v1/orders/12345/items/67'), '/v1/orders/{id}/items/{id2}')
+        self.assertEqual(template_for('/files/123e4567-e89b-12d3-a456-426614174000/download'),
+                         '/files/{uuid}/download')
+        self.assertEqual(template_for('/sessions/9f86d081884c7d659a2feaa0c55ad015'), '/sessions/{token}')
+        self.assertEqual(template_for('/v1/charges/ch_1AbCdEfGhIjK/refund'), '/v1/charges/{id}/refund')
+        self.assertEqual(template_for('/v1/charges/'), '/v1/charges/')
+        self.assertEqual(template_for('/v2/api/'), '/v2/api/')
+        self.assertEqual(template_for('/api/get_products'), '/api/get_products')
+
+    def test_high_cardinality_segments_collapse(self):
+        paths = ['/users/%s/profile' % name for name in ('alice', 'bob', 'carol')] + ['/users/me/settings']
+        templates = learn_templates(paths, threshold=3)
+        self.assertEqual(templates['/users/alice/profile'], '/users/{param}/profile')
+        self.assertEqual(templates['/users/bob/profile'], '/users/{param}/profile')
+        self.assertEqual(templates['/users/me/settings'], '/users/me/settings')
+
+        self.assertEqual(learn_templates(paths, threshold=4)['/users/alice/profile'], '/users/alice/profile')
+
+    def test_discovery_creates_template_rules(self):
+        with override_settings(STORMCLOUD_DISCOVERY_TEMPLATES=True):
+            for order in range(20):
+                self.client.get('/v1/orders/%s' % (1000 + order))
+            self.assertEqual(rule_discovery.flush(), 1)
+            self.assertEqual(list(Rule.objects.values_list('path', flat=True)), ['/v1/orders/{id}'])
+
+            self.client.get('/v1/orders/99999')  # matched by the pattern rule now
+            self.assertEqual(rule_discovery.flush(), 0)
+
+    def test_compact_rules_command(self):
+        for order in range(3):
+            Rule.objects.create(hostname='testserver', path='/v1/orders/%s' % order, verb='GET')
+        for name in ('alice', 'bob', 'carol'):
+            Rule.objects.create(hostname='testserver', path='/users/%s' % name, verb='GET')
+        configured = Rule.objects.create(hostname='testserver', path='/v1/orders/42', verb='POST', action='500')
+        Rule.objects.create(hostname='testserver', path='/v1/orders/', verb='GET')
+
+        out = StringIO()
+        call_command('compact_rules', threshold=3, dry_run=True, stdout=out)
+        self.assertEqual(Rule.objects.count(), 8)
+
+        call_command('compact_rules', threshold=3, stdout=out)
+        self.assertEqual(sorted(Rule.objects.values_list('path', 'verb')),
+                         [('/users/{param}', 'GET'), ('/v1/orders/', 'GET'), ('/v1/orders/42', 'POST'),
+                          ('/v1/orders/{id}', 'GET')])
+        self.assertTrue(Rule.objects.filter(pk=configured.pk).exists())
+        self.assertEqual(rule_table.match(None, '/v1/orders/77', 'GET')[0][0].path, '/v1/orders/{id}')
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+
+    def tearDown(self):
+        rule_discovery.flush()
+        live_sessions.close()
+
+    def test_every_action_measured(self):
+        results = run_benchmarks(requests=3, table_sizes=(5,), response_sizes=(64,), substitution_counts=(0, 2))
+        self.assertEqual(list(results), ['301 rules=5', '302 rules=5', '500 rules=5', 'unknown rules=5'] +
+                         ['%s rules=5 body=64 subs=%s' % (action, subs) for action in ('flat', 'live', 'proxy')
+                          for subs in (0, 2)])
+        for result in results.values():
+            self.assertEqual(result['requests'], 3)
+            self.assertTrue(result['rps'] > 0 and 0 < result['p50_ms'] <= result['p99_ms'])
+
+    def test_body_contains_finds(self):
+        body = make_body(100, 3)
+        self.assertEqual(len(body), 100)
+        self.assertTrue(all('needle%s' % i in body for i in range(3)))
+
+    def test_regressions_past_tolerance(self):
+        baseline = {'flat': {'rps': 1000.0, 'p50_ms': 1.0, 'p99_ms': 2.0}}
+        self.assertEqual(compare({'flat': {'rps': 900.0, 'p50_ms': 1.1, 'p99_ms': 2.2}}, baseline, 0.25), [])
+        self.assertEqual(len(compare({'flat': {'rps': 500.0, 'p50_ms': 1.1, 'p99_ms': 3.0}}, baseline, 0.25)), 2)
+        self.assertEqual(compare({'new': {'rps': 1.0, 'p50_ms': 9.0, 'p99_ms': 9.0}}, baseline, 0.25), [])
+
+
+class TrafficCaptureTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        self.directory = tempfile.mkdtemp()
+        self.path = '%s/capture.jsonl' % self.directory
+
+    def tearDown(self):
+        rule_discovery.flush()
+        shutil.rmtree(self.directory)
+
+    def capture(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges', verb='POST', action='402')
+        with override_settings(STORMCLOUD_CAPTURE_PATH=self.path):
+            self.client.post('/v1/charges?expand=customer', {'amount': '100'})
+            self.client.get('/v1/unknown')
+            self.client.get('/admin/')
+            self.assertEqual(traffic_capture.flush(), 2)
+        return rule
+
+    def test_requests_recorded(self):
+        rule = self.capture()
+        charge, unknown = read_capture(self.path)
+
+        self.assertEqual((charge['host'], charge['path'], charge['verb']), ('testserver', '/v1/charges', 'POST'))
+        self.assertEqual(charge['params'], {'get': {'expand': ['customer']}, 'post': {'amount': ['100']}})
+        self.assertEqual((charge['rule'], charge['status']), (rule.pk, 402))
+        self.assertEqual(len(charge['body_sha1']), 40)
+        self.assertTrue(charge['body_length'] > 0)
+        self.assertEqual((unknown['path'], unknown['rule'], unknown['body_sha1']), ('/v1/unknown', None, None))
+        self.assertTrue(unknown['ts'] >= charge['ts'])
+
+    def test_replay(self):
+        rule = self.capture()
+        upstream = StubUpstream(body=b'ok')
+        try:
+            report = Replay(read_capture(self.path), upstream.url, speed=0, concurrency=2).run()
+        finally:
+            upstream.stop()
+
+        self.assertEqual((report['requests'], report['errors']), (2, 0))
+        self.assertEqual(sorted(report['rules']), ['GET /v1/unknown', 'rule %s' % rule.pk])
+        self.assertTrue(report['rules']['rule %s' % rule.pk]['p99_ms'] > 0)
+
+        sent = dict((path, (command, headers['Host'], body)) for command, path, headers, body in upstream.requests)
+        self.assertEqual(sent['/v1/charges?expand=customer'], ('POST', 'testserver', b'amount=100'))
+        self.assertEqual(sent['/v1/unknown'][:2], ('GET', 'testserver'))
+
+    def test_replay_matches_captured_vendors(self):
+        for name, host in (('Stripe', 'api.stripe.com'), ('Twilio', 'api.twilio.com')):
+            vendor = Vendor.objects.create(name=name, base_url=host)
+            Rule.objects.create(vendor=vendor, path='/v1/health', verb='GET', action='503' if name == 'Stripe' else '502')
+        with override_settings(STORMCLOUD_CAPTURE_PATH=self.path):
+            self.client.get('/v1/health', HTTP_HOST='api.stripe.com:443')
+            self.client.get('/v1/health', HTTP_HOST='api.twilio.com')
+            traffic_capture.flush()
+        records = read_capture(self.path)
+        self.assertEqual([record['host'] for record in records], ['api.stripe.com', 'api.twilio.com'])
+
+        statuses = []
+        for record in records:  # as one StormCloud instance would receive them from the replay
+            method, url, kwargs = build_request(record, 'http://localhost:8000')
+            statuses.append(self.client.generic(method, url[len('http://localhost:8000'):],
+                                                HTTP_HOST=kwargs['headers']['Host']).status_code)
+        self.assertEqual(statuses, [503, 502])
+
+
+profiled = []
+
+
+@contextlib.contextmanager
+def recording_profiler(request):
+    profiled.append(request.META['PATH_INFO'])
+    yield
+
+
+class ServerTimingTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        del profiled[:]
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges', verb='GET', action='flat', delay_ms=5)
+        RuleResponse.objects.create(rule=rule, response='declined')
+        RuleSubstitution.objects.create(rule=rule, find='declined', replace='approved')
+
+    def test_header_only_when_enabled(self):
+        self.assertNotIn('Server-Timing', self.client.get('/v1/charges'))
+
+        with override_settings(STORMCLOUD_SERVER_TIMING=True):
+            response = self.client.get('/v1/charges')
+        self.assertEqual(response.content, b'approved')
+        phases = OrderedDict(entry.split(';dur=') for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(list(phases), ['vendor', 'rule', 'delay', 'select', 'render', 'total'])
+        self.assertTrue(float(phases['delay']) >= 5)
+        self.assertTrue(float(phases['total']) >= float(phases['delay']))
+
+    def test_phases_add_up(self):
+        timer = PhaseTimer()
+        timer.add('upstream', 0.001)
+        timer.add('upstream', 0.002)
+        self.assertTrue(timer.header().startswith('upstream;dur=3.000, total;dur='))
+
+    def test_profiler_sampled(self):
+        with override_settings(STORMCLOUD_PROFILE_RATE=1, STORMCLOUD_PROFILER='rules.tests.recording_profiler'):
+            self.client.get('/v1/charges')
+            self.client.get('/v1/charges')
+        with override_settings(STORMCLOUD_PROFILE_RATE=0, STORMCLOUD_PROFILER='rules.tests.recording_profiler'):
+            self.client.get('/v1/charges')
+        self.assertEqual(profiled, ['/v1/charges', '/v1/charges'])
+
+    def test_cprofile_hook_writes_stats(self):
+        directory = tempfile.mkdtemp()
+        try:
+            with override_settings(STORMCLOUD_PROFILE_RATE=1, STORMCLOUD_PROFILE_DIR=directory):
+                self.assertEqual(self.client.get('/v1/charges').content, b'approved')
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(pstats.Stats(os.path.join(directory, files[0])).total_calls > 0)
+        finally:
+            shutil.rmtree(directory)
+
+
+class _Collect(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.events = []
+
+    def emit(self, record):
+        self.events.append(record.event)
+
+
+class RequestLoggingTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        self.collect = _Collect()
+        request_logger.addHandler(self.collect)
+
+    def tearDown(self):
+        request_logger.removeHandler(self.collect)
+        rule_discovery.flush()
+
+    def test_one_event_per_request(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges/{charge}', verb='GET', action='503')
+        self.client.get('/v1/charges/ch_1')
+        self.client.get('/admin/')
+
+        event, = self.collect.events
+        self.assertEqual((event['path'], event['verb'], event['rule'], event['action'], event['status']),
+                         ('/v1/charges/ch_1', 'GET', rule.pk, '503', 503))
+        self.assertEqual(event['params'], {'charge': 'ch_1'})
+        self.assertEqual(event['sample_rate'], 1.0)
+
+    def test_sample_rates_by_rule_then_vendor(self):
+        vendor = Vendor.objects.create(name='Stripe', base_url='testserver', log_sample_rate=0)
+        Rule.objects.create(vendor=vendor, path='/quiet', verb='GET', action='200')
+        Rule.objects.create(vendor=vendor, path='/loud', verb='GET', action='200', log_sample_rate=1)
+        for _ in range(3):
+            self.client.get('/quiet')
+            self.client.get('/loud')
+        self.assertEqual([event['path'] for event in self.collect.events], ['/loud'] * 3)
+
+        with override_settings(STORMCLOUD_LOG_SAMPLE_RATE=0):
+            self.client.get('/v1/unknown')
+        self.assertEqual(len(self.collect.events), 3)
+
+    def test_queue_handler_writes_json_lines(self):
+        stream = StringIO()
+        handler = QueueStreamHandler(stream)
+        handler.setFormatter(JSONFormatter())
+        logger = logging.getLogger('stormcloud.tests.queue')
+        logger.addHandler(handler)
+        try:
+            logger.warning("upstream %s slow", 'api.stripe.com', extra={'event': {'ms': 12.5}})
+            handler.flush_queue()
+        finally:
+            logger.removeHandler(handler)
+
+        entry = json.loads(stream.getvalue())
+        self.assertEqual((entry['level'], entry['message'], entry['ms']),
+                         ('WARNING', 'upstream api.stripe.com slow', 12.5))
+
+
+class FastPathTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        self.application = StormCloudApplication(WSGIHandler())
+
+    def tearDown(self):
+        rule_discovery.flush()
+
+    def call(self, request):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, dict(headers)
+
+        response = self.application(request.environ, start_response)
+        content = b''.join(response)
+        response.close()
+        return started['status'], started['headers'], content
+
+    def test_mocks_skip_django(self):
+        Rule.objects.create(hostname='testserver', path='/v1/charges', verb='GET', action='503')
+        status, headers, content = self.call(RequestFactory().get('/v1/charges'))
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertNotIn('X-Frame-Options', headers)  # Django's middleware never saw it
+
+        status, headers, content = self.call(RequestFactory().get('/v1/unknown'))
+        self.assertEqual((status, content), ('200 OK', b''))
+        self.assertEqual(rule_discovery.flush(), 1)
+
+    def test_admin_and_rules_without_action_go_to_django(self):
+        status, headers, content = self.call(RequestFactory().get('/admin/'))
+        self.assertEqual(status, '302 Found')
+        self.assertIn('X-Frame-Options', headers)
+
+        Rule.objects.create(hostname='testserver', path='/v1/charges', verb='POST', match_params='amount=100')
+        request = RequestFactory().post('/v1/charges', {'amount': '100'})
+        status, headers, content = self.call(request)
+        self.assertEqual(status, '404 Not Found')
+        self.assertIn('X-Frame-Options', headers)
+        self.assertIn(b'name="amount"', request.environ['wsgi.input'].getvalue())  # a copy left for Django to read
+
+    def test_proxied_body_not_buffered(self):
+        upstream = StubUpstream(body=b'stored')
+        self.addCleanup(upstream.stop)
+        self.addCleanup(live_sessions.close)
+        Rule.objects.create(hostname='testserver', path='/v1/files', verb='POST', action='proxy',
+                            live_url=upstream.url + '/v1/files')
+
+        request = RequestFactory().post('/v1/files', b'x' * 100000, content_type='application/octet-stream')
+        self.assertTrue(self.application.mocks(request))
+        self.assertFalse(hasattr(request, '_body'))  # still unread, for the proxy to stream
+
+        status, headers, content = self.call(RequestFactory().post('/v1/files', b'x' * 100000,
+                                                                   content_type='application/octet-stream'))
+        self.assertEqual((status, content), ('200 OK', b'stored'))
+        self.assertEqual(upstream.requests[0][3], b'x' * 100000)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='stormcloud-media-'))
+class FileBodyTests(TestCase):
+    body = b''.join(b'%05d ' % i for i in range(2000))
+
+    def setUp(self):
+        rule_table.clear()
+        self.rule = Rule.objects.create(hostname='testserver', path='/v1/reports/{report}', verb='GET', action='flat')
+        self.response = RuleResponse(rule=self.rule)
+        self.response.body_file.save('report.txt', ContentFile(self.body))
+
+    def tearDown(self):
+        self.response.body_file.delete(save=False)
+
+    def test_served_from_disk(self):
+        response = self.client.get('/v1/reports/r_1')
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), self.body)
+        self.assertEqual((response['Content-Length'], response['Content-Type'], response['Accept-Ranges']),
+                         (str(len(self.body)), 'text/plain', 'bytes'))
+
+    def test_ranges(self):
+        response = self.client.get('/v1/reports/r_1', HTTP_RANGE='bytes=6-11')
+        self.assertEqual((response.status_code, response['Content-Range']), (206, 'bytes 6-11/12000'))
+        self.assertEqual(b''.join(response.streaming_content), b'00001 ')
+
+        response = self.client.get('/v1/reports/r_1', HTTP_RANGE='bytes=-6')
+        self.assertEqual(b''.join(response.streaming_content), b'01999 ')
+
+        response = self.client.get('/v1/reports/r_1', HTTP_RANGE='bytes=12000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */12000'))
+
+        response = self.client.get('/v1/reports/r_1', HTTP_RANGE='bytes=0-1,5-6')  # sent whole
+        self.assertEqual((response.status_code, len(b''.join(response.streaming_content))), (200, len(self.body)))
+
+    def test_substituted_while_streaming(self):
+        with open(self.response.body_file.path, 'ab') as f:
+            f.write(b'{{report}}')
+        RuleSubstitution.objects.create(rule=self.rule, find='01999', replace='last')
+        response = self.client.get('/v1/reports/r_1', HTTP_RANGE='bytes=0-5')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content)[-15:], b'last {{report}}')
+
+
+class ResponseBodyStoreTests(TestCase):
+    wsdl = '<definitions name="Payments">%s</definitions>' % ('<message name="charge"/>' * 200)
+
+    def setUp(self):
+        rule_table.clear()
+        body_cache.clear()
+
+    def test_bodies_are_shared_and_compressed(self):
+        first = Rule.objects.create(hostname='testserver', path='/v1/first', verb='GET', action='flat')
+        second = Rule.objects.create(hostname='testserver', path='/v1/second', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=first, response=self.wsdl)
+        RuleResponse.objects.create(rule=second, response=self.wsdl)
+        RuleResponse.objects.create(rule=second, response='', active=False)
+
+        body, = ResponseBody.objects.all()
+        self.assertEqual((body.encoding, body.size), ('zlib', len(self.wsdl)))
+        self.assertLess(len(body.data), len(self.wsdl) / 10)
+
+        body_cache.clear()
+        self.assertEqual(self.client.get('/v1/second').content, self.wsdl.encode('utf-8'))
+        self.assertEqual(body_cache.get(body.digest), self.wsdl)  # decoded once, kept for the next hit
+
+    def test_table_serves_bodies_without_queries(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/wsdl', verb='GET', action='flat')
+        RuleResponse.objects.create(rule=rule, response=self.wsdl)
+        body_cache.clear()
+
+        with override_settings(STORMCLOUD_BODY_CACHE_SIZE=100):  # too small to ever hold the body
+            self.client.get('/v1/wsdl')  # loads the table, bodies with it
+            with self.assertNumQueries(0):
+                for _ in range(2):
+                    self.assertEqual(self.client.get('/v1/wsdl').content, self.wsdl.encode('utf-8'))
+
+    def test_table_bodies_held_to_cache_size(self):
+        bodies = {}
+        for n in range(5):
+            rule = Rule.objects.create(hostname='testserver', path='/v1/wsdl/%s' % n, verb='GET', action='flat')
+            bodies[rule.path] = self.wsdl.replace('Payments', 'Payments%s' % n)
+            RuleResponse.objects.create(rule=rule, response=bodies[rule.path])
+        body_cache.clear()
+
+        with override_settings(STORMCLOUD_BODY_CACHE_SIZE=len(self.wsdl) * 2 + 10):  # room for two of them
+            self.client.get('/v1/wsdl/0')  # loads the table, bodies with it
+            with self.assertNumQueries(0):
+                for _ in range(2):
+                    for path, body in sorted(bodies.items()):
+                        self.assertEqual(self.client.get(path).content, body.encode('utf-8'))
+            self.assertLessEqual(body_cache.size, body_cache.capacity)
+        self.assertEqual(len(body_cache.bodies), 2)
+
+    def test_cache_drops_least_recently_used(self):
+        with override_settings(STORMCLOUD_BODY_CACHE_SIZE=10):
+            body_cache.put('a', 'aaaa', 4)
+            body_cache.put('b', 'bbbb', 4)
+            body_cache.get('a')
+            body_cache.put('c', 'cccc', 4)
+            body_cache.put('d', 'd' * 11, 11)  # bigger than the whole cache
+        self.assertEqual((list(body_cache.bodies), body_cache.size), (['a', 'c'], 8))
+
+    def test_edits_and_pruning(self):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/errors', verb='GET', action='flat')
+        response = RuleResponse.objects.create(rule=rule, response='{"error": "card_declined"}')
+        response.response = '{"error": "expired_card"}'
+        response.save()
+        self.assertEqual(RuleResponse.objects.get(pk=response.pk).response, '{"error": "expired_card"}')
+
+        out = StringIO()
+        call_command('prune_response_bodies', stdout=out)
+        self.assertIn('Deleted 1 unused bodies', out.getvalue())
+        self.assertEqual(ResponseBody.objects.get().digest, response.body_id)
+
+
+class ContentEncodingTests(TestCase):
+    body = '{"error": {"type": "card_error", "code": "card_declined"}, "retry": false}' * 20
+
+    def setUp(self):
+        rule_table.clear()
+        body_cache.clear()
+        self.rule = Rule.objects.create(hostname='testserver', path='/v1/charges', verb='POST', action='flat')
+        self.response = RuleResponse.objects.create(rule=self.rule, response=self.body)
+
+    def test_stored_variants_negotiated(self):
+        stored = ResponseBody.objects.get()
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(bytes(stored.gzip))).read(), self.body.encode('utf-8'))
+
+        self.client.post('/v1/charges', HTTP_ACCEPT_ENCODING='gzip')
+        with self.assertNumQueries(0):  # the variants were loaded with the rule table
+            response = self.client.post('/v1/charges', HTTP_ACCEPT_ENCODING='br;q=0.9, gzip, deflate')
+        self.assertEqual((response['Content-Encoding'], response['Vary']), ('gzip', 'Accept-Encoding'))
+        self.assertEqual(response.content, bytes(stored.gzip))
+
+        response = self.client.post('/v1/charges', HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, self.body.encode('utf-8'))
+
+        response = self.client.post('/v1/charges')
+        self.assertFalse(response.has_header('Vary'))
+
+    def test_stored_variant_used_from_cold_cache(self):
+        stored = ResponseBody.objects.get()
+        body_cache.clear()
+        with override_settings(STORMCLOUD_BODY_CACHE_SIZE=100):  # too small to hold the body
+            self.client.post('/v1/charges')  # loads the table
+            with self.assertNumQueries(0):
+                response = self.client.post('/v1/charges', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.streaming)  # the stored variant, not gzipped again
+        self.assertEqual(response.content, bytes(stored.gzip))
+
+    def test_substituted_bodies_streamed_compressed(self):
+        RuleSubstitution.objects.create(rule=self.rule, find='card_declined', replace='expired_card')
+        response = self.client.post('/v1/charges', HTTP_ACCEPT_ENCODING='*')
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.GzipFile(fileobj=io.BytesIO(b''.join(response.streaming_content))).read()
+        self.assertEqual(content, self.body.replace('card_declined', 'expired_card').encode('utf-8'))
+
+    def test_ranked_encodings(self):
+        self.assertEqual(ranked_encodings('gzip, br', ('br', 'gzip')), ['br', 'gzip'])
+        self.assertEqual(ranked_encodings('gzip;q=1.0, br;q=0.5', ('br', 'gzip')), ['gzip', 'br'])
+        self.assertEqual(ranked_encodings('*;q=0.1, gzip;q=0', ('br', 'gzip')), ['br'])
+        self.assertEqual(ranked_encodings('identity', ('br', 'gzip')), [])
+
+    def test_substituted_proxy_encoded_again(self):
+        upstream = StubUpstream(body=gzip_bytes(self.body.encode('utf-8')), headers=[('Content-Encoding', 'gzip')])
+        try:
+            rule = Rule.objects.create(hostname='testserver', path='/v1/refunds', verb='GET', action='proxy',
+                                       live_url=upstream.url + '/v1/refunds')
+            RuleSubstitution.objects.create(rule=rule, find='card_error', replace='api_error')
+            response = self.client.get('/v1/refunds', HTTP_ACCEPT_ENCODING='gzip')
+            content = gzip.GzipFile(fileobj=io.BytesIO(b''.join(response.streaming_content))).read()
+        finally:
+            live_sessions.close()
+            upstream.stop()
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(content, self.body.replace('card_error', 'api_error').encode('utf-8'))
+
+
+class PacedResponseTests(TestCase):
+    body = 'x' * 300
+
+    def setUp(self):
+        rule_table.clear()
+
+    def create_rule(self, action, **fields):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/documents', verb='GET', action=action, **fields)
+        RuleResponse.objects.create(rule=rule, response=self.body)
+        return rule
+
+    def test_chunks(self):
+        chunks = list(paced_chunks([b'a' * 250, b'b' * 100], bytes_per_second=1000, cut_at=[120]))
+        self.assertEqual([len(chunk) for chunk in chunks], [100, 20, 100, 30, 100])
+        self.assertEqual(b''.join(chunks), b'a' * 250 + b'b' * 100)
+
+    def test_throttle(self):
+        self.create_rule('throttle', throttle_bps=1000)
+        started = time.time()
+        response = self.client.get('/v1/documents')
+        chunks = list(response.streaming_content)
+        self.assertGreaterEqual(time.time() - started, 0.2)  # the last of three chunks is due after 200ms
+        self.assertEqual((len(chunks), b''.join(chunks)), (3, self.body.encode('utf-8')))
+
+    def test_truncate(self):
+        self.create_rule('truncate', fault_after_bytes=120)
+        response = self.client.get('/v1/documents')
+        self.assertEqual(response['Content-Length'], '300')
+        received = []
+        with self.assertRaises(TruncatedResponse):
+            for chunk in response.streaming_content:
+                received.append(chunk)
+        self.assertEqual(len(b''.join(received)), 120)
+
+    def test_stall_paced_by_server(self):
+        self.create_rule('stall', stall_ms=5000)
+        started = time.time()
+        response = self.client.get('/v1/documents', **{SERVER_PACES: True})
+        chunks = list(response.streaming_content)
+        self.assertLess(time.time() - started, 1)  # the waiting is left to the server
+        self.assertEqual([len(chunk) for chunk in chunks], [150, 150])
+
+        pacer = response.wsgi_request.META[PACER]
+        pacer.sent = 0
+        self.assertEqual(pacer.wait(150), 0)
+        self.assertGreater(pacer.wait(150), 4.9)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        rule_table.clear()
+        limit_table.clear()
+        self.addCleanup(limit_table.clear)
+
+    def create_rule(self, vendor=None, **fields):
+        rule = Rule.objects.create(hostname='testserver', path='/v1/charges', verb='GET', action='flat',
+                                   vendor=vendor, **fields)
+        RuleResponse.objects.create(rule=rule, response='{"id": 1}')
+        return rule
+
+    def test_rate_limit(self):
+        self.create_rule(rate_limit=0.5, rate_burst=2)
+        self.assertEqual([self.client.get('/v1/charges').status_code for _ in range(3)], [200, 200, 429])
+        response = self.client.get('/v1/charges')
+        self.assertEqual(response['Retry-After'], '2')  # a token every 2 seconds
+
+    def test_max_in_flight(self):
+        self.create_rule(max_in_flight=1)
+        middleware = StormCloudMiddleware(get_response=None)
+        factory = RequestFactory()
+        held = middleware(factory.get('/v1/charges'))  # still being sent
+        self.assertEqual(middleware(factory.get('/v1/charges')).status_code, 503)
+        held.close()  # sent, so its place is given back
+        self.assertEqual(middleware(factory.get('/v1/charges')).status_code, 200)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp(prefix='stormcloud-media-'))
+    def test_in_flight_released_by_file_wrapper(self):
+        rule = self.create_rule(max_in_flight=2)
+        response = RuleResponse(rule=rule)
+        response.body_file.save('charge.json', ContentFile(b'{"id": "ch_1"}'))
+        self.addCleanup(response.body_file.delete, save=False)
+        RuleResponse.objects.exclude(pk=response.pk).delete()
+
+        def serve(application):
+            """A request as gunicorn or uWSGI would serve it, sending the file through wsgi.file_wrapper."""
+            started = []
+            environ = dict(RequestFactory().get('/v1/charges').environ, **{'wsgi.file_wrapper': FileWrapper})
+            result = application(environ, lambda status, headers, exc_info=None: started.append(status))
+            content = b''.join(result)
+            result.close()
+            return started[0], content
+
+        for application in (StormCloudApplication(WSGIHandler()), WSGIHandler()):  # and with the fast path off
+            self.assertEqual([serve(application) for _ in range(4)], [('200 OK', b'{"id": "ch_1"}')] * 4)
+
+    def test_vendor_limit(self):
+        vendor = Vendor.objects.create(name='Stripe', base_url='testserver', rate_limit=1, rate_burst=2)
+        self.create_rule(vendor=vendor, rate_limit=0.5)
+        customers = Rule.objects.create(hostname='testserver', path='/v1/customers', verb='GET', action='flat',
+                                        vendor=vendor)
+        RuleResponse.objects.create(rule=customers, response='{"object": "list"}')
+        self.assertEqual(self.client.get('/v1/charges').status_code, 200)
+        self.assertEqual(self.client.get('/v1/charges').status_code, 429)  # over the rule's limit, not the vendor's
+        self.assertEqual(self.client.get('/v1/customers').status_code, 200)  # so that didn't use a vendor token
+        self.assertEqual(self.client.get('/v1/customers').status_code, 429)  # the vendor's limit covers every rule
+
+    def test_shared_between_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        key = limit_key(RULE, 1)
+        with override_settings(STORMCLOUD_LIMITS_PATH=os.path.join(directory, 'limits')):
+            other = LimitTable()  # as another worker would have it
+            self.addCleanup(other.clear)
+            self.assertEqual(limit_table.acquire(key, max_in_flight=1), (None, None))
+            self.assertEqual(other.acquire(key, max_in_flight=1), (503, 1))
+            limit_table.release(key)
+            self.assertEqual(other.acquire(key, max_in_flight=1), (None, None))
+
+
+@skipIf(six.PY2, "stormcloud.asgi is Python 3 only")
+class ASGIHandlerTests(TestCase):
+    def setUp(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from stormcloud.asgi import ASGIHandler
+
+        rule_table.clear()
+        rule_table.ensure_loaded()  # here, the worker thread's connection can't see this test's rules
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        executor = ThreadPoolExecutor(max_workers=1)  # one thread, so a delay waited out on it would hold up the next
+        self.addCleanup(executor.shutdown)
+        self.environs = []
+        self.handler = ASGIHandler(self.echo, executor)
+
+    def echo(self, environ, start_response):
+        self.environs.append(environ)
+        start_response(str('201 Created'), [(str('Content-Type'), str('text/plain')),
+                                            (str('X-Echo'), environ.get('HTTP_X_ECHO', ''))])
+        return [environ['wsgi.input'].read()]
+
+    def scope(self, path='/v1/charges', headers=()):
+        return {'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'live=false', 'http_version': '1.1',
+                'server': ('127.0.0.1', 8000), 'client': ('10.0.0.1', 50000), 'headers': list(headers)}
+
+    def resolved(self, value):
+        future = self.loop.create_future()
+        future.set_result(value)
+        return future
+
+    def request(self, scope, body=b''):
+        """The coroutine handling one request, and the list of messages it sends."""
+        sent = []
+
+        def send(message):
+            sent.append(message)
+            return self.resolved(None)
+
+        return self.handler(scope, lambda: self.resolved({'type': 'http.request', 'body': body}), send), sent
+
+    def test_delay_waited_on_event_loop(self):
+        Rule.objects.create(hostname='testserver', path='/v1/charges', verb='POST', action='flat', delay_ms=300)
+
+        (first, _), (second, _) = self.request(self.scope()), self.request(self.scope())
+        started = time.time()
+        self.loop.run_until_complete(self.asyncio.gather(first, second, loop=self.loop))
+        elapsed = time.time() - started
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 0.55)  # both delays at once, neither holding the only worker thread
+        self.assertEqual([environ.get(DELAY_SERVED) for environ in self.environs], [True, True])
+
+    def test_body_and_headers_pass_through(self):
+        handling, sent = self.request(self.scope(headers=[(b'x-echo', b'hello'), (b'content-type', b'application/json')]),
+                                      body=b'{"amount": 100}')
+        self.loop.run_until_complete(handling)
+        self.assertEqual(sent[0], {'type': 'http.response.start', 'status': 201,
+                                   'headers': [(b'content-type', b'text/plain'), (b'x-echo', b'hello')]})
+        self.assertEqual(b''.join(message.get('body', b'') for message in sent[1:]), b'{"amount": 100}')
+        self.assertEqual(sent[-1], {'type': 'http.response.body', 'body': b''})
+        self.assertEqual(self.environs[0]['CONTENT_TYPE'], 'application/json')
+
+    def test_build_environ(self):
+        environ = self.handler.build_environ(self.scope(path='/v1/caf\xe9', headers=[
+            (b'host', b'api.example.com:8443'), (b'accept', b'text/html'), (b'accept', b'*/*'), (b'content-length', b'4'),
+        ]), b'body')
+        self.assertEqual((environ['REQUEST_METHOD'], environ['PATH_INFO'], environ['QUERY_STRING']),
+                         ('POST', '/v1/caf\xc3\xa9', 'live=false'))
+        self.assertEqual((environ['SERVER_NAME'], environ['SERVER_PORT']), ('api.example.com', '8443'))
+        self.assertEqual((environ['HTTP_ACCEPT'], environ['CONTENT_LENGTH']), ('text/html,*/*', '4'))
+        self.assertEqual((environ['REMOTE_ADDR'], environ['SERVER_PROTOCOL']), ('10.0.0.1', 'HTTP/1.1'))
+        self.assertEqual(environ['wsgi.input'].read(), b'body')
+
+        environ = self.handler.build_environ(self.scope(), b'')  # no Host header, the server's address then
+        self.assertEqual((environ['SERVER_NAME'], environ['SERVER_PORT']), ('127.0.0.1', '8000'))
+
+    def test_truncated_before_first_byte(self):
+        def cut(environ, start_response):
+            start_response(str('200 OK'), [(str('Content-Length'), str('300'))])
+            return paced_chunks([b'x' * 300], truncate_at=0)
+
+        self.handler.wsgi_application = cut
+        handling, sent = self.request(self.scope())
+        self.loop.run_until_complete(handling)
+        # the headers promised a body that never comes: no end of the response, so the server drops the connection
+        self.assertEqual(sent, [{'type': 'http.response.start', 'status': 200, 'headers': [(b'content-length', b'300')]}])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import cProfile
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class _Phase(object):
+    __slots__ = ('timer', 'name', 'started')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.timer.add(self.name, default_timer() - self.started)
+
+
+class PhaseTimer(object):
+    """Where one request's time went - vendor lookup, rule lookup, response selection, rendering (substitutions), the
+    configured delay, the upstream fetch - reported in a Server-Timing header when STORMCLOUD_SERVER_TIMING is on."""
+
+    enabled = True
+
+    def __init__(self):
+        self.started = default_timer()
+        self.phases = OrderedDict()  # name -> seconds
+
+    def phase(self, name):
+        """Context manager timing a block as the named phase, adding up if the phase is entered more than once."""
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def header(self):
+        phases = list(self.phases.items()) + [('total', default_timer() - self.started)]
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000.0) for name, seconds in phases)
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class NullTimer(object):
+    """Stands in for PhaseTimer when Server-Timing is off, at the cost of an empty with block per phase."""
+
+    enabled = False
+    _phase = _NullPhase()
+
+    def phase(self, name):
+        return self._phase
+
+    def add(self, name, seconds):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def start_timer():
+    return PhaseTimer() if getattr(settings, 'STORMCLOUD_SERVER_TIMING', False) else NULL_TIMER
+
+
+_sampling = random.Random()  # separate from the response selection one, so profiling doesn't change a seeded run
+_hooks = {}
+_hooks_lock = threading.Lock()
+
+
+def profiler_for(request):
+    """The context manager to profile this request in, for STORMCLOUD_PROFILE_RATE of requests, or None.
+
+    STORMCLOUD_PROFILER is the dotted path to a callable taking the request and returning that context manager, so any
+    profiler can be attached (see cprofile_hook for an example)."""
+    rate = getattr(settings, 'STORMCLOUD_PROFILE_RATE', 0)
+    if not rate or _sampling.random() >= rate:
+        return None
+
+    path = getattr(settings, 'STORMCLOUD_PROFILER', 'rules.timing.cprofile_hook')
+    hook = _hooks.get(path)
+    if hook is None:
+        with _hooks_lock:
+            hook = _hooks[path] = import_string(path)
+    return hook(request)
+
+
+@contextmanager
+def cprofile_hook(request):
+    """Profiles the request with cProfile and writes the stats to STORMCLOUD_PROFILE_DIR (the temp directory if unset),
+    one .prof file per request for pstats or snakeviz."""
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        directory = getattr(settings, 'STORMCLOUD_PROFILE_DIR', None) or tempfile.gettempdir()
+        path = os.path.join(directory, 'stormcloud-%s-%s-%s.prof' % (int(time.time() * 1000), os.getpid(),
+                                                                   threading.current_thread().ident))
+        profile.dump_stats(path)
+        logger.debug("Profile of %s %s written to %s", request.META['REQUEST_METHOD'], request.META['PATH_INFO'], path)
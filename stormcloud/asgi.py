@@ -0,0 +1,183 @@
+"""
+ASGI config for stormcloud project.
+
+It exposes the ASGI callable as a module-level variable named ``application``, run it with any ASGI 3 server, e.g.
+``uvicorn stormcloud.asgi:application``. Python 3 only.
+
+Django 1.11 has no ASGI support of its own, so requests are still answered by the WSGI application from stormcloud.wsgi
+on a thread pool. What this buys over stormcloud.wsgi is that a rule's delay_ms is waited out with asyncio.sleep on the
+event loop before a thread is involved at all, and so are the gaps in a throttled or stalled response, so thousands of
+delayed and trickling responses can be pending at once without exhausting the worker pool.
+"""
+
+import asyncio
+import io
+import os
+import sys
+
+from django.core.handlers.wsgi import WSGIRequest
+from django.http.request import split_domain_port
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "stormcloud.settings")
+
+from stormcloud.wsgi import application as wsgi_application  # noqa: E402 - mock traffic skips Django, see dispatch
+from rules.faults import PACER, SERVER_PACES, TruncatedResponse  # noqa: E402 - needs the apps loaded
+from rules.matching import RequestParameters  # noqa: E402
+from rules.router import request_host  # noqa: E402
+from stormcloud.middleware import DELAY_SERVED, StormCloudMiddleware  # noqa: E402
+
+_END = object()
+
+
+class ASGIHandler(object):
+    """Adapts an ASGI 3 server to a WSGI application, waiting out StormCloud delays asynchronously first."""
+
+    def __init__(self, wsgi_application, executor=None):
+        self.wsgi_application = wsgi_application
+        self.executor = executor  # None is the event loop's default thread pool
+        self.stormcloud = StormCloudMiddleware(get_response=None)  # only used for delay_for()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError("StormCloud can't handle ASGI %s connections" % scope['type'])
+
+        body = await self.read_body(receive)
+        environ = self.build_environ(scope, body)
+        loop = asyncio.get_event_loop()
+
+        # the delay may depend on the request's parameters, read from a copy of the body the application never sees
+        parameters = RequestParameters(WSGIRequest(dict(environ, **{'wsgi.input': io.BytesIO(body)})))
+        delay_ms = await loop.run_in_executor(self.executor, self.stormcloud.delay_for, request_host(environ),
+                                              environ['PATH_INFO'], environ['REQUEST_METHOD'], parameters)
+        if delay_ms:
+            await asyncio.sleep(delay_ms / 1000.0)
+            environ[DELAY_SERVED] = True
+
+        environ[SERVER_PACES] = True
+        status, headers, chunks = await loop.run_in_executor(self.executor, self.start_wsgi, environ)
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        pacer = environ.get(PACER)  # a throttled or stalled response, its gaps are waited out here
+        try:
+            while True:
+                try:
+                    chunk = await loop.run_in_executor(self.executor, next, chunks, _END)
+                except TruncatedResponse:
+                    return  # without finishing the response, so the server drops the connection
+                if chunk is _END:
+                    break
+                if chunk:
+                    wait = pacer.wait(len(chunk)) if pacer is not None else 0
+                    if wait:
+                        await asyncio.sleep(wait)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(chunks, 'close'):
+                await loop.run_in_executor(self.executor, chunks.close)
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                break
+        return body
+
+    def build_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+            'QUERY_STRING': scope['query_string'].decode('ascii'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope['http_version'],
+            'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin1')
+            if name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            elif name == 'content-type':
+                key = 'CONTENT_TYPE'
+            else:
+                key = 'HTTP_%s' % name.upper().replace('-', '_')
+            value = value.decode('latin1')
+            if key in environ:
+                value = '%s,%s' % (environ[key], value)
+            environ[key] = value
+        # the host the client asked for, as a WSGI server would give it - rules and vendors are matched on it
+        host, port = split_domain_port(environ.get('HTTP_HOST', ''))
+        if host:
+            environ['SERVER_NAME'] = host
+            environ['SERVER_PORT'] = port or ('443' if environ['wsgi.url_scheme'] == 'https' else '80')
+        return environ
+
+    def start_wsgi(self, environ):
+        """Runs the WSGI application up to the point the status and headers are known, on a worker thread."""
+        started = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin1'), value.encode('latin1'))
+                                  for name, value in response_headers]
+
+        result = self.wsgi_application(environ, start_response)
+        chunks = iter(result)
+        try:
+            first = next(chunks, _END)  # the status may only be known once the first chunk is produced
+        except TruncatedResponse:  # cut off before its first byte, __call__ drops the connection after the headers
+            return started['status'], started['headers'], _prepend(b'', _truncated(), result)
+        if first is not _END:
+            chunks = _prepend(first, chunks, result)
+        elif hasattr(result, 'close'):
+            chunks = _prepend(b'', chunks, result)
+        return started['status'], started['headers'], chunks
+
+
+def _truncated():
+    raise TruncatedResponse("Response cut off before it started")
+    yield  # a generator, so the error is raised when the first chunk is asked for
+
+
+class _prepend(object):
+    def __init__(self, first, rest, result):
+        self.first, self.rest, self.result = first, rest, result
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.first is not None:
+            first, self.first = self.first, None
+            return first
+        return next(self.rest)
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+application = ASGIHandler(wsgi_application)
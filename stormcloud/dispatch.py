@@ -0,0 +1,100 @@
+"""
+A WSGI application answering mocked requests straight from the compiled rule table, handing everything else - the
+admin, static files and requests for rules without an action - to the regular Django application.
+
+Mock traffic skips URL resolution, the rest of the middleware stack (sessions, CSRF, auth, messages) and the
+request_started / request_finished signals, none of which apply to a vendor's API. StormCloudMiddleware itself still
+does the work, so stats, Server-Timing, traffic capture and request logging behave the same either way.
+"""
+import io
+
+from django.conf import settings
+from django.core.handlers.exception import response_for_exception
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import connections
+from django.urls import set_script_prefix
+from django.utils.encoding import force_str
+
+from rules.files import ClosingFile
+from rules.timing import start_timer
+from stormcloud.middleware import StormCloudMiddleware
+
+
+def _not_mocked(request):
+    raise AssertionError("Requests StormCloud doesn't mock are dispatched to Django before reaching the middleware")
+
+
+def close_old_connections():
+    """What Django's request_started and request_finished receivers do, for the thread's open database connections
+    only - a mock only opens one when the rule table has to be loaded, so this is usually nothing at all. Connections in
+    a transaction (a test's) are left alone, as the test client does."""
+    for connection in connections.all():
+        if connection.connection is not None and not connection.in_atomic_block:
+            connection.close_if_unusable_or_obsolete()
+
+
+class MockResult(object):
+    """The WSGI iterable for a mock: the response's content, closed without sending request_finished."""
+
+    def __init__(self, response):
+        self.response = response
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        for closable in self.response._closable_objects:
+            try:
+                closable.close()
+            except Exception:
+                pass
+        self.response.closed = True
+        close_old_connections()
+
+
+class StormCloudApplication(object):
+    """Routes each request either to StormCloudMiddleware alone or to the full Django application, converting the
+    middleware's response to WSGI the same way django.core.handlers.wsgi.WSGIHandler does."""
+
+    def __init__(self, django_application):
+        self.django_application = django_application
+        self.stormcloud = StormCloudMiddleware(get_response=_not_mocked)
+        self.django_prefixes = tuple(prefix for prefix in ('/admin/', settings.STATIC_URL) if prefix)
+
+    def mocks(self, request):
+        """Whether StormCloud answers this request itself rather than leaving it to Django. The vendor and rule found
+        are kept on the request for the middleware, so they're only looked up once. The body is only read if a rule
+        matches on its fields (see RequestParameters), otherwise it's left for the proxy to stream or Django to read."""
+        if request.path_info.startswith(self.django_prefixes):
+            return False
+        request.stormcloud_timer = start_timer()
+        try:
+            vendor, rule, params = self.stormcloud.lookup(request)
+        except Exception:
+            return True  # the middleware runs into it again, and it's answered with a 500 like any other error
+        return rule is None or bool(rule.action)  # unknown URLs are discovered and answered with a blank response
+
+    def __call__(self, environ, start_response):
+        request = WSGIRequest(environ)
+        close_old_connections()
+        if not self.mocks(request):
+            if hasattr(request, '_body'):
+                environ['wsgi.input'] = io.BytesIO(request._body)
+                environ['CONTENT_LENGTH'] = str(len(request._body))
+            return self.django_application(environ, start_response)
+
+        set_script_prefix(request.META.get('SCRIPT_NAME') or '/')
+        try:
+            response = self.stormcloud(request)
+        except Exception as e:
+            response = response_for_exception(request, e)
+
+        status = '%d %s' % (response.status_code, response.reason_phrase)
+        response_headers = [(str(name), str(value)) for name, value in response.items()]
+        for cookie in response.cookies.values():
+            response_headers.append((str('Set-Cookie'), str(cookie.output(header=''))))
+        start_response(force_str(status), response_headers)
+        result = MockResult(response)
+        if getattr(response, 'file_to_stream', None) is not None and environ.get('wsgi.file_wrapper'):
+            return environ['wsgi.file_wrapper'](ClosingFile(response.file_to_stream, result), response.block_size)
+        return result
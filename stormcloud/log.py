@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.utils.six.moves import queue
+
+from rules.router import request_host
+
+request_logger = logging.getLogger('stormcloud.requests')
+
+
+class QueueStreamHandler(logging.StreamHandler):
+    """A StreamHandler that only queues records on the calling thread - formatting and writing them happens on a
+    background thread, so a slow console or pipe never holds up a request. Python 2 has no QueueHandler of its own.
+
+    When more than capacity records are waiting new ones are dropped rather than blocking, and a count of how many is
+    written once there's room again."""
+
+    def __init__(self, stream=None, capacity=10000):
+        logging.StreamHandler.__init__(self, stream)
+        self.queue = queue.Queue(maxsize=capacity)
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._run, name='stormcloud-log-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if self.dropped:  # not locked, the count is only ever approximate
+                dropped, self.dropped = self.dropped, 0
+                logging.StreamHandler.emit(self, logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "Dropped %s log records, the log writer couldn't keep up", 'args': (dropped,)}))
+            logging.StreamHandler.emit(self, record)
+            self.queue.task_done()
+
+    def flush_queue(self, timeout=5.0):
+        """Waits (up to timeout seconds) until everything queued so far has been written."""
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.005)
+        self.flush()
+
+    def close(self):
+        self.flush_queue()
+        logging.StreamHandler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger and message, plus whatever was passed in extra={'event': {...}}."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'event', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=lambda value: '%s' % value)
+
+
+_sampling = random.Random()  # separate from the response selection one, so logging doesn't change a seeded run
+
+
+def sample_rate(vendor, rule):
+    """The fraction of requests to log: the rule's log_sample_rate, else its vendor's, else
+    STORMCLOUD_LOG_SAMPLE_RATE."""
+    for configured in (rule, vendor):
+        rate = getattr(configured, 'log_sample_rate', None)
+        if rate is not None:
+            return rate
+    return getattr(settings, 'STORMCLOUD_LOG_SAMPLE_RATE', 1.0)
+
+
+def log_request(request, response, elapsed_ms):
+    """Logs one structured line for a request StormCloud handled, if it's sampled. Nothing is formatted here, that's
+    left to the handler (see QueueStreamHandler)."""
+    if not request_logger.isEnabledFor(logging.INFO):
+        return
+    vendor = getattr(request, 'stormcloud_vendor', None)
+    rule = getattr(request, 'stormcloud_rule', None)
+    rate = sample_rate(vendor, rule)
+    if rate <= 0 or (rate < 1 and _sampling.random() >= rate):
+        return
+
+    request_logger.info('request', extra={'event': {
+        'host': request_host(request.META),
+        'path': request.META['PATH_INFO'],
+        'verb': request.META['REQUEST_METHOD'],
+        'vendor': vendor.pk if vendor is not None else None,
+        'rule': rule.pk if rule is not None else None,
+        'action': rule.action if rule is not None else None,
+        'params': getattr(request, 'stormcloud_params', None) or None,
+        'status': response.status_code,
+        'ms': round(elapsed_ms, 3),
+        'delayed_ms': getattr(request, 'stormcloud_delayed_ms', 0),
+        'sample_rate': rate,
+    }})
@@ -1,99 +1,261 @@
 import logging
+import os
 import time
+from timeit import default_timer
 
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect, StreamingHttpResponse
+from django.utils.encoding import force_bytes
 
-from rules.models import Rule
-from vendors.models import Vendor
+from rules.capture import traffic_capture
+from rules.discovery import rule_discovery
+from rules.encoding import body_response, compressing, gzip_stream, ranked_encodings
+from rules.faults import paced_response
+from rules.files import ClosingFile, file_response, iter_file
+from rules.limits import check_limits
+from rules.live import RequestBody, iter_upstream, live_sessions, request_headers, response_headers
+from rules.matching import RequestParameters
+from rules.router import request_host
+from rules.models import PACED_ACTIONS
+from rules.stats import rule_stats
+from rules.table import rule_table
+from rules.timing import NULL_TIMER, profiler_for, start_timer
+from stormcloud.log import log_request
 
 logger = logging.getLogger(__name__)
 
+# set in the WSGI environ by stormcloud.asgi once it has waited out a rule's delay_ms on the event loop
+DELAY_SERVED = 'stormcloud.delay_served'
+
 
 class StormCloudMiddleware(object):
     def __init__(self, get_response):
         self.get_response = get_response
         # One-time configuration and initialization.
 
-    def vendor_lookup(self, server_name):
-        """Currently goes off of hostname ONLY, but ideally the path could be a component, particularly when the
-        hostname is localhost. However, since it's stored on the vendor as a complete base_url including a hostname..."""
-        vendors = Vendor.objects.filter(base_url=server_name)
-        if vendors.count() > 1:
-            logger.error("More than one vendor found for hostname %s", server_name)
-            raise Exception("More than one vendor for hostname %s" % server_name)
-
-        return vendors.first()
+    def vendor_lookup(self, hostname, path='/'):
+        """The vendor whose base_url has the request's hostname and the longest prefix of its path, so several vendors
+        can share a hostname (localhost/stripe, localhost/twilio). Where vendors share a base_url the oldest wins."""
+        vendors = rule_table.vendors_for(hostname, path)
+        if len(vendors) > 1:
+            logger.error("More than one vendor found for hostname %s / path %s, using %s", hostname, path,
+                         vendors[0])
 
-    def rule_lookup(self, vendor, path, verb):
-        lookup_kwargs = {}
-        if vendor:
-            lookup_kwargs['vendor__in'] = vendor
+        return vendors[0] if vendors else None
 
-        lookup_kwargs['path'] = path
-        lookup_kwargs['verb'] = verb
+    def rule_match(self, vendor, path, verb, parameters=None):
+        """Served from the compiled rule table, so a known rule costs no database queries. Returns the rule (or None)
+        and the parameters captured from the path if it matched a pattern rule. Rules with match_params only match if
+        the request's parameters (a RequestParameters) are given and have those values."""
+        matches = rule_table.match(vendor, path, verb, parameters)
 
-        rules = Rule.objects.filter(**lookup_kwargs)
-
-        if rules.count() > 1:
+        if len(matches) > 1:
             logger.error("More than one rule for path %s / vendor %s", path, vendor)
             raise Exception("More than one rule for path %s / vendor %s" % (path, vendor))
 
-        return rules.first()
+        return matches[0] if matches else (None, {})
+
+    def rule_lookup(self, vendor, path, verb, parameters=None):
+        return self.rule_match(vendor, path, verb, parameters)[0]
+
+    def delay_for(self, hostname, path, verb, parameters=None):
+        """The delay_ms a request would be held for, so the ASGI handler can wait it out with asyncio.sleep before a
+        worker thread gets involved. None if the request won't be delayed."""
+        if path.startswith('/admin/'):
+            return None
+
+        rule = self.rule_lookup(vendor=self.vendor_lookup(hostname, path), path=path, verb=verb,
+                                parameters=parameters)
+        if rule and rule.action:
+            return rule.delay_ms
+
+    def lookup(self, request):
+        """(vendor, rule, parameters captured from the path) for a request, looked up once - stormcloud.dispatch does
+        it before the request gets here, to decide whether Django needs to see it at all."""
+        if not hasattr(request, 'stormcloud_match'):
+            timer = getattr(request, 'stormcloud_timer', NULL_TIMER)
+            with timer.phase('vendor'):
+                vendor = self.vendor_lookup(request_host(request.META), request.META['PATH_INFO'])
+            with timer.phase('rule'):
+                rule, params = self.rule_match(vendor=vendor, path=request.META['PATH_INFO'],
+                                               verb=request.META['REQUEST_METHOD'],
+                                               parameters=RequestParameters(request))
+            request.stormcloud_match = (vendor, rule, params)
+        return request.stormcloud_match
+
+    def proxy_response(self, rule, request):
+        """Streams the request through to the rule's live_url and the upstream response back, chunk by chunk."""
+        if not rule.live_url:
+            return HttpResponse('')
+
+        url = rule.live_url
+        if request.META.get('QUERY_STRING'):
+            url += ('&' if '?' in url else '?') + request.META['QUERY_STRING']
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+
+        with getattr(request, 'stormcloud_timer', NULL_TIMER).phase('upstream'):  # until the upstream's headers
+            upstream = live_sessions.stream(request.META['REQUEST_METHOD'], url, headers=request_headers(request.META),
+                                            body=RequestBody(request, length) if length else None)
+
+        substituter = rule.get_substituter()
+        if substituter:  # substitutions need the decoded body, and change its length
+            content = substituter.stream(iter_upstream(upstream, decode_content=True))
+            skip_headers = ('content-encoding', 'content-length')
+        else:
+            content = iter_upstream(upstream)
+            skip_headers = ()
+
+        response = StreamingHttpResponse(content, status=upstream.status_code, reason=upstream.reason)
+        del response['Content-Type']  # only send what the upstream did
+        for name, value in response_headers(upstream):
+            if name.lower() not in skip_headers:
+                response[name] = value
+        if substituter and upstream.headers.get('Content-Encoding') and compressing(request) and \
+                ranked_encodings(request.META['HTTP_ACCEPT_ENCODING'], ('gzip',)):
+            return gzip_stream(response, content)  # encoded again, as the upstream sent it
+        return response
 
     def __call__(self, request):
+        started = default_timer()
+        mocked = not request.META['PATH_INFO'].startswith('/admin/')
+        captured = traffic_capture.start(request) if mocked else None
+        if not hasattr(request, 'stormcloud_timer'):
+            request.stormcloud_timer = start_timer()
+        timer = request.stormcloud_timer
+
+        profiler = profiler_for(request)
+        try:
+            if profiler is not None:
+                with profiler:
+                    response = self.handle(request)
+            else:
+                response = self.handle(request)
+        except Exception:
+            if hasattr(request, 'stormcloud_in_flight'):
+                request.stormcloud_in_flight.close()
+            raise
+        if hasattr(request, 'stormcloud_in_flight'):  # held until the last byte is sent
+            response._closable_objects.append(request.stormcloud_in_flight)
+            if getattr(response, 'file_to_stream', None) is not None:  # may be sent by wsgi.file_wrapper instead
+                response.file_to_stream = ClosingFile(response.file_to_stream, request.stormcloud_in_flight)
+
+        rule = getattr(request, 'stormcloud_rule', None)
+        if rule is not None:  # StormCloud's own time, not counting the delay it was configured to add
+            elapsed_ms = (default_timer() - started) * 1000.0 - getattr(request, 'stormcloud_delayed_ms', 0)
+            rule_stats.record(rule.pk, rule.action or 'django', elapsed_ms)
+        if captured is not None:
+            traffic_capture.finish(captured, rule, response)
+        if timer.enabled:
+            response['Server-Timing'] = timer.header()
+        if mocked:
+            log_request(request, response, (default_timer() - started) * 1000.0)
+
+        return response
+
+    def handle(self, request):
         # Code to be executed for each request before
         # the view (and later middleware) are called.
 
+        timer = getattr(request, 'stormcloud_timer', NULL_TIMER)
+
         # bypass for Django admin
         if request.META['PATH_INFO'].startswith('/admin/'):
-            logger.debug("StormCloud Ignoring Admin URL %s" % request.META['PATH_INFO'])
+            logger.debug("StormCloud Ignoring Admin URL %s", request.META['PATH_INFO'])
             return self.get_response(request)  # act normally / return to Django
 
-        logger.info("StormCloud received request to\n URL: %s \n Hostname: %s \n Verb: %s",
-                        request.META['PATH_INFO'], request.META['SERVER_NAME'], request.META['REQUEST_METHOD'])
-        vendor = self.vendor_lookup(request.META['SERVER_NAME'])
-        logger.debug("  Determined vendor as %s" % vendor)
-        rule = self.rule_lookup(vendor=vendor, path=request.META['PATH_INFO'], verb=request.META['REQUEST_METHOD'])
+        hostname = request_host(request.META)
+        logger.debug("StormCloud received request to\n URL: %s \n Hostname: %s \n Verb: %s",
+                        request.META['PATH_INFO'], hostname, request.META['REQUEST_METHOD'])
+        vendor, rule, params = self.lookup(request)
+        request.stormcloud_vendor = vendor
+        logger.debug("  Determined vendor as %s", vendor)
+
+        limited = check_limits(request, vendor, rule)
+        if limited is not None:
+            logger.debug("  Over the rate limit or in-flight cap for URL %s, answering %s",
+                         request.META['PATH_INFO'], limited.status_code)
+            return limited
 
         if not rule:  # nothing found
-            # go ahead and create one with what we know
-            rule = Rule.objects.create(vendor=vendor, hostname=request.META['SERVER_NAME'], path=request.META['PATH_INFO'],
-                                       verb=request.META['REQUEST_METHOD'])
-            logger.info("  No rule was found for URL %s / Vendor %s / Hostname %s / Verb %s, one was created.",
-                        request.META['PATH_INFO'], vendor, request.META['SERVER_NAME'], request.META['REQUEST_METHOD'])
+            # go ahead and create one with what we know - written behind, so this request doesn't wait on the database
+            rule_discovery.enqueue(vendor=vendor, hostname=hostname, path=request.META['PATH_INFO'],
+                                   verb=request.META['REQUEST_METHOD'])
+            logger.debug("  No rule was found for URL %s / Vendor %s / Hostname %s / Verb %s, one will be created.",
+                        request.META['PATH_INFO'], vendor, hostname, request.META['REQUEST_METHOD'])
             return HttpResponse("")  # blank response initially
 
-        # todo: some better reading of GET/POST parameters to make rules more fine-grained, may require architectural changes
-        # str(request.GET.dict())
-        # str(request.POST.dict())
+        request.stormcloud_rule = rule
+        request.stormcloud_params = params
+        if params:
+            logger.debug("  Matched pattern rule %s with parameters %s", rule.path, params)
 
         if not rule.action:
-            logger.info("  No action was found for URL %s / Vendor %s / Hostname %s / Verb %s, passing request to Django to handle.",
-                        request.META['PATH_INFO'], vendor, request.META['SERVER_NAME'], request.META['REQUEST_METHOD'])
-            return self.get_response(request)  # act normally / return to Django
+            logger.debug("  No action was found for URL %s / Vendor %s / Hostname %s / Verb %s, passing request to Django to handle.",
+                        request.META['PATH_INFO'], vendor, hostname, request.META['REQUEST_METHOD'])
+            with timer.phase('django'):
+                return self.get_response(request)  # act normally / return to Django
 
         # was a delay requested?
-        if rule.delay_ms:
-            logger.info("  StormCloud initiating %s ms delay", rule.delay_ms)
-            time.sleep(rule.delay_ms / 1000.0)  # convert ms to expected seconds
+        if rule.delay_ms and request.META.get(DELAY_SERVED):
+            logger.debug("  StormCloud %s ms delay was already served by the ASGI handler", rule.delay_ms)
+            timer.add('delay', rule.delay_ms / 1000.0)
+        elif rule.delay_ms:
+            logger.debug("  StormCloud initiating %s ms delay", rule.delay_ms)
+            with timer.phase('delay'):
+                time.sleep(rule.delay_ms / 1000.0)  # convert ms to expected seconds
+            request.stormcloud_delayed_ms = rule.delay_ms
 
         if rule.action == 'flat':
-            logger.info("  StormCloud returning flat response.")
-            return HttpResponse(rule.flat_response)
+            with timer.phase('select'):
+                chosen = rule.choose_response()
+            logger.debug("  StormCloud returning flat response %s.", chosen.pk if chosen else None)
+            if chosen is not None and chosen.body_file:
+                return file_response(chosen.body_file, request, rule.get_substituter())
+            text = chosen.response if chosen is not None else ''
+            with timer.phase('render'):
+                content = rule.render_content(text, params)
+            if chosen is not None and chosen.body_id and content == text:  # nothing substituted or filled in
+                return body_response(request, content, chosen.body)
+            return body_response(request, content)
 
         elif rule.action == 'live':
-            logger.info("  StormCloud returning live response.")
-            return HttpResponse(rule.live_response(get=request.GET.copy(), post=request.POST.copy(),
-                                                   verb=request.META['REQUEST_METHOD']))
+            logger.debug("  StormCloud returning live response.")
+            with timer.phase('upstream'):
+                content = rule.live_content(get=request.GET.copy(), post=request.POST.copy(),
+                                            verb=request.META['REQUEST_METHOD'])
+            with timer.phase('render'):
+                content = rule.render_content(content, params)
+            return body_response(request, content)
+
+        elif rule.action in PACED_ACTIONS:
+            with timer.phase('select'):
+                chosen = rule.choose_response()
+            logger.debug("  StormCloud sending response %s paced (%s)", chosen.pk if chosen else None, rule.action)
+            if chosen is not None and chosen.body_file:  # sent as stored, like file_response() does
+                f = open(chosen.body_file.path, 'rb')
+                length = os.fstat(f.fileno()).st_size
+                return paced_response(rule, request, iter_file(f, 0, length), length)
+            with timer.phase('render'):
+                content = force_bytes(rule.render_response(chosen, params))
+            return paced_response(rule, request, [content], len(content))
+
+        elif rule.action == 'proxy':
+            logger.debug("  StormCloud streaming live response from %s", rule.live_url)
+            return self.proxy_response(rule, request)
 
         elif rule.action == '301':
-            url = rule.flat_response  # if not stored, if there are multiple configured URLs logging could report sending to the wrong URL
-            logger.info("  StormCloud returning 301 response to %s", url)
+            with timer.phase('select'):
+                chosen = rule.choose_response()  # chosen once, so what's logged is where the client was sent
+            with timer.phase('render'):
+                url = rule.render_response(chosen, params)
+            logger.debug("  StormCloud returning 301 response %s to %s", chosen.pk if chosen else None, url)
             return HttpResponsePermanentRedirect(url)  # treat the text field as a URL field
 
         elif rule.action == '302':
-            url = rule.flat_response  # if not stored, if there are multiple configured URLs logging could report sending to the wrong URL
-            logger.info("  StormCloud returning 302 response to %s", url)
+            with timer.phase('select'):
+                chosen = rule.choose_response()  # chosen once, so what's logged is where the client was sent
+            with timer.phase('render'):
+                url = rule.render_response(chosen, params)
+            logger.debug("  StormCloud returning 302 response %s to %s", chosen.pk if chosen else None, url)
             return HttpResponseRedirect(url)
 
         else:
@@ -104,7 +266,7 @@ class StormCloudMiddleware(object):
                              "do. Should an additional action be written into stormcloud.middleware.StormCloudMiddleware ?")
                 pass
             else:
-                logger.info("  StormCloud returning %s response", rule.action)
+                logger.debug("  StormCloud returning %s response", rule.action)
                 return HttpResponse('', status=int(rule.action))
 
         response = HttpResponse('')  # respond with nothing to everything else
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import sys
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -73,10 +74,19 @@ TEMPLATES = [
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'stormcloud.log.JSONFormatter',
+        },
+    },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
         },
+        'requests': {
+            'class': 'stormcloud.log.QueueStreamHandler',
+            'formatter': 'json',
+        },
     },
     'loggers': {
         'django': {
@@ -86,12 +96,20 @@ LOGGING = {
         },
         'stormcloud.middleware': {
             'handlers': ['console'],
-            'level': 'DEBUG',
+            'level': 'INFO',  # DEBUG to follow each request step by step
             'propagate': True,
         },
+        'stormcloud.requests': {  # one JSON line per request, written by a background thread
+            'handlers': ['requests'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
+if sys.argv[1:2] == ['test']:  # not to the console, the tests that look at the request log add a handler of their own
+    LOGGING['handlers']['requests'] = {'class': 'logging.NullHandler'}
+
 WSGI_APPLICATION = 'stormcloud.wsgi.application'
 
 
@@ -143,3 +161,74 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# Uploaded files, i.e. response bodies stored as files (RuleResponse.body_file)
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+
+# StormCloud
+
+# Shared rule snapshot, memory-mapped by every worker process on the host so an admin change reaches them all at once
+# and only one of them reads the rule tables from the database. Leave as None to have each process load its own copy.
+# e.g. os.path.join(BASE_DIR, 'rules.snapshot')
+STORMCLOUD_SNAPSHOT_PATH = None
+
+# Connections to live_url upstreams are pooled and kept alive per host. Pool size is per upstream host, the timeout is
+# (connect, read) in seconds, retries cover connection errors and idempotent requests only.
+STORMCLOUD_LIVE_POOL_SIZE = 10
+STORMCLOUD_LIVE_TIMEOUT = (3.05, 30)
+STORMCLOUD_LIVE_RETRIES = 2
+
+# Seed for picking between a rule's responses, set it to make a chaos run reproducible.
+STORMCLOUD_RANDOM_SEED = None
+
+# Rules for requests nothing matched yet are created in the background, in batches of up to this many, at least this
+# often (seconds).
+STORMCLOUD_DISCOVERY_BATCH_SIZE = 500
+STORMCLOUD_DISCOVERY_INTERVAL = 1.0
+
+# Per rule hit counts and latencies are kept in memory and written to the database this often (seconds).
+STORMCLOUD_STATS_FLUSH_INTERVAL = 10.0
+
+# Discover rules for URLs with ids in them (numbers, UUIDs, hex tokens) as one pattern rule per endpoint, e.g.
+# /v1/charges/{id}, instead of one rule per URL. See also `manage.py compact_rules` for rules discovered before.
+STORMCLOUD_DISCOVERY_TEMPLATES = False
+
+# Record every request StormCloud sees to this file, one JSON object per line, to replay later with
+# `manage.py replay_traffic`. None to not record anything.
+STORMCLOUD_CAPTURE_PATH = None
+
+# Add a Server-Timing header to every StormCloud response, breaking its time down into vendor and rule lookup, response
+# selection, rendering (substitutions), delay and upstream fetch. Browsers' dev tools and most HTTP clients can show it.
+STORMCLOUD_SERVER_TIMING = False
+
+# Profile this fraction of requests (0 to 1) with STORMCLOUD_PROFILER, the dotted path to a callable that takes the
+# request and returns a context manager to handle it in. The default writes a cProfile .prof file per request to
+# STORMCLOUD_PROFILE_DIR (the temp directory if None).
+STORMCLOUD_PROFILE_RATE = 0
+STORMCLOUD_PROFILER = 'rules.timing.cprofile_hook'
+STORMCLOUD_PROFILE_DIR = None
+
+# Fraction of requests (0 to 1) logged to stormcloud.requests, unless a rule or its vendor sets its own log_sample_rate.
+STORMCLOUD_LOG_SAMPLE_RATE = 1.0
+
+# Serve mocks from a minimal WSGI application (stormcloud.dispatch) that skips Django's URL routing, middleware and
+# request signals, handing only the admin, static files and rules without an action to Django. False to run every
+# request through Django as before.
+STORMCLOUD_FAST_PATH = True
+
+# Response text is stored once per distinct body, compressed with 'zlib', 'zstd' (needs the zstandard package) or None.
+# Up to STORMCLOUD_BODY_CACHE_SIZE bytes of recently used bodies are kept decoded in memory.
+STORMCLOUD_BODY_COMPRESSION = 'zlib'
+STORMCLOUD_BODY_CACHE_SIZE = 64 * 1024 * 1024
+
+# Send responses gzipped (or brotli compressed, if the brotli package is installed) to clients whose Accept-Encoding
+# allows it, like most real vendors do. Stored bodies are compressed once when saved, substituted and live ones as
+# they're streamed out.
+STORMCLOUD_COMPRESS_RESPONSES = True
+
+# Rules' and vendors' rate_limit and max_in_flight are counted in a table of STORMCLOUD_LIMIT_SLOTS slots (one per
+# limited rule or vendor). With STORMCLOUD_LIMITS_PATH set it's a file every worker process maps, so limits hold
+# across all of them. None counts per process.
+STORMCLOUD_LIMITS_PATH = None
+STORMCLOUD_LIMIT_SLOTS = 4096
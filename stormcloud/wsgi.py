@@ -9,8 +9,18 @@ https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "stormcloud.settings")
 
 application = get_wsgi_application()
+
+if getattr(settings, 'STORMCLOUD_FAST_PATH', True):
+    from stormcloud.dispatch import StormCloudApplication  # needs the apps loaded
+
+    application = StormCloudApplication(application)
+
+from rules.table import warm_up  # noqa: E402
+
+warm_up()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 16:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendors', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vendor',
+            name='base_url',
+            field=models.CharField(blank=True, default='', help_text='Hostname requests for this vendor arrive on, optionally with a path prefix (e.g. localhost/stripe) so several vendors can share a hostname. The longest matching prefix wins. A scheme or port is ignored.', max_length=256),
+        ),
+    ]
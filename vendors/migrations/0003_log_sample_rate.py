@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendors', '0002_base_url_prefix'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendor',
+            name='log_sample_rate',
+            field=models.FloatField(blank=True, help_text="Fraction of requests to this vendor's rules to log (0 to 1). Blank to use STORMCLOUD_LOG_SAMPLE_RATE.", null=True, validators=[django.core.validators.MinValueValidator(0.0), django.core.validators.MaxValueValidator(1.0)]),
+        ),
+    ]
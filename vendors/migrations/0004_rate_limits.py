@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.8 on 2026-10-18 17:22
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vendors', '0003_log_sample_rate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendor',
+            name='max_in_flight',
+            field=models.PositiveIntegerField(blank=True, help_text="Most requests to this vendor's rules being answered at once, across all workers. Requests over it get a 503. Blank for no limit.", null=True),
+        ),
+        migrations.AddField(
+            model_name='vendor',
+            name='rate_burst',
+            field=models.PositiveIntegerField(blank=True, help_text='Requests let through at once before rate_limit applies. Blank for one second of rate_limit.', null=True),
+        ),
+        migrations.AddField(
+            model_name='vendor',
+            name='rate_limit',
+            field=models.FloatField(blank=True, help_text="Requests per second to all of this vendor's rules, across all workers. Requests over it get a 429 with Retry-After. Blank for no limit.", null=True, validators=[django.core.validators.MinValueValidator(0.0)]),
+        ),
+    ]
@@ -1,13 +1,31 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 
 
 class Vendor(models.Model):
     name = models.CharField(max_length=64, null=False, blank=True, default='')
-    base_url = models.CharField(max_length=256, null=False, blank=True, default='')
+    base_url = models.CharField(max_length=256, null=False, blank=True, default='',
+                                help_text=u'Hostname requests for this vendor arrive on, optionally with a path prefix '
+                                          u'(e.g. localhost/stripe) so several vendors can share a hostname. The '
+                                          u'longest matching prefix wins. A scheme or port is ignored.')
     override_instructions = models.TextField(null=False, blank=True, default='')
+    log_sample_rate = models.FloatField(null=True, blank=True,
+                                        validators=[MinValueValidator(0.0), MaxValueValidator(1.0)],
+                                        help_text=u"Fraction of requests to this vendor's rules to log (0 to 1). Blank "
+                                                  u'to use STORMCLOUD_LOG_SAMPLE_RATE.')
+    rate_limit = models.FloatField(null=True, blank=True, validators=[MinValueValidator(0.0)],
+                                   help_text=u"Requests per second to all of this vendor's rules, across all workers. "
+                                             u'Requests over it get a 429 with Retry-After. Blank for no limit.')
+    rate_burst = models.PositiveIntegerField(null=True, blank=True,
+                                             help_text=u'Requests let through at once before rate_limit applies. '
+                                                       u'Blank for one second of rate_limit.')
+    max_in_flight = models.PositiveIntegerField(null=True, blank=True,
+                                                help_text=u"Most requests to this vendor's rules being answered at "
+                                                          u'once, across all workers. Requests over it get a 503. '
+                                                          u'Blank for no limit.')
 
     def __unicode__(self):
         return self.name